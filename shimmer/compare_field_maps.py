@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+import os
+
+# one blas thread per worker, as reevaluate.py. set before numpy is imported.
+for variable in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+    os.environ.setdefault(variable, "1")
+
+import concurrent.futures
+import csv
+import sys
+import time
+
+import numpy as np
+
+from libraries.field_map_comparison import CONDITIONS, PERCENTILES, compare_task
+
+# shimming_comparison/compare_field_maps.m for a whole study: the field differences after movement, unshimmed and
+# shimmed, of every session, see libraries/field_map_comparison.py for what a session folder holds.
+# sessions are compared on a process pool across all the cores. writes to the output folder:
+#   summary.csv    a row per session and condition: mean, std, rms, largest difference and percentiles (Hz).
+#   slices.csv     a row per session, condition and slice.
+#   <session>.npz  the masked differences, conditions x volume, for figures.
+
+
+def main():
+    # check correct arguments (the output folder and at least one session)
+    if len(sys.argv) < 3:
+        print(
+            f"Usage: {sys.argv[0]} <output folder> <session folder> [<session folder> ...]"
+        )
+        sys.exit(1)
+    output_folder = sys.argv[1]
+    sessions = sys.argv[2:]
+    os.makedirs(output_folder, exist_ok=True)
+
+    workers = min(os.cpu_count() or 1, len(sessions))
+    print(f"Comparing {len(sessions)} sessions on {workers} processes.")
+    started = time.perf_counter()
+
+    summary = []
+    slices = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        for folder, statistics, differences, error in pool.map(compare_task, sessions):
+            name = os.path.basename(os.path.normpath(folder))
+            if error is not None:
+                print(f"{name}: skipped, {error}")
+                continue
+            np.savez(
+                os.path.join(output_folder, f"{name}.npz"),
+                differences=differences,
+                conditions=CONDITIONS,
+            )
+
+            for c, condition in enumerate(CONDITIONS):
+                row = {"session": name, "condition": condition}
+                for key in ("voxels", "mean", "std", "rms", "max_abs"):
+                    row[key] = statistics[key][c]
+                for p, value in zip(PERCENTILES, statistics["percentiles"][c]):
+                    row[f"p{p}"] = value
+                summary.append(row)
+
+                for s in range(len(statistics["slice_voxels"])):
+                    slices.append(
+                        {
+                            "session": name,
+                            "condition": condition,
+                            "slice": s + 1,  # from 1, as the scanner numbers them.
+                            "voxels": statistics["slice_voxels"][s],
+                            "mean": statistics["slice_mean"][c, s],
+                            "std": statistics["slice_std"][c, s],
+                            "rms": statistics["slice_rms"][c, s],
+                        }
+                    )
+
+    if not summary:
+        print("No sessions could be compared.")
+        sys.exit(1)
+    for filename, rows in (("summary.csv", summary), ("slices.csv", slices)):
+        with open(os.path.join(output_folder, filename), "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+
+    # the table, and the study's mean of each.
+    print(f"Done in {time.perf_counter() - started:.1f} s.")
+    print(f"{'session':<24}{'condition':<12}{'std':>10}{'rms':>10}{'p95':>10}")
+    for row in summary:
+        print(
+            f"{row['session']:<24}{row['condition']:<12}{row['std']:>10.2f}{row['rms']:>10.2f}{row['p95']:>10.2f}"
+        )
+    for condition in CONDITIONS:
+        rows = [row for row in summary if row["condition"] == condition]
+        print(
+            f"{'mean':<24}{condition:<12}{np.mean([r['std'] for r in rows]):>10.2f}"
+            f"{np.mean([r['rms'] for r in rows]):>10.2f}{np.mean([r['p95'] for r in rows]):>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
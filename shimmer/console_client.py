@@ -1,37 +1,117 @@
 #!/usr/bin/env python3
 
+import collections
+import json
+import os
+import queue
 import selectors
 import sys
+import threading
+import time
 import traceback
 
 import libraries.parser as parser
+import libraries.transport as transport
 from libraries.generic_client import Client
 from libraries.printers import selector_printer
 
+# stdin is read on a thread of its own, so the console keeps receiving relays and server output while someone is
+# typing. each line is handed to the main loop through a queue, and a socketpair wakes the selector up (windows can
+# only select on sockets, not stdin). the next prompt waits until the last command has been answered, for a second
+# at most, so answers aren't printed in the middle of it.
+#
+# !status shows a summary from mrshim (frame rate, currents, latency, amplifier temperatures) every few seconds.
+# mrshim only works it out when asked, and only that often, so it doesn't slow down shimming.
+
+ANSWER_TIMEOUT = 1.0  # seconds to wait for an answer before prompting again anyway.
+
 
 class CommandPrompt(Client):
     """A class to be the command prompt so that we can put it on the selector and select into at the correct times."""
 
-    def __init__(self, name):
+    quiet_commands = frozenset(["status_update"])
+
+    def __init__(self, name, sock=None):
         super().__init__(name)
-        self.start_connection()
+        self.commands.register("egg", self.egg)
+        self.commands.register(
+            "status", self.status, rest=str, usage="!status [seconds|off]"
+        )
+        self.commands.register("status_update", self.status_update, arguments=(str,))
+        self.start_connection(sock)
+
+        self.lines = queue.Queue()  # typed, waiting for the main loop.
+        self.requests = collections.deque()  # waiting for the connection to be free.
+        self._wakeup = transport.Wakeup(self.selector)
+        self._ready_to_prompt = threading.Event()
+        self._ready_to_prompt.set()
+        self._answer_deadline = None  # while waiting for an answer to a command.
+        self.status_interval = 0
+        self._last_status = 0
+
+        self._stdin_thread = threading.Thread(target=self._read_stdin, daemon=True)
+        self._stdin_thread.start()
 
     def close(self):
+        self._wakeup.close()
         super().close()
 
-    def send_command(self):
-        """Input a command string from the user, turn it into a request and send it to the server."""
-        command_string = input("[shimmer]: ")
-
-        if not command_string:
-            # if nothing is entered, then try and read
-            command_string = "!reader"
+    def _read_stdin(self):
+        """Runs on its own thread. Prompt for lines and hand them to the main loop, None at the end of input.
+
+        Reads the file descriptor rather than input(), which would hold sys.stdin's lock and stop python exiting
+        while it waits."""
+        pending = b""
+        while self.running:
+            self._ready_to_prompt.wait()
+            self._ready_to_prompt.clear()
+            print("[shimmer]: ", end="", flush=True)
+
+            while b"\n" not in pending:
+                data = os.read(sys.stdin.fileno(), 4096)
+                if not data:
+                    self.lines.put(None)
+                    self._wakeup.wake()
+                    return
+                pending += data
+            line, pending = pending.split(b"\n", 1)
+            self.lines.put(line.decode("utf-8", errors="replace").rstrip("\r"))
+            self._wakeup.wake()
+
+    def main_loop(self, timeout=0.1):
+        super().main_loop(timeout)
+
+        while not self.lines.empty():
+            line = self.lines.get_nowait()
+            if line is None:
+                self.running = False
+                return
+            self.send_command(line)
+
+        message = self.selector.get_key(self.socket).data
+        if self.requests and message.is_idle():
+            self.send_request(self.requests.popleft())
+            self._answer_deadline = time.monotonic() + ANSWER_TIMEOUT
+
+        if self._answer_deadline is not None:
+            if time.monotonic() < self._answer_deadline:
+                return
+            self._answer_deadline = None
+        if not self.requests and not self._ready_to_prompt.is_set():
+            self._ready_to_prompt.set()
+
+    def send_command(self, command_string):
+        """Turn a line the user entered into a request and queue it for the server, or run it if it is ours."""
+        if not command_string.strip():
+            return
 
+        # the only place a typed command is parsed, it is sent on as tokens.
         command_tokens = parser.parse(command_string)
 
         if command_tokens[0][0] == "!":
-            self.handle_command(command_string[1:])
-            return 1
+            command_tokens[0] = command_tokens[0][1:]
+            self.handle_command(command_tokens)
+            return
         else:
             if command_tokens[0] == "relay":
                 try:
@@ -39,19 +119,18 @@ class CommandPrompt(Client):
                     packet = {
                         "to": command_tokens[1],
                         "from": self.name,
-                        "content": command_tokens[2],
+                        "content": parser.parse(command_tokens[2]),
                     }
                 except IndexError:
                     print('Usage: relay <to name> "<content>"')
-                    return 1
+                    return
             else:
                 action = "command"
                 packet = {
                     "to": "server",
                     "from": self.name,
-                    "content": command_tokens[0],
+                    "content": command_tokens,
                 }
-                # NOTE: all server commands (currently) have zero arguments. is this appropriate?
 
             self.logger.debug(f"Attempting to create request.")
             self.logger.debug(f"Command tokens are {command_tokens}")
@@ -59,19 +138,19 @@ class CommandPrompt(Client):
                 action,
                 packet,
             )
-            self.send_request(request)
-        return 2
+            self.requests.append(request)
 
     def process_events(self, mask):
-        """Called by main loop. Main entry to the prompt, which will either allow a command to be entered or wait for a response."""
+        """Called by main loop. Lets the packet write if we have queued something, otherwise goes back to reading."""
         if mask & selectors.EVENT_READ:
-            # the selector for the prompt is set back to write mode by the packet once its finished processing.
+            self._answer_deadline = None  # got our answer, or something else worth seeing before the prompt.
             return mask
         if mask & selectors.EVENT_WRITE:
-            mask = (
-                self.send_command()
-            )  # .send_command returns a mask because client commands need us to *not* write afterwards.
-            return mask
+            message = self.selector.get_key(self.socket).data
+            if message.request is not None:
+                return mask
+            self.selector.modify(self.socket, selectors.EVENT_READ, data=message)
+            return selectors.EVENT_READ
 
     def create_request(self, action, value):
         """Make a requst from the users entry.
@@ -92,44 +171,74 @@ class CommandPrompt(Client):
         else:
             pass  # action is always one of either relay or command. is set by code.
 
-    def handle_command(self, command_string):
-        if not command_string:
-            return
-
-        command_tokens = parser.parse(command_string)
-        self.logger.debug(f"Recieved command tokens are {command_tokens}")
-        if command_tokens[0] == "egg":
-            print(f"Dogs can't operate MRI scanners... \a")
-            print(f"But cats can!")
-        elif command_tokens[0] == "reader":
-            # temporarily set the mask to read, and call main_loop to read any waiting input.
-            # then go back to whatever we were doing before.
-            message = self.selector.get_key(self.socket).data
-            old_state = self.selector.get_key(self.socket).events
-            self.selector.modify(self.socket, selectors.EVENT_READ, data=message)
-            self.main_loop()
-            self.selector.modify(self.socket, selectors.EVENT_WRITE, data=message)
-
-        super().handle_command(command_string)
-
-
-# check correct arguments (none)
-if len(sys.argv) != 1:
-    print(f"Usage: {sys.argv[0]}")
-    sys.exit(1)
+    def egg(self):
+        print(f"Dogs can't operate MRI scanners... \a")
+        print(f"But cats can!")
 
-
-console_number = int(input("Enter console number (1 or 2): "))
-name = "console" + str(console_number)
-
-# create and register the command prompt.
-prompt = CommandPrompt(name)
-
-try:
-    while prompt.running:
-        prompt.main_loop()
-except KeyboardInterrupt:
-    print("Exiting program!")
-finally:
-    prompt.close()
-    sys.exit(0)
+    def status(self, *seconds):
+        """Ask mrshim for its status every so many seconds (1 by default), or to stop with off."""
+        if seconds and seconds[0] == "off":
+            interval = 0
+        else:
+            try:
+                interval = float(seconds[0]) if seconds else 1.0
+            except ValueError:
+                print("Usage: !status [seconds|off]")
+                return
+        self.status_interval = interval
+
+        packet = {
+            "to": "mrshim",
+            "from": self.name,
+            "content": ["!report_status", self.name, str(interval)],
+        }
+        self.requests.append(self.create_request("relay", packet))
+
+    def status_update(self, status):
+        """The status from mrshim, shown at most once per status interval."""
+        now = time.monotonic()
+        if (
+            not self.status_interval
+            or now - self._last_status < self.status_interval / 2
+        ):
+            return
+        self._last_status = now
+
+        status = json.loads(status)
+        latency = status["latency"]
+        latency = "unknown" if latency is None else f"{latency * 1e3:.1f} ms"
+        print(
+            f"\n[status] {status['frame_rate']:.1f} frames/s, latency {latency},"
+            f" shimming {'on' if status['shimming'] else 'off'}"
+            f"{', held' if status['holding'] else ''}"
+        )
+        print(f"[status] currents [mA]: {' '.join(str(c) for c in status['currents'])}")
+        if status["temperatures"] is not None:
+            temperatures = " ".join(f"{t:.1f}" for t in status["temperatures"])
+            print(f"[status] temperatures ['C]: {temperatures}")
+
+
+def main():
+    # check correct arguments (none)
+    if len(sys.argv) != 1:
+        print(f"Usage: {sys.argv[0]}")
+        sys.exit(1)
+
+    console_number = int(input("Enter console number (1 or 2): "))
+    name = "console" + str(console_number)
+
+    # create and register the command prompt.
+    prompt = CommandPrompt(name)
+
+    try:
+        while prompt.running:
+            prompt.main_loop()  # waits for the server or a typed line.
+    except KeyboardInterrupt:
+        print("Exiting program!")
+    finally:
+        prompt.close()
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+# runs the server, the mrshim client and a sender in one python process, connected over queues instead of sockets.
+# useful for testing without a network, or for running everything on one computer with the lowest latency.
+
+# note, this won't import from inside /docs/, move to the root of shimmer for this import to work.
+from shimming_server import ShimmingServer
+from mrshim_client import MRShimClient
+from libraries.generic_client import Client
+
+server = ShimmingServer()
+server.start()  # still listens for clients on other computers.
+
+# each in-process client gets its end of the connection from the server.
+mrshim = MRShimClient("mrshim", sock=server.connect_inprocess("mrshim"))
+sender = Client("matlab")
+sender.start_connection(server.connect_inprocess("matlab"))
+
+
+def run_once():
+    # nothing blocks, so everybody gets a turn.
+    server.main_loop(timeout=0)
+    mrshim.main_loop()
+    sender.main_loop()
+
+
+for _ in range(10):  # let the sender's connection message through.
+    run_once()
+
+request = dict(
+    type="relay",
+    content={"to": "mrshim", "from": "matlab", "content": "!shim 10 20 30"},
+)
+sender.send_request(request)
+
+for _ in range(10):
+    run_once()
+
+# stopping the server tells the clients to disconnect too.
+server.stop()
+while server.running:
+    run_once()
+
+mrshim.close()
+sender.close()
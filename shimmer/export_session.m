@@ -0,0 +1,41 @@
+%% Export a recorded scan for reevaluate.py
+% writes the Bfit skope recorded, the probe positions and the calibration
+% inputs of one scan to a folder of .npy files, which python memory maps.
+% see libraries/reevaluation.py for what is in it.
+clear all;
+
+% SET PATH TO SHIMMER DIRECTORY, as in matlab_client.m
+shimmer_directory = 'C:/Users/skope/Documents/shimmer-newest/';
+addpath([shimmer_directory, 'libraries/'])
+addpath([shimmer_directory, 'libraries/methods/']);
+data_folder = [shimmer_directory , 'data/'];
+
+% the scan to export, and where to put it.
+scan_id = 6;
+session_folder = [shimmer_directory, 'sessions/', sprintf('scan%d', scan_id), '/'];
+mkdir(session_folder);
+
+%% probe fields and positions
+scan_metadata = AqSysData(data_folder, scan_id);
+% samples x channels x interleaves x dynamics, averaged to one field per
+% probe per dynamic, as the live loop does with each block.
+bfit = scan_metadata.getData('Bfit', [], [], [], []);
+bfit = squeeze(mean(mean(bfit, 1), 3));  % channels x dynamics
+writeNPY(double(bfit'), [session_folder, 'bfit.npy']);
+writeNPY(double(scan_metadata.probePositions), [session_folder, 'probe_positions.npy']);
+
+%% calibration inputs
+[img, ~] = rec_read_sjm([data_folder, 'field_map']);
+writeNPY(double(squeeze(img(:, :, :, 1, 1))), [session_folder, 'magnitude.npy']);
+copyfile([data_folder, 'coil_tmp.npy'], [session_folder, 'coil_tmp.npy']);
+
+% voxel sizes as in matlab_client.m
+info.dynamic_tr = scan_metadata.dynamicTR;
+info.resolution = 3e-3;
+info.z_resolution = 3.3e-3;
+info.scan_id = scan_id;
+fid = fopen([session_folder, 'session.json'], 'w');
+fprintf(fid, '%s', jsonencode(info));
+fclose(fid);
+
+fprintf('Exported scan %d to %s\n', scan_id, session_folder);
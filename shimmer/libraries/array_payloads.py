@@ -0,0 +1,66 @@
+import zlib
+
+import numpy as np
+
+# numpy arrays between clients as "ndarray" payloads (see libraries/payloads.py), e.g. probe fields, fitted
+# coefficients or telemetry for an analysis client to watch, without going through json lists.
+# the meta says what the array is:
+#   name         so a client can tell its arrays apart.
+#   dtype        numpy's dtype string, which starts with the byte order, e.g. "<f8".
+#   shape
+#   order        "C", or "F" for a column major (matlab) array, which is sent as it is rather than copied.
+#   compression  None, or "zlib" at the fastest level if that made it smaller.
+# and the body is the array's memory. on arrival the array is a read only view of the frame it came in, or of the
+# decompressed body, so it is never copied.
+
+
+def array_request(array, to, sender, name="", compress=False):
+    """A request sending an array to another client through the server.
+
+    The body is the array's own memory until the request is sent, so don't change the array before then."""
+    array = np.asarray(array)
+    if array.dtype.hasobject:
+        raise ValueError("Arrays of python objects can't be sent.")
+    shape = list(array.shape)
+
+    if array.flags.c_contiguous:
+        order = "C"
+    elif array.flags.f_contiguous:
+        order = "F"
+        # the transpose of a column major array is row major, in the same memory.
+        array = array.T
+    else:
+        order = "C"
+        array = np.ascontiguousarray(array)
+    body = memoryview(array.reshape(-1).view(np.uint8))
+
+    compression = None
+    if compress:
+        compressed = zlib.compress(body, 1)
+        if len(compressed) < len(body):
+            compression = "zlib"
+            body = compressed
+
+    meta = {
+        "name": name,
+        "dtype": array.dtype.str,
+        "shape": shape,
+        "order": order,
+        "compression": compression,
+    }
+    content = {"to": to, "from": sender, "meta": meta, "body": body}
+    return dict(type="ndarray", content=content)
+
+
+def array_from_payload(meta, body):
+    """The array in an "ndarray" payload, as a view of its body."""
+    if meta.get("compression") == "zlib":
+        body = zlib.decompress(body)
+    elif meta.get("compression") is not None:
+        raise ValueError(f"Unknown compression {meta['compression']!r}.")
+
+    dtype = np.dtype(meta["dtype"])
+    if dtype.hasobject:
+        raise ValueError("Arrays of python objects can't be received.")
+    shape = tuple(meta["shape"])
+    return np.frombuffer(body, dtype=dtype).reshape(shape, order=meta.get("order", "C"))
@@ -1,11 +1,15 @@
 import io
 import json
+import os
 import selectors
 import struct
 import sys
 import logging
 
-from libraries.parser import parse
+import libraries.commands as commands
+import libraries.transport as transport
+import libraries.protocol as protocol
+import libraries.payloads as payloads
 
 
 class Message:
@@ -23,12 +27,22 @@ class Message:
         self.jsonheader = None
         self.response = None
         self.is_relay = False
+        # (file descriptor, offset, count) of a payload body still to be sent straight from its file.
+        self._sendfile = None
+
+        # the protocol version we write to the server, goes up to 2 once it shows it can read it.
+        self.protocol_version = 1
+        self._sequence = 0
+
+        # whether the last read finished a frame for the client itself, rather than a clock pong or a payload.
+        self._got_client_frame = False
 
     def _clear(self):
         """Clear the buffers and sentinels ready to do the next thing."""
         self.request = None
         self._recv_buffer = b""
         self._send_buffer = b""
+        self._sendfile = None
         self._request_queued = False
         self._jsonheader_len = None
         self.jsonheader = None
@@ -41,6 +55,18 @@ class Message:
             # NOTE: *_client.py sets this back to write once a command is recieved.
             self._set_selector_events_mask("r")
 
+    def is_idle(self):
+        """Check we are neither sending nor part way through receiving anything."""
+        return (
+            self.request is None
+            and not self._request_queued
+            and not self._recv_buffer
+            and self._jsonheader_len is None
+        )
+
+    def _sending_clock_ping(self):
+        return self.request is not None and self.request["type"] == "clock"
+
     def _set_selector_events_mask(self, mode):
         """Set selector to listen for events: mode is 'r', 'w', or 'rw'."""
         if mode == "r":
@@ -57,15 +83,18 @@ class Message:
         """Read from the socket and add to the read buffer.
 
         Called repeatedly by .read()"""
+        started = self.client.profiler.begin()
         try:
             # Should be ready to read
-            data = self.sock.recv(4096)
+            data = self.sock.recv(65536)  # file chunks are 64 kB.
         except BlockingIOError:
             # Resource temporarily unavailable (errno EWOULDBLOCK)
             pass
         else:
+            self.client.profiler.end("recv", started)
             if data:
                 self._recv_buffer += data
+                self.client.bytes_in.inc(len(data))
             else:
                 raise RuntimeError("Peer closed.")
 
@@ -74,7 +103,16 @@ class Message:
 
         Called repeatedly by .write()"""
         if self._send_buffer:
-            self.client.logger.info(f"Sending {self._send_buffer!r} to {self.addr}")
+            profiler = self.client.profiler
+            started = profiler.begin()
+            if self.request is not None and self.request["type"] in payloads.FORWARDED:
+                self.client.logger.info(
+                    f"Sending {len(self._send_buffer)} bytes of {self.request['type']} to {self.addr}"
+                )
+            else:
+                self.client.logger.info(f"Sending {self._send_buffer!r} to {self.addr}")
+            profiler.end("logging", started)
+            started = profiler.begin()
             try:
                 # Should be ready to write
                 sent = self.sock.send(self._send_buffer)
@@ -82,28 +120,74 @@ class Message:
                 # Resource temporarily unavailable (errno EWOULDBLOCK)
                 pass
             else:
+                profiler.end("send", started)
                 self._send_buffer = self._send_buffer[sent:]
+                self.client.bytes_out.inc(sent)
+                if not self._send_buffer and self._sendfile is None:
+                    self.client.frames_out.inc()
+
+        if not self._send_buffer and self._sendfile is not None:
+            self._write_from_file()
+
+    def _write_from_file(self):
+        """Write the rest of a payload's body from its file, with the kernel copying it to the socket."""
+        fd, offset, count = self._sendfile
+        profiler = self.client.profiler
+        started = profiler.begin()
+        try:
+            sent = os.sendfile(self.sock.fileno(), fd, offset, count)
+        except BlockingIOError:
+            return
+        profiler.end("sendfile", started)
+        if not sent:
+            raise RuntimeError("File ended before its payload was sent.")
+        self.client.bytes_out.inc(sent)
+        if sent < count:
+            self._sendfile = (fd, offset + sent, count - sent)
+        else:
+            self._sendfile = None
+            self.client.frames_out.inc()
 
     def _json_encode(self, obj):
         """Encodes json into bytes."""
-        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        started = self.client.profiler.begin()
+        encoded = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.client.profiler.end("json_encode", started)
+        return encoded
 
     def _json_decode(self, json_bytes):
         """Decodes bytes into a json object."""
+        started = self.client.profiler.begin()
         tiow = io.TextIOWrapper(io.BytesIO(json_bytes), encoding="utf-8", newline="")
         obj = json.load(tiow)
         tiow.close()
+        self.client.profiler.end("json_decode", started)
         return obj
 
-    def _create_message(self, optional_header=None, *, content_bytes, content_type):
-        """Create the bytes of message that are sent down the wire."""
+    def _create_message(
+        self, optional_header=None, *, content_bytes, content_type, trailing_length=0
+    ):
+        """Create the bytes of message that are sent down the wire.
+
+        trailing_length is how much more content will be sent after content_bytes, straight from a file."""
+        self._sequence += 1
+        content_length = len(content_bytes) + trailing_length
+
+        if self.protocol_version >= 2:
+            header = protocol.pack_header(
+                content_type, content_length, optional_header, self._sequence
+            )
+            if header is not None:  # not everything fits in a version 2 header.
+                return header + content_bytes
+
         jsonheader = {
             "byteorder": sys.byteorder,
             "content-type": content_type,
-            "content-length": len(content_bytes),
+            "content-length": content_length,
         }
 
         jsonheader.update(optional_header)
+        jsonheader.update(protocol.offer())
 
         jsonheader_bytes = self._json_encode(jsonheader)
         message_hdr = struct.pack(">H", len(jsonheader_bytes))
@@ -115,7 +199,10 @@ class Message:
         content = self.response
         result = content.get("result")
         self.client.logger.info(f"Got result: {result}")
-        print(result)
+        tokens = commands.tokenize(result) if result else []
+        if tokens and tokens[0].lstrip("!") in self.client.quiet_commands:
+            return  # the client shows these its own way.
+        print(commands.join(result))
 
     def process_events(self, mask):
         """Use selector state to start read or write.
@@ -130,15 +217,22 @@ class Message:
         """
 
         # if statements are repeated many times because clients may change these variables duing their own processing of events.
+        # clock pings and pongs, and payloads, are handled here, so the client doesn't e.g. prompt for a command or
+        # apply shims. nor does it hear about part of a frame, which for a file chunk is most reads.
+        self._got_client_frame = False
         if mask & selectors.EVENT_READ:
             self.client.logger.debug("packet is reading")
             self.read()
-        if mask & selectors.EVENT_READ:
+        if mask & selectors.EVENT_READ and self._got_client_frame:
             self.client.logger.debug("client is doing something after packet read")
+            started = self.client.profiler.begin()
             mask = self.client.process_events(mask)
-        if mask & selectors.EVENT_WRITE:
+            self.client.profiler.end("client_after_read", started)
+        if mask & selectors.EVENT_WRITE and not self._sending_clock_ping():
             self.client.logger.debug("client is doing something before packet write")
+            started = self.client.profiler.begin()
             mask = self.client.process_events(mask)
+            self.client.profiler.end("client_before_write", started)
         if mask & selectors.EVENT_WRITE:
             self.client.logger.debug("packet is writing")
             self.write()
@@ -146,7 +240,10 @@ class Message:
     def read(self):
         """Read and sequence processing of message."""
         self._read()
+        self._process_recv_buffer()
 
+    def _process_recv_buffer(self):
+        """Work through as much of the next frame as we have."""
         if self._jsonheader_len is None:
             self.process_protoheader()
 
@@ -162,12 +259,17 @@ class Message:
     def write(self):
         """Write request if queued, generate it if not."""
         if not self._request_queued:
+            if self.request is None:
+                # nothing to send, go back to listening.
+                self._set_selector_events_mask("r")
+                return
             self.queue_request()
 
         self._write()
 
         if self._request_queued:  # if we have been sending a packet
-            if not self._send_buffer:  # but we've sent all of it.
+            # but we've sent all of it.
+            if not self._send_buffer and self._sendfile is None:
                 self._clear()
 
     def close(self):
@@ -179,7 +281,7 @@ class Message:
             print(f"Error: selector.unregister() exception for " f"{self.addr}: {e!r}")
 
         try:
-            self.sock.close()
+            transport.close(self.sock)
         except OSError as e:
             print(f"Error: socket.close() exception for {self.addr}: {e!r}")
         finally:
@@ -197,9 +299,15 @@ class Message:
                 "content_bytes": self._json_encode(content),
                 "content_type": content_type,
             }
-        elif content_type in ("command", "relay"):
+        elif content_type in ("command", *protocol.RELAYS):
+            command = content["content"]
+            if self.protocol_version < 2:
+                command = commands.join(command)  # a legacy server wants a string.
+                if content_type in protocol.RELAYS:
+                    content_type = "relay"  # and doesn't know the other relays.
+
             req = {
-                "content_bytes": self._json_encode(content["content"]),
+                "content_bytes": self._json_encode(command),
                 "content_type": content_type,
             }
 
@@ -208,8 +316,34 @@ class Message:
                 "from": content["from"],
             }
 
-            if content_type == "relay":
+            if content_type in protocol.RELAYS:
                 self.is_relay = True
+        elif content_type == "clock":
+            req = {
+                "content_bytes": self._json_encode(content),
+                "content_type": content_type,
+            }
+        elif content_type in payloads.FORWARDED:
+            # the meta then the body as it is, see libraries/payloads.py.
+            # a body given as a (file descriptor, offset, count) range is sent from the file if the socket can.
+            body = content.get("body", b"")
+            file_range = content.get("file_range")
+            if file_range is not None and not payloads.can_sendfile(self.sock):
+                body = payloads.read_range(*file_range)
+                file_range = None
+
+            req = {
+                "content_bytes": payloads.pack_meta(content["meta"]) + body,
+                "content_type": content_type,
+            }
+            if file_range is not None:
+                req["trailing_length"] = file_range[2]
+                self._sendfile = file_range
+
+            optional_header_parts = {
+                "to": content["to"],
+                "from": content["from"],
+            }
         else:
             server.logger.warn(f"Invalid request type {content_type} recieved.")
             return  # do not attempt to create a message.
@@ -219,7 +353,18 @@ class Message:
         self._request_queued = True
 
     def process_protoheader(self):
-        """Process the protoheader that says how long the jsonheader is."""
+        """Process the protoheader that says how long the jsonheader is.
+
+        A version 2 header is all one piece, so it is processed here too."""
+        if self._recv_buffer[:1] == protocol.MAGIC_BYTE:
+            if len(self._recv_buffer) >= protocol.HEADER.size:
+                self.jsonheader = protocol.unpack_header(self._recv_buffer)
+                self._recv_buffer = self._recv_buffer[protocol.HEADER.size :]
+                self._jsonheader_len = protocol.HEADER.size
+                # they wrote version 2, so they can read it.
+                self.protocol_version = protocol.VERSION
+            return
+
         hdrlen = 2
         if len(self._recv_buffer) >= hdrlen:
             self._jsonheader_len = struct.unpack(">H", self._recv_buffer[:hdrlen])[0]
@@ -242,6 +387,9 @@ class Message:
                 if reqhdr not in self.jsonheader:
                     raise ValueError(f"Missing required header '{reqhdr}'.")
 
+            if protocol.accepts_offer(self.jsonheader):
+                self.protocol_version = protocol.VERSION
+
     def process_response(self):
         """Process the actual response from the server."""
         content_len = self.jsonheader["content-length"]
@@ -251,16 +399,47 @@ class Message:
 
         data = self._recv_buffer[:content_len]
         self._recv_buffer = self._recv_buffer[content_len:]  # remove from buffer
+        self.client.frames_in.inc()
+
+        if self.jsonheader["content-type"] == "clock":
+            self.client.clock_pong(self._json_decode(data))
+            self._clear_keeping_next_frame()
+            return
+
+        if self.jsonheader["content-type"] in payloads.FORWARDED:
+            # straight to its handler, like clock pongs the client's own after read step doesn't need to see them.
+            meta, body = payloads.unpack(data)
+            started = self.client.profiler.begin()
+            self.client.handle_payload(
+                self.jsonheader["content-type"], meta, body, self.jsonheader.get("from")
+            )
+            self.client.profiler.end("handle_payload", started)
+            self._clear_keeping_next_frame()
+            return
 
-        if self.jsonheader["content-type"] in ("command", "text/json", "relay"):
+        self._got_client_frame = True
+        if "timestamp" in self.jsonheader:  # version 2 frames say when they were sent.
+            self.client.observe_frame_latency(self.jsonheader["timestamp"])
+        if self.jsonheader["content-type"] in (
+            "command",
+            "text/json",
+            *protocol.RELAYS,
+        ):
             self.response = self._json_decode(data)
             self.client.logger.debug(f"Decoded response from server is {self.response}")
             self._process_response_json_content()
 
-        if self.jsonheader["content-type"] == "relay":
+        if self.jsonheader["content-type"] in protocol.RELAYS:
             # a relay command is a command sent from another client.
-            if self.response["result"][0] == "!":  # client commands start with a bang!
-                self.client.handle_command(self.response["result"][1:])
+            # parsed here if a legacy client sent it as a string, and nowhere after.
+            started = self.client.profiler.begin()
+            command_tokens = commands.tokenize(self.response["result"])
+            self.client.profiler.end("parse", started)
+            if commands.is_client_command(command_tokens):
+                command_tokens[0] = command_tokens[0][1:]
+                started = self.client.profiler.begin()
+                self.client.handle_command(command_tokens)
+                self.client.profiler.end("handle_command", started)
             else:
                 # it's a server command, we know how to send those!
                 # implemented manually because not all clients have a command_send method
@@ -268,7 +447,7 @@ class Message:
                 packet = {
                     "to": "server",
                     "from": self.client.name,
-                    "content": self.response["result"],
+                    "content": command_tokens,
                 }
                 request = self.client.create_request(
                     action,
@@ -283,12 +462,20 @@ class Message:
                 f"Received response {self.response!r} from {self.addr}"
             )
         else:
-            # Binary or unknown content-type
-            self.response = data
-            self.client.logger.info(
-                f"Received {self.jsonheader['content-type']} "
-                f"response from {self.addr}"
+            # binary payloads have gone to their handler already, so we can't read this.
+            self.client.logger.warning(
+                f"Received {self.jsonheader['content-type']} frame from {self.addr},"
+                f" which isn't a type we know."
             )
-            self.client.logger.warn(f"Recieved packet with unknown type.")
 
+        self._clear_keeping_next_frame()
+
+    def _clear_keeping_next_frame(self):
+        """Clear up after a frame we received, then deal with whatever came in behind it.
+
+        e.g. a relay right behind a clock pong, which won't make the selector fire again."""
+        next_frame = self._recv_buffer
         self._clear()
+        if next_frame:
+            self._recv_buffer = next_frame
+            self._process_recv_buffer()
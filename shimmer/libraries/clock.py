@@ -0,0 +1,74 @@
+import collections
+import time
+
+# ntp style clock synchronisation between each client and the server.
+# every clock_sync_interval seconds a client sends a "clock" frame stamped with its time t0. the server stamps the
+# time it got it (t1) and the time it answered (t2), and the client stamps the time the answer got back (t3).
+# assuming the trip there and back take about as long, the server's clock is ahead of the client's by
+#     offset = ((t1 - t0) + (t2 - t3)) / 2
+# and we can't be sure of that to better than half the round trip, delay = (t3 - t0) - (t2 - t1).
+# the client keeps its estimate and sends it to the server with the next ping, so both ends know it.
+
+
+def exchange(t0, t1, t2, t3):
+    """Get the (offset, delay) one ping and pong measured. offset is server time minus client time."""
+    offset = ((t1 - t0) + (t2 - t3)) / 2
+    # can come out just below 0 from clock resolution.
+    delay = max(0.0, (t3 - t0) - (t2 - t1))
+    return offset, delay
+
+
+class ClockEstimator:
+    """Estimates the offset of the server's clock from ours, how sure we are of it, and how fast it is drifting.
+
+    Of the last few exchanges, the one with the shortest round trip had the least room for the trips there and back
+    to be different, so that one is used (like ntp's clock filter). Drift is fitted over a longer history."""
+
+    def __init__(self, window=8, history=64):
+        self._samples = collections.deque(maxlen=window)  # (delay, offset, local time)
+        self._history = collections.deque(maxlen=history)  # (local time, offset)
+        self.offset = None
+        self.uncertainty = None
+        self.drift = 0.0  # seconds per second the server's clock gains on ours.
+
+    def add_exchange(self, t0, t1, t2, t3):
+        offset, delay = exchange(t0, t1, t2, t3)
+        self._samples.append((delay, offset, t3))
+        self._history.append((t3, offset))
+        self._fit_drift()
+
+        best_delay, best_offset, best_time = min(self._samples)
+        # the best sample may be a few pings old, the clocks will have drifted apart a little since.
+        age = t3 - best_time
+        self.offset = best_offset + self.drift * age
+        self.uncertainty = best_delay / 2 + abs(self.drift) * age
+
+    def _fit_drift(self):
+        """Least squares slope of offset against time."""
+        if len(self._history) < 2:
+            return
+
+        n = len(self._history)
+        mean_t = sum(t for t, _ in self._history) / n
+        mean_offset = sum(offset for _, offset in self._history) / n
+        spread = sum((t - mean_t) ** 2 for t, _ in self._history)
+        if spread == 0:
+            return
+        self.drift = (
+            sum((t - mean_t) * (offset - mean_offset) for t, offset in self._history)
+            / spread
+        )
+
+    def server_time(self, local_time=None):
+        """Convert one of our times to the server's clock."""
+        if local_time is None:
+            local_time = time.time()
+        return local_time + (self.offset or 0.0)
+
+    def as_dict(self):
+        """What we send to the server with each ping."""
+        return {
+            "offset": self.offset,
+            "uncertainty": self.uncertainty,
+            "drift": self.drift,
+        }
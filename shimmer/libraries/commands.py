@@ -0,0 +1,90 @@
+from libraries.parser import parse
+
+# commands travel as lists of tokens, parsed once where they are typed in (or built already split up).
+# legacy peers only understand command strings, so we join the tokens back up for them.
+
+
+class CommandError(Exception):
+    """Raised when a command's arguments don't match what it declared."""
+
+    pass
+
+
+def tokenize(command):
+    """Get the tokens of a command, which may already be tokens or may be a string from a legacy peer."""
+    if isinstance(command, str):
+        return parse(command)
+    return list(command)
+
+
+def join(tokens):
+    """Turn tokens back into a command string, the inverse of parse."""
+    if isinstance(tokens, str):
+        return tokens
+    return " ".join(f'"{token}"' if " " in token else token for token in tokens)
+
+
+def is_client_command(tokens):
+    """Client commands start with a bang!"""
+    return bool(tokens) and tokens[0].startswith("!")
+
+
+class Command:
+    """A command name, its handler, and the arguments it takes.
+
+    arguments are functions that turn each token into the value the handler wants (e.g. int).
+    rest does the same to any remaining tokens, if the command takes a variable number of them."""
+
+    def __init__(self, name, handler, arguments=(), rest=None, usage=""):
+        self.name = name
+        self.handler = handler
+        self.arguments = tuple(arguments)
+        self.rest = rest
+        self.usage = usage
+
+    def validate(self, tokens):
+        """Turn the argument tokens into the handler's arguments, checking them against the declaration."""
+        if len(tokens) < len(self.arguments) or (
+            self.rest is None and len(tokens) > len(self.arguments)
+        ):
+            raise CommandError(
+                f"Incorrect number of arguments for command {self.name}. Look up correct usage in manual."
+            )
+
+        converters = self.arguments + (self.rest,) * (len(tokens) - len(self.arguments))
+        try:
+            return [convert(token) for convert, token in zip(converters, tokens)]
+        except ValueError:
+            usage = f" Usage: {self.usage}" if self.usage else ""
+            raise CommandError(f"Invalid arguments for command {self.name}.{usage}")
+
+
+class CommandTable:
+    """Maps command names to commands, so dispatch is one dictionary lookup however many commands there are."""
+
+    def __init__(self):
+        self._commands = {}
+
+    def __contains__(self, name):
+        return name in self._commands
+
+    def names(self):
+        return list(self._commands)
+
+    def register(self, name, handler, arguments=(), rest=None, usage=""):
+        """Add a command, replacing any with the same name (so a child class can override its parent)."""
+        self._commands[name] = Command(name, handler, arguments, rest, usage)
+
+    def dispatch(self, tokens):
+        """Validate a command's tokens and call its handler.
+
+        Returns False if there is no such command. Raises CommandError if the arguments are wrong."""
+        if not tokens:
+            return False
+
+        command = self._commands.get(tokens[0])
+        if command is None:
+            return False
+
+        command.handler(*command.validate(tokens[1:]))
+        return True
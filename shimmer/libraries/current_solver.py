@@ -0,0 +1,162 @@
+import collections
+import math
+import time
+
+import numpy as np
+
+# working out the shim currents for each frame within the amplifier's limits, instead of working them out without
+# limits and then zeroing everything if they are broken.
+#
+# the currents I minimise |H I + s|^2 + regularisation |I|^2, where s is the field to cancel (e.g. its spherical
+# harmonic coefficients) and H is the field each channel makes per mA, subject to |I_k| <= channel_limit on every
+# channel and rms(I) <= rms_limit overall (the power the amplifiers put out).
+# it is solved with accelerated projected gradient descent (fista), started from the last frame's currents, which
+# are usually nearly right already, and stopped when it converges or the frame's time budget runs out. every step
+# stays within the limits, so stopping early still gives currents we can use.
+# there are more channels than targets, so some combinations of currents make no field at all. the warm start is
+# first stripped of those (projected onto the row space of H), or whatever the last frame left of them would stay,
+# using up the amplifiers' headroom and rms budget for nothing. it is then scaled back within the limits, as
+# clipping it would bring some of them back.
+
+SolverResult = collections.namedtuple(
+    "SolverResult", ["currents", "iterations", "converged", "limited"]
+)
+
+
+class CurrentSolver:
+    """Bounded, regularised least squares for the shim currents, in a fixed time per frame.
+
+    field_per_current is targets x channels. Limits are in mA, time_budget in seconds."""
+
+    def __init__(
+        self,
+        field_per_current,
+        channel_limit=2000.0,
+        rms_limit=2000.0,
+        regularisation=0.0,
+        time_budget=0.002,
+        max_iterations=1000,
+        tolerance=1e-3,
+    ):
+        self.field_per_current = np.asarray(field_per_current, dtype=np.float64)
+        channels = self.field_per_current.shape[1]
+        self.channel_limit = channel_limit
+        self.rms_limit = rms_limit
+        self.regularisation = regularisation
+        # the rms limit as a limit on |I|.
+        self.norm_limit = rms_limit * math.sqrt(channels)
+        self.time_budget = time_budget
+        self.max_iterations = max_iterations
+        self.tolerance = tolerance  # mA, stop once no current moves by more than this.
+
+        # everything that doesn't change from frame to frame.
+        self._hessian = (
+            self.field_per_current.T @ self.field_per_current
+            + regularisation * np.eye(channels)
+        )
+        self._step = 1 / np.linalg.eigvalsh(self._hessian).max()
+        # takes away the currents which make no field.
+        self._row_space = (
+            np.linalg.pinv(self.field_per_current) @ self.field_per_current
+        )
+        self.previous = np.zeros(channels)
+
+    @classmethod
+    def from_coil_coefficients(cls, coil_coefficients, **kwargs):
+        """Make a solver from the currents which make each harmonic (harmonics x channels), as matlab_client.m makes.
+
+        Without limits it gives the same currents calculate_currents.m does."""
+        coil_coefficients = np.asarray(coil_coefficients, dtype=np.float64)
+        return cls(np.linalg.pinv(coil_coefficients.T), **kwargs)
+
+    def save(self, path):
+        """Save what the solver was made from, e.g. for pipeline_client.py to shim without matlab."""
+        np.savez(
+            path,
+            field_per_current=self.field_per_current,
+            channel_limit=self.channel_limit,
+            rms_limit=self.rms_limit,
+            regularisation=self.regularisation,
+        )
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        with np.load(path) as saved:
+            return cls(
+                saved["field_per_current"],
+                channel_limit=float(saved["channel_limit"]),
+                rms_limit=float(saved["rms_limit"]),
+                regularisation=float(saved["regularisation"]),
+                **kwargs,
+            )
+
+    def project(self, currents):
+        """The closest currents to these within the limits.
+
+        That is clip(scale * currents) for the largest scale <= 1 which meets the rms limit. Sorting the channels
+        by size gives the point at which each would start to clip, so the scale can be found without searching."""
+        clipped = np.clip(currents, -self.channel_limit, self.channel_limit)
+        if np.dot(clipped, clipped) <= self.norm_limit**2:
+            return clipped
+
+        # with the k largest channels clipped, scale^2 * (sum of the rest squared) + k * limit^2 = norm_limit^2.
+        sizes = np.sort(np.abs(currents))[::-1]
+        rest = np.cumsum((sizes**2)[::-1])[::-1]
+        clipped_channels = np.arange(len(sizes))
+        left = np.maximum(
+            self.norm_limit**2 - clipped_channels * self.channel_limit**2, 0
+        )
+        # channels at 0 can't clip, and divide by 0 here.
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scales = np.sqrt(left / rest)
+        # the right k has channel k unclipped at its scale (and channel k - 1 clipped, which follows).
+        k = np.argmax(scales * sizes <= self.channel_limit)
+        return np.clip(scales[k] * currents, -self.channel_limit, self.channel_limit)
+
+    def _warm_start(self):
+        """The last frame's currents, without any which make no field, within the limits."""
+        currents = self._row_space @ self.previous
+        largest = np.abs(currents).max(initial=0)
+        if largest == 0:
+            return currents
+        scale = min(
+            1.0,
+            self.channel_limit / largest,
+            self.norm_limit / np.linalg.norm(currents),
+        )
+        return scale * currents
+
+    def solve(self, target):
+        """The currents which best cancel target, within the limits and time budget."""
+        deadline = time.perf_counter() + self.time_budget
+        linear = self.field_per_current.T @ np.asarray(target, dtype=np.float64)
+
+        currents = self._warm_start()
+        momentum = currents
+        t = 1.0
+        converged = False
+        for iteration in range(1, self.max_iterations + 1):
+            gradient = self._hessian @ momentum + linear
+            new_currents = self.project(momentum - self._step * gradient)
+
+            t_next = (1 + math.sqrt(1 + 4 * t * t)) / 2
+            momentum = new_currents + ((t - 1) / t_next) * (new_currents - currents)
+            change = np.abs(new_currents - currents).max()
+            currents, t = new_currents, t_next
+
+            if change < self.tolerance:
+                converged = True
+                break
+            if time.perf_counter() > deadline:
+                break
+
+        self.previous = currents
+        limited = bool(
+            np.any(np.abs(currents) >= self.channel_limit)
+            or np.linalg.norm(currents) >= self.norm_limit * (1 - 1e-9)
+        )
+        return SolverResult(currents, iteration, converged, limited)
+
+    def reset(self):
+        """Forget the last frame, e.g. between scans."""
+        self.previous = np.zeros_like(self.previous)
@@ -0,0 +1,117 @@
+import math
+
+import numpy as np
+
+# denoising the probe fields and predicting them forward to when the currents will actually be applied.
+# by the time a frame's currents reach the shims (skope, the solve, the relay and the amplifiers), the field they
+# were worked out from is at least a dynamicTR old, which for breathing is a big error.
+#
+# a kalman filter for each probe. all the probes share the same model and noise, so they share the same covariance
+# and gain too: each frame is a handful of 2x2 or 3x3 matrix sums, plus one multiply-add over the probes.
+#
+# models:
+#   velocity     the field and how fast it is changing, good for anything smooth.
+#   respiratory  a slowly wandering level plus an oscillation at the breathing rate, whose phase and size are
+#                tracked, so it predicts the turn at the top and bottom of each breath.
+
+# per second, in Hz. the oscillation explains most of breathing, so needs far less left over than a straight line.
+_DEFAULT_PROCESS_NOISE = {"velocity": 5.0, "respiratory": 0.5}
+
+
+def _rotation(angle):
+    c, s = math.cos(angle), math.sin(angle)
+    return np.array([[c, -s], [s, c]])
+
+
+class FieldPredictor:
+    """Filters each frame of probe fields and predicts them forward by the pipeline latency.
+
+    Noise is in the units of the field, the defaults suit fields in Hz. process_noise is how much the field is
+    expected to wander per second beyond what the model explains, measurement_noise how noisy each frame is."""
+
+    def __init__(
+        self,
+        channels,
+        model="velocity",
+        process_noise=None,
+        measurement_noise=0.5,
+        breathing_period=4.0,
+    ):
+        if model not in ("velocity", "respiratory"):
+            raise ValueError(f"Unknown field model {model!r}.")
+        self.model = model
+        if process_noise is None:
+            process_noise = _DEFAULT_PROCESS_NOISE[model]
+        self.process_noise = process_noise
+        self.measurement_variance = measurement_noise**2
+        self.breathing_frequency = 2 * math.pi / breathing_period  # rad/s
+
+        states = 2 if model == "velocity" else 3
+        self._observe = np.zeros(states)  # what the probes measure of the state.
+        self._observe[0] = 1
+        if model == "respiratory":
+            self._observe[1] = 1  # level plus the oscillation.
+
+        self.state = np.zeros((states, channels))
+        self.covariance = None  # None until the first frame.
+        self.last_time = None
+
+    def _transition(self, dt):
+        if self.model == "velocity":
+            return np.array([[1.0, dt], [0.0, 1.0]])
+        transition = np.eye(3)
+        transition[1:, 1:] = _rotation(self.breathing_frequency * dt)
+        return transition
+
+    def _process_covariance(self, dt):
+        q = self.process_noise**2
+        if self.model == "velocity":
+            # the rate of change wanders randomly.
+            return q * np.array([[dt**3 / 3, dt**2 / 2], [dt**2 / 2, dt]])
+        return q * dt * np.eye(3)
+
+    def update(self, field, time):
+        """Add a frame of probe fields measured at time (seconds), returns the filtered fields."""
+        field = np.asarray(field, dtype=np.float64)
+
+        if self.covariance is None:
+            self.state[0] = field
+            self.covariance = np.eye(len(self.state)) * self.measurement_variance
+            if self.model == "respiratory":
+                self.covariance[1:, 1:] *= 100  # no idea about the breathing yet.
+            self.last_time = time
+            return self.filtered()
+
+        dt = max(time - self.last_time, 0.0)
+        self.last_time = time
+        transition = self._transition(dt)
+        self.state = transition @ self.state
+        self.covariance = (
+            transition @ self.covariance @ transition.T + self._process_covariance(dt)
+        )
+
+        # one gain for every probe, as they share a covariance.
+        observe = self._observe
+        innovation_variance = (
+            observe @ self.covariance @ observe + self.measurement_variance
+        )
+        gain = self.covariance @ observe / innovation_variance
+        innovation = field - observe @ self.state
+        self.state += np.outer(gain, innovation)
+        self.covariance -= np.outer(gain, observe @ self.covariance)
+        return self.filtered()
+
+    def filtered(self):
+        return self._observe @ self.state
+
+    def predict(self, latency):
+        """The fields expected latency seconds after the last frame."""
+        if self.covariance is None:
+            raise ValueError("No frames to predict from yet.")
+        return self._observe @ self._transition(latency) @ self.state
+
+    def reset(self):
+        """Forget everything, e.g. between scans."""
+        self.state[:] = 0
+        self.covariance = None
+        self.last_time = None
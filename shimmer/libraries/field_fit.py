@@ -0,0 +1,84 @@
+import collections
+
+import numpy as np
+
+# fitting the field at each probe ourselves, from the raw fids on PortBase+2, instead of waiting for skope's bfit.
+# a probe's signal precesses at gamma * B, so over the fit window its phase is a straight line against time whose
+# slope is the angular frequency. every channel and interleave is fitted at once with the same matrix products.
+
+GAMMA_1H = 267.5e6  # rad/s/T, as used in calculate_currents.m
+GAMMA_19F = 251.815e6  # rad/s/T, fluorine probes.
+
+# per probe (and interleave) results, each of shape (..., channels).
+FieldFit = collections.namedtuple("FieldFit", ["frequency", "field", "phase"])
+
+
+def unwrapped_phase(signal):
+    """Phase of complex signals along the last axis, without jumps of 2 pi.
+
+    Rather than np.unwrap on np.angle, the phase step between each pair of samples is taken from their product,
+    which is one angle per sample and needs no branches. Steps must be under pi, i.e. the probe's frequency under
+    half the sampling rate, which it is or the fit would be meaningless anyway."""
+    steps = np.angle(signal[..., 1:] * np.conj(signal[..., :-1]))
+    phase = np.empty(signal.shape, dtype=np.float64)
+    phase[..., 0] = np.angle(signal[..., 0])
+    np.cumsum(steps, axis=-1, out=phase[..., 1:])
+    phase[..., 1:] += phase[..., :1]
+    return phase
+
+
+class FieldFitter:
+    """Fits frequency and field to raw fids, over the fitStart/fitDuration window of the scan definition.
+
+    Everything that only depends on the window is worked out once here, fit() is then two small matrix products.
+    dwell is the sampling dwell time in seconds. offres_frequencies (Hz, one per channel) are the probes' own
+    offsets, from the .scan file, which are taken off."""
+
+    def __init__(
+        self, dwell, fit_start, fit_duration, gamma=GAMMA_19F, offres_frequencies=None
+    ):
+        self.dwell = dwell
+        self.gamma = gamma
+        first = int(round(fit_start / dwell))
+        count = max(2, int(round(fit_duration / dwell)))
+        self.window = slice(first, first + count)
+
+        # least squares straight line through (t, phase): slope and intercept are weighted sums of the phases.
+        t = (first + np.arange(count)) * dwell
+        t_centred = t - t.mean()
+        slope_weights = t_centred / np.sum(t_centred**2)
+        intercept_weights = 1 / count - t.mean() * slope_weights
+        self._weights = np.stack([slope_weights, intercept_weights], axis=1)
+
+        self.offres_frequencies = (
+            None if offres_frequencies is None else np.asarray(offres_frequencies)
+        )
+
+    @classmethod
+    def from_scan_def(cls, scan_def, dwell, **kwargs):
+        """Make a fitter for a short scan definition, as got with SkopeControl.get_short_scan_def()."""
+        return cls(dwell, scan_def["fitStart"], scan_def["fitDuration"], **kwargs)
+
+    def fit(self, raw, interleaves=1):
+        """Fit a block of raw data, channels x samples (as SkopeIngester gives it) or with more leading axes.
+
+        If a block holds several interleaves one after the other, each is fitted separately and the results have
+        shape (interleaves, channels)."""
+        raw = np.asarray(raw)
+        if interleaves > 1:
+            # (..., channels, interleaves, samples) -> (..., interleaves, channels, samples)
+            raw = raw.reshape(raw.shape[:-1] + (interleaves, -1))
+            raw = np.swapaxes(raw, -3, -2)
+
+        window = raw[..., self.window]
+        if window.shape[-1] < self._weights.shape[0]:
+            raise ValueError(
+                f"Fit window needs {self._weights.shape[0]} samples, only {window.shape[-1]} were acquired."
+            )
+
+        slope, intercept = np.moveaxis(unwrapped_phase(window) @ self._weights, -1, 0)
+        frequency = slope / (2 * np.pi)
+        if self.offres_frequencies is not None:
+            frequency = frequency - self.offres_frequencies
+        field = 2 * np.pi * frequency / self.gamma
+        return FieldFit(frequency, field, intercept)
@@ -0,0 +1,79 @@
+import os
+
+import numpy as np
+
+from libraries.parrec import ParRec
+
+# how well shimming held the field through movement, across many sessions: shimming_comparison/compare_field_maps.m
+# for a study at once, see compare_field_maps.py.
+#
+# a session is a folder of three field maps (.PAR/.REC), named as compare_field_maps.m's variables:
+#   before_movement     the reference, whose magnitude makes the mask.
+#   without_shimming    after movement, unshimmed.
+#   with_shimming       after movement, shimmed.
+# each map after movement is compared by its difference from the reference over the mask. only the magnitude and
+# field volumes are read from the recs, and the statistics of every condition and slice come from whole array
+# operations, with no loop over voxels or slices.
+
+MAPS = ["before_movement", "without_shimming", "with_shimming"]
+CONDITIONS = ["unshimmed", "shimmed"]  # without_shimming and with_shimming.
+MASK_THRESHOLD = 0.04  # of the brightest voxel, as compare_field_maps.m.
+PERCENTILES = [5, 25, 50, 75, 95]
+
+
+def read_field_map(filename):
+    """The magnitude and field volumes of a field map, img(:, :, :, 1, 1) and img(:, :, :, 2, 2) in matlab."""
+    img = ParRec(filename).squeezed()
+    return img[:, :, :, 0, 0], img[:, :, :, 1, 1]
+
+
+def compare_session(folder, mask_threshold=MASK_THRESHOLD):
+    """Statistics of the field differences of one session, in the units of the field maps (Hz).
+
+    Returns a dict of per condition arrays (conditions first) and the differences themselves, zero outside the
+    mask, conditions x the volume's shape."""
+    magnitude, reference = read_field_map(os.path.join(folder, MAPS[0]))
+    mask = magnitude > mask_threshold * magnitude.max()
+    fields = np.stack(
+        [read_field_map(os.path.join(folder, name))[1] for name in MAPS[1:]]
+    )
+    if fields.shape[1:] != reference.shape:
+        raise ValueError(f"The field maps in {folder} aren't all the same shape.")
+    differences = np.where(mask, fields - reference, 0)
+
+    # over the whole mask. std with n - 1 as matlab's.
+    values = differences[:, mask]
+    count = values.shape[1]
+    mean = values.mean(axis=1)
+    statistics = {
+        "voxels": np.full(len(CONDITIONS), count),
+        "mean": mean,
+        "std": values.std(axis=1, ddof=1),
+        "rms": np.sqrt(np.mean(values**2, axis=1)),
+        "max_abs": np.abs(values).max(axis=1),
+        "percentiles": np.percentile(values, PERCENTILES, axis=1).T,
+    }
+
+    # per slice, conditions x slices, from masked sums. nan for slices with nothing in the mask.
+    slice_count = mask.sum(axis=(0, 1))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        slice_sum = differences.sum(axis=(1, 2))
+        slice_square = (differences**2).sum(axis=(1, 2))
+        slice_mean = slice_sum / slice_count
+        statistics["slice_voxels"] = slice_count
+        statistics["slice_mean"] = slice_mean
+        statistics["slice_rms"] = np.sqrt(slice_square / slice_count)
+        statistics["slice_std"] = np.sqrt(
+            np.maximum(slice_square - slice_count * slice_mean**2, 0)
+            / (slice_count - 1)
+        )
+    return statistics, differences
+
+
+def compare_task(folder):
+    """For a process pool: folder -> (folder, statistics, differences, error), error a string if it failed."""
+    try:
+        statistics, differences = compare_session(folder)
+    except (OSError, ValueError, IndexError) as e:
+        return folder, None, None, f"{type(e).__name__}: {e}"
+    return folder, statistics, differences, None
@@ -0,0 +1,348 @@
+import collections
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+import zlib
+
+import libraries.payloads as payloads
+
+# sending files between clients through the server, e.g. the field and coil maps from the scanner computer to
+# wherever matlab runs, with the !send_file command.
+#
+#   sender  offer (name, size, sha256)  ->  receiver
+#   sender  <-  resume (how much it already has)
+#   sender  chunk, chunk, ... done  ->
+#   sender  <-  ack (whether the sha256 matched)
+#
+# chunks are only sent when the connection is idle, one at a time, so a frame of currents waits behind at most one
+# chunk (64 kB). the server services file frames after everything else too, see libraries/traffic.py.
+# uncompressed chunks go from the file to the socket with sendfile where there is one, so the sender never copies
+# them. with compression each chunk is zlib'd at the fastest level, which is worth it for maps full of zeros.
+#
+# the receiver writes to name.part, with what it will be (size and sha256) in name.part.json. if the transfer is
+# broken off, offering the same file again carries on from the end of the .part file.
+
+CHUNK_SIZE = 1 << 16
+RECEIVE_FOLDER = "./data"
+
+
+class TransferError(Exception):
+    """Raised when a transfer can't carry on, it is cancelled at both ends."""
+
+    pass
+
+
+class _Outgoing:
+    """A file we are sending. Its sha256 is worked out on a thread, it is offered once that's done."""
+
+    def __init__(self, transfer_id, to, path, compress):
+        self.id = transfer_id
+        self.to = to
+        self.path = path
+        self.name = os.path.basename(path)
+        self.compress = compress
+        self.file = open(path, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.sha256 = None
+        self.offered = False
+        self.offset = None  # where to send from next, once the receiver has said.
+        self.finished = False
+        self.started = None
+
+        threading.Thread(
+            target=self._hash, name=f"hash {self.name}", daemon=True
+        ).start()
+
+    def _hash(self):
+        digest = hashlib.sha256()
+        with open(self.path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        self.sha256 = digest.hexdigest()
+
+    def close(self):
+        self.file.close()
+
+
+class _Incoming:
+    """A file we are receiving, into a .part file until it has all arrived and been checked."""
+
+    def __init__(self, meta, sender, folder):
+        self.id = meta["id"]
+        self.sender = sender
+        self.name = os.path.basename(meta["name"])  # never anywhere but the folder.
+        self.size = meta["size"]
+        self.sha256 = meta["sha256"]
+        self.path = os.path.join(folder, self.name)
+        self.part_path = self.path + ".part"
+        self.info_path = self.part_path + ".json"
+        self.digest = hashlib.sha256()
+        self.started = time.monotonic()
+
+        info = {"size": self.size, "sha256": self.sha256}
+        if self._read_info() == info and os.path.exists(self.part_path):
+            # the same file as a transfer which was broken off, carry on from where it got to.
+            self.file = open(self.part_path, "r+b")
+            for block in iter(lambda: self.file.read(1 << 20), b""):
+                self.digest.update(block)
+            self.received = self.file.tell()
+        else:
+            os.makedirs(folder, exist_ok=True)
+            self.file = open(self.part_path, "wb")
+            with open(self.info_path, "w", encoding="utf-8") as f:
+                json.dump(info, f)
+            self.received = 0
+
+    def _read_info(self):
+        try:
+            with open(self.info_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write(self, offset, data):
+        if offset != self.received:
+            raise TransferError(
+                f"Chunk of {self.name} at {offset} bytes, expected {self.received}."
+            )
+        self.file.write(data)
+        self.digest.update(data)
+        self.received += len(data)
+
+    def finish(self):
+        """Keep the file if it all arrived and its sha256 matches. Returns whether it did."""
+        self.file.close()
+        kept = self.received == self.size and self.digest.hexdigest() == self.sha256
+        if kept:
+            os.replace(self.part_path, self.path)
+        else:
+            os.remove(self.part_path)  # start from scratch next time.
+        os.remove(self.info_path)
+        return kept
+
+    def close(self):
+        """Stop for now, keeping the .part file to resume from."""
+        self.file.close()
+
+
+class FileTransfers:
+    """A client's file transfers, both ways.
+
+    Handles the client's "file" payloads, and sends its next frame from pump(), which the client's main loop calls."""
+
+    def __init__(self, client, folder=RECEIVE_FOLDER, chunk_size=CHUNK_SIZE):
+        self.client = client
+        self.folder = folder
+        self.chunk_size = chunk_size
+        self.outgoing = {}
+        self.incoming = {}
+        # (to, meta) of our answers as the receiving end, sent before any chunks.
+        self._replies = collections.deque()
+        client.payload_handlers["file"] = self.handle
+
+    def send(self, to, path, compress=False):
+        transfer = _Outgoing(uuid.uuid4().hex[:12], to, path, compress)
+        self.outgoing[transfer.id] = transfer
+        return transfer
+
+    def busy(self):
+        return bool(self._replies or self.outgoing)
+
+    def pump(self):
+        """Send the next frame of any transfer, if the connection is idle."""
+        try:
+            message = self.client.selector.get_key(self.client.socket).data
+        except (AttributeError, KeyError, ValueError):
+            return  # not connected.
+        if not message.is_idle():
+            return
+
+        request = self._next_request()
+        if request is not None:
+            self.client.send_request(request)
+
+    def _next_request(self):
+        if self._replies:
+            return self._request(*self._replies.popleft())
+
+        for transfer in self.outgoing.values():
+            if not transfer.offered:
+                if transfer.sha256 is None:
+                    continue  # still hashing.
+                transfer.offered = True
+                meta = {
+                    "op": "offer",
+                    "id": transfer.id,
+                    "name": transfer.name,
+                    "size": transfer.size,
+                    "sha256": transfer.sha256,
+                }
+                return self._request(transfer.to, meta)
+            if transfer.offset is None or transfer.finished:
+                continue  # waiting to hear back.
+            if transfer.offset < transfer.size:
+                return self._chunk(transfer)
+            transfer.finished = True
+            return self._request(transfer.to, {"op": "done", "id": transfer.id})
+        return None
+
+    def _chunk(self, transfer):
+        offset = transfer.offset
+        count = min(self.chunk_size, transfer.size - offset)
+        transfer.offset += count
+        meta = {"op": "chunk", "id": transfer.id, "offset": offset, "length": count}
+        file_range = (transfer.file.fileno(), offset, count)
+
+        if transfer.compress:
+            data = payloads.read_range(*file_range)
+            compressed = zlib.compress(data, 1)
+            if len(compressed) < count:
+                meta["compressed"] = True
+                return self._request(transfer.to, meta, body=compressed)
+            return self._request(transfer.to, meta, body=data)
+        return self._request(transfer.to, meta, file_range=file_range)
+
+    def _request(self, to, meta, body=b"", file_range=None):
+        content = {
+            "to": to,
+            "from": self.client.name,
+            "meta": meta,
+            "body": body,
+            "file_range": file_range,
+        }
+        return dict(type="file", content=content)
+
+    def handle(self, meta, body, sender):
+        """Called by the client with each "file" payload."""
+        op = meta.get("op")
+        try:
+            if op == "offer":
+                self._offered(meta, sender)
+            elif op == "resume":
+                self._resume(meta)
+            elif op == "chunk":
+                self._chunk_arrived(meta, body)
+            elif op == "done":
+                self._done(meta)
+            elif op == "ack":
+                self._acknowledged(meta)
+            elif op == "cancel":
+                self._drop(meta["id"])
+                print(f"File transfer cancelled by {sender}: {meta.get('reason')}")
+            else:
+                self.client.logger.warning(f"Unknown file transfer op {op!r}.")
+        except KeyError:
+            # e.g. we restarted part way through, the other end needs to offer it again.
+            self._cancel(meta.get("id"), sender, "Unknown transfer.")
+        except (OSError, TransferError, zlib.error) as e:
+            print(f"File transfer failed: {e}")
+            self._cancel(meta.get("id"), sender, str(e))
+
+    def _offered(self, meta, sender):
+        if meta["id"] in self.incoming:
+            return
+        # offered again after a broken transfer, under a new id. the old one's file is closed first, so all it got
+        # is in the .part file before we resume from it.
+        name = os.path.basename(meta["name"])
+        for stale in list(self.incoming.values()):
+            if stale.name == name and stale.sender == sender:
+                self._drop(stale.id)
+        transfer = _Incoming(meta, sender, self.folder)
+        self.incoming[transfer.id] = transfer
+        if transfer.received:
+            print(
+                f"Resuming {transfer.name} from {sender} at {transfer.received} of {transfer.size} bytes."
+            )
+        else:
+            print(f"Receiving {transfer.name} ({transfer.size} bytes) from {sender}.")
+        self._replies.append(
+            (sender, {"op": "resume", "id": transfer.id, "offset": transfer.received})
+        )
+
+    def _resume(self, meta):
+        transfer = self.outgoing[meta["id"]]
+        transfer.offset = meta["offset"]
+        transfer.started = time.monotonic()
+        if transfer.offset:
+            print(
+                f"{transfer.to} already has {transfer.offset} bytes of {transfer.name}."
+            )
+
+    def _chunk_arrived(self, meta, body):
+        transfer = self.incoming[meta["id"]]
+        data = zlib.decompress(body) if meta.get("compressed") else body
+        if len(data) != meta["length"]:
+            raise TransferError(f"Chunk of {transfer.name} is the wrong length.")
+        transfer.write(meta["offset"], data)
+
+    def _done(self, meta):
+        transfer = self.incoming.pop(meta["id"])
+        kept = transfer.finish()
+        if kept:
+            print(
+                f"Received {transfer.name} from {transfer.sender}, saved as {transfer.path}"
+                f" ({_rate(transfer.size, transfer.started)})."
+            )
+        else:
+            print(
+                f"{transfer.name} from {transfer.sender} failed its checksum, not kept."
+            )
+        self._replies.append(
+            (transfer.sender, {"op": "ack", "id": transfer.id, "ok": kept})
+        )
+
+    def _acknowledged(self, meta):
+        transfer = self.outgoing.pop(meta["id"])
+        transfer.close()
+        if meta["ok"]:
+            print(
+                f"Sent {transfer.name} to {transfer.to} ({_rate(transfer.size, transfer.started)})."
+            )
+        else:
+            print(f"{transfer.name} arrived at {transfer.to} corrupted, send it again.")
+
+    def _cancel(self, transfer_id, sender, reason):
+        self._drop(transfer_id)
+        self._replies.append(
+            (sender, {"op": "cancel", "id": transfer_id, "reason": reason})
+        )
+
+    def _drop(self, transfer_id):
+        transfer = self.outgoing.pop(transfer_id, None) or self.incoming.pop(
+            transfer_id, None
+        )
+        if transfer is not None:
+            transfer.close()
+
+    def print_transfers(self):
+        if not (self.outgoing or self.incoming):
+            print("No file transfers.")
+        for transfer in self.outgoing.values():
+            if transfer.sha256 is None:
+                progress = "working out its checksum"
+            elif transfer.offset is None:
+                progress = "waiting for an answer"
+            else:
+                progress = f"{transfer.offset} of {transfer.size} bytes"
+            print(f"Sending {transfer.name} to {transfer.to}: {progress}")
+        for transfer in self.incoming.values():
+            print(
+                f"Receiving {transfer.name} from {transfer.sender}: {transfer.received} of {transfer.size} bytes"
+            )
+
+    def close(self):
+        """Close every file, keeping partly received ones to resume."""
+        for transfer in list(self.outgoing.values()) + list(self.incoming.values()):
+            transfer.close()
+        self.outgoing.clear()
+        self.incoming.clear()
+
+
+def _rate(size, started):
+    seconds = max(time.monotonic() - started, 1e-6) if started is not None else None
+    if seconds is None:
+        return f"{size} bytes"
+    return f"{size} bytes in {seconds:.2f} s, {size / seconds / 1e6:.1f} MB/s"
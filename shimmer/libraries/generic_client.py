@@ -1,17 +1,27 @@
 import selectors
 import logging
-import socket
 import sys
+import time
 import traceback
+import zlib
 from libraries.registry import registry, get_address
+import libraries.transport as transport
+from libraries.array_payloads import array_from_payload
 from libraries.client_packets import Message
-from libraries.parser import parse
+from libraries.clock import ClockEstimator
+from libraries.commands import CommandTable, CommandError, tokenize
+from libraries.file_transfer import FileTransfers
+from libraries.metrics import MetricsRegistry
+from libraries.profiling import StageProfiler
 from libraries.printers import selector_printer
 
 
 class Client:
     """Represents a generic client object, having a socket, current packet and internal id associated with it."""
 
+    # relayed commands which aren't echoed when they arrive, e.g. frequent status updates.
+    quiet_commands = frozenset()
+
     def __init__(self, name):
         self.name = name  # the role name for this client generic client object.
         self.selector = selectors.DefaultSelector()
@@ -36,15 +46,88 @@ class Client:
             self.stdout_handler.setLevel(logging.DEBUG)
             print("Debugging mode enabled.")
 
-    def start_connection(self):
-        """Try and make a connection to the server, add this socket to the selector."""
+        # client commands (without their !), looked up by name. child classes register their own.
+        self.commands = CommandTable()
+        self.commands.register("echo", self.echo, rest=str)
+        self.commands.register("server_disconnect", self.server_disconnect)
+        self.commands.register("debug", self.toggle_debugging)
+        self.commands.register("stats", self.print_stats)
+        self.commands.register("clock", self.print_clock)
+        self.commands.register(
+            "profile",
+            self.profile,
+            arguments=(float,),
+            rest=str,
+            usage="!profile <seconds> [full]",
+        )
+        self.commands.register(
+            "send_file",
+            self.send_file,
+            arguments=(str, str),
+            rest=str,
+            usage="!send_file <client name> <path> [compress]",
+        )
+        self.commands.register("transfers", self.print_transfers)
+        self.commands.register("arrays", self.print_arrays)
+
+        # kept up to date as we run, see the !stats command.
+        self.metrics = MetricsRegistry(f"shimmer_{self.name}")
+        self.frames_in = self.metrics.counter(
+            "frames_in_total", "Frames received from the server."
+        )
+        self.frames_out = self.metrics.counter(
+            "frames_out_total", "Frames sent to the server."
+        )
+        self.bytes_in = self.metrics.counter(
+            "bytes_in_total", "Bytes received from the server."
+        )
+        self.bytes_out = self.metrics.counter(
+            "bytes_out_total", "Bytes sent to the server."
+        )
+        self.loop_time = self.metrics.histogram(
+            "loop_seconds", "Time spent in main loops which had something to do."
+        )
+
+        self.clock_offset = self.metrics.gauge(
+            "clock_offset_seconds", "How far the server's clock is ahead of ours."
+        )
+        self.clock_uncertainty = self.metrics.gauge(
+            "clock_uncertainty_seconds", "How far out the clock offset could be."
+        )
+        self.one_way_latency = self.metrics.histogram(
+            "one_way_latency_seconds",
+            "From the server sending a frame to it arriving, once our clocks are synchronised.",
+        )
+        self.last_latency = None  # of the last frame, for status displays.
+
+        # how the server's clock compares to ours, measured every clock_sync_interval seconds. 0 turns it off.
+        self.clock = ClockEstimator()
+        self.clock_sync_interval = registry["server"].getfloat(
+            "clock_sync_interval", fallback=10.0
+        )
+        self._next_clock_sync = 0
+
+        # per stage timers, off until the !profile command.
+        self.profiler = StageProfiler(self.name, self.logger)
+
+        # binary payloads from other clients, by content type, see libraries/payloads.py.
+        # each handler is called with the payload's meta, a memoryview of its body and who sent it.
+        self.payload_handlers = {}
+        # files to and from other clients, sent a chunk at a time whenever we have nothing else to send.
+        self.transfers = FileTransfers(self)
+        # numpy arrays from other clients, the last one of each name, see libraries/array_payloads.py.
+        self.payload_handlers["ndarray"] = self._array_arrived
+        self.arrays = {}
+
+    def start_connection(self, sock=None):
+        """Try and make a connection to the server, add this socket to the selector.
+
+        sock is an already open connection, e.g. from ShimmingServer.connect_inprocess(). Otherwise one is opened."""
         print(f"Starting connection to {self.server_address}")
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # SO_REUSEADDR avoids bind() exception: OSError: [Errno 48] Address already in use
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.socket.bind(self.my_address)
-        self.socket.setblocking(False)
-        self.socket.connect_ex(self.server_address)
+        if sock is None:
+            # over a unix socket if we are on the same computer as the server and it allows it, tcp otherwise.
+            sock = transport.connect(self.name)
+        self.socket = sock
 
         events = selectors.EVENT_WRITE
         # add this socket to the register if successful
@@ -91,11 +174,23 @@ class Client:
 
         return mask
 
-    def main_loop(self):
+    def main_loop(self, timeout=0):
+        if self.clock_sync_interval and time.monotonic() >= self._next_clock_sync:
+            self.sync_clock()
+        if self.transfers.busy():
+            self.transfers.pump()
+
         events = self.selector.select(
-            timeout=0
+            timeout=timeout
         )  # get waiting io events. timeout = 0 to wait without blocking.
 
+        if self.profiler.active:
+            self.profiler.check()
+
+        if not events:
+            return
+
+        loop_start = time.perf_counter()
         if self.debugging:
             selector_printer(self.selector, events)
 
@@ -110,7 +205,13 @@ class Client:
                 )
                 message.close()
 
+        loop_time = time.perf_counter() - loop_start
+        self.loop_time.observe(loop_time)
+        if self.profiler.active:
+            self.profiler.record("loop_work", loop_time)
+
     def close(self):
+        self.transfers.close()
         try:
             message = self.selector.get_key(self.socket).data
             message.close()
@@ -120,33 +221,124 @@ class Client:
             self.selector.close()
             print(f"Closed {self.name} client. Goodbye \\o")
 
-    def handle_command(self, command_string):
-        """Should be overridden by child class.
+    def handle_command(self, command_tokens):
+        """Look up a command and call it. Child classes add commands to self.commands rather than override this.
 
-        Leading exclamation mark is removed in packet code, before calling."""
-        if not command_string:
+        Leading exclamation mark is removed in packet code, before calling. A string is parsed into tokens first."""
+        command_tokens = tokenize(command_tokens)
+        if not command_tokens:
             return
 
-        self.logger.info(f"Client {self.name} is handling command: {command_string}")
-        command_tokens = parse(command_string)
+        self.logger.info(f"Client {self.name} is handling command: {command_tokens}")
+        try:
+            if not self.commands.dispatch(command_tokens):
+                self.logger.info(
+                    f"Client {self.name} has no command {command_tokens[0]}"
+                )
+        except CommandError as e:
+            print(e)
+
+    def echo(self, *words):
+        print(f"{' '.join(words)}")
+
+    def server_disconnect(self):
+        self.logger.info("Recieved disconnect command from server.")
+        print("Recieved disconnect instruction from the server.")
+        self.running = False
+
+    def sync_clock(self):
+        """Ping the server for the time, if we aren't busy. The pong goes to clock_pong()."""
         try:
-            if command_tokens[0] == "echo":
-                print(f"{' '.join(command_tokens[1:])}")
-            elif command_tokens[0] == "server_disconnect":
-                self.logger.info("Recieved disconnect command from server.")
-                print("Recieved disconnect instruction from the server.")
-                self.running = False
-            elif command_tokens[0] == "debug":
-                self.debugging = not self.debugging
-
-                if self.debugging:
-                    print("Debugging mode enabled.")
-                    self.stdout_handler.setLevel(logging.DEBUG)
-                else:
-                    print("Debugging mode disabled.")
-                    self.stdout_handler.setLevel(logging.WARNING)
-
-        except IndexError:
-            print(
-                f"Incorrect number of arguments for command {command_tokens[0]}. Look up correct usage in manual."
+            message = self.selector.get_key(self.socket).data
+        except (KeyError, ValueError):
+            return  # not connected.
+
+        # a server which doesn't speak version 2 won't know what a clock frame is.
+        if message.protocol_version < 2 or not message.is_idle():
+            return  # try again next loop.
+
+        ping = self.clock.as_dict()
+        ping["t0"] = time.time()
+        self.send_request(dict(type="clock", content=ping))
+        self._next_clock_sync = time.monotonic() + self.clock_sync_interval
+
+    def clock_pong(self, pong):
+        self.clock.add_exchange(pong["t0"], pong["t1"], pong["t2"], time.time())
+        self.clock_offset.set(self.clock.offset)
+        self.clock_uncertainty.set(self.clock.uncertainty)
+        self.logger.debug(
+            f"Server clock is {self.clock.offset:+.6f} +/- {self.clock.uncertainty:.6f} s ahead."
+        )
+
+    def observe_frame_latency(self, sent):
+        """Called by the packet with the server's send time from a version 2 header."""
+        if self.clock.offset is None:
+            return
+        self.last_latency = max(self.clock.server_time() - sent, 0.0)
+        self.one_way_latency.observe(self.last_latency)
+
+    def handle_payload(self, content_type, meta, body, sender):
+        """Called by the packet with each binary payload, which goes to the handler for its content type."""
+        handler = self.payload_handlers.get(content_type)
+        if handler is None:
+            self.logger.warning(
+                f"No handler for {content_type} from {sender}, dropped."
             )
+            return
+        handler(meta, body, sender)
+
+    def _array_arrived(self, meta, body, sender):
+        try:
+            array = array_from_payload(meta, body)
+        except (KeyError, TypeError, ValueError, zlib.error) as e:
+            self.logger.warning(f"Bad array from {sender}: {e}")
+            return
+        self.arrays[meta["name"]] = array
+        self.array_received(meta["name"], array, sender)
+
+    def array_received(self, name, array, sender):
+        """Called with each array another client sends us, as a read only view. Child classes do something with it."""
+        self.logger.info(
+            f"Received array {name} {array.dtype}{array.shape} from {sender}."
+        )
+
+    def print_arrays(self):
+        if not self.arrays:
+            print("No arrays received.")
+        for name, array in self.arrays.items():
+            print(f"{name}: {array.dtype}{array.shape}")
+
+    def send_file(self, to, path, *options):
+        try:
+            self.transfers.send(to, path, compress="compress" in options)
+        except OSError as e:
+            print(f"Can't send {path}: {e}")
+
+    def print_transfers(self):
+        self.transfers.print_transfers()
+
+    def print_clock(self):
+        if self.clock.offset is None:
+            print("Not synchronised with the server's clock yet.")
+            return
+        print(
+            f"Server clock is {self.clock.offset * 1e3:+.3f} ms"
+            f" +/- {self.clock.uncertainty * 1e3:.3f} ms ahead of ours,"
+            f" drifting {self.clock.drift * 1e6:+.2f} ppm"
+        )
+
+    def print_stats(self):
+        print(self.metrics.summary())
+
+    def profile(self, seconds, *mode):
+        self.profiler.start(seconds, full="full" in mode)
+
+    def toggle_debugging(self):
+        self.debugging = not self.debugging
+
+        if self.debugging:
+            print("Debugging mode enabled.")
+            self.stdout_handler.setLevel(logging.DEBUG)
+        else:
+            print("Debugging mode disabled.")
+            self.stdout_handler.setLevel(logging.WARNING)
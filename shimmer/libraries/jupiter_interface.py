@@ -29,6 +29,14 @@ def start_connection():
     return channel_number
 
 
+def read_temperatures():
+    """Amplifier circuit temperatures in 'C, one per channel."""
+    channel_number = mrshim.shim_num_channels()
+    temp = mrshim.ShimGetAttr(6)
+    # NOTE: conversion is from arbitrary units, provided by Paul at MRShim
+    return [((temp[i] * 0.8 - 400) / 19.5) for i in range(channel_number)]
+
+
 def display_status():
     """Print some status information about Jupiter/shimming.
 
@@ -38,9 +46,7 @@ def display_status():
     channel_number = mrshim.shim_num_channels()
 
     # print temperatures
-    temp = mrshim.ShimGetAttr(6)
-    # NOTE: conversion is from arbitrary units, provided by Paul at MRShim
-    temperatures = [((temp[i] * 0.8 - 400) / 19.5) for i in range(channel_number)]
+    temperatures = read_temperatures()
     temperatures_string = " ".join(["{:.1f}".format(temp) for temp in temperatures])
     print(f"Amplifier circuit temperatures are ['C]: {temperatures_string}")
 
@@ -57,10 +63,11 @@ def display_status():
         )
 
 
-def set_shim_currents(currents):
+def set_shim_currents(currents, verbose=True):
     """Apply shim currents.
 
     Enable should be called first, otherwise this will do nothing. Currents should be a list of 24 milliamp currents.
+    verbose=False doesn't print them, for frequent updates.
     """
     channel_number = mrshim.shim_num_channels()
 
@@ -75,7 +82,8 @@ def set_shim_currents(currents):
     ctype_currents = (ctypes.c_int32 * channel_number)(*currents)
     current_pointer = ctypes.cast(ctype_currents, ctypes.POINTER(ctypes.c_int32))
     mrshim.ShimSetCurr(current_pointer, channel_number, False)
-    print(f"Shims set: {currents}")
+    if verbose:
+        print(f"Shims set: {currents}")
 
 
 def enable_shims():
@@ -1,10 +1,26 @@
+import queue
 import selectors
 import sys
+import threading
+import time
+
+import numpy as np
 
 import libraries.parser as parser
+from libraries.array_payloads import array_request
 from libraries.generic_client import Client
+import libraries.transport as transport
 from libraries.client_packets import Message
+from libraries.current_solver import CurrentSolver
+from libraries.field_filter import FieldPredictor
+from libraries.field_fit import GAMMA_1H
 from libraries.printers import selector_printer
+from libraries.skope import RateController
+from libraries.spherical_harmonics import HarmonicBasis
+
+# matlab only calls into python when it wants something, so the socket is looked after by a thread of our own.
+# send_currents() and send_command() just queue their request and return, so the scan loop's time goes on acquiring
+# and solving. the thread sends the queue one request at a time, in order, and flush() waits until it has.
 
 
 class MatlabClient(Client):
@@ -13,28 +29,189 @@ class MatlabClient(Client):
     def __init__(self, name):
         name = "matlab"
         super().__init__(name)
+        # times each frame, to pick the dynamicTR for the next scan.
+        self.rate = RateController()
+        # mrshim's measure of getting and applying the currents, for the rate.
+        self.commands.register(
+            "apply_time",
+            self.rate.observe_apply,
+            arguments=(float,),
+            usage="apply_time <seconds>",
+        )
+        self.basis = None
+        self.solver = None
+        self.predictor = None
+        self.frame_arrived = None
+
+        # requests waiting for the i/o thread, and how many have been queued and sent, for flush().
+        self._outbox = queue.Queue()
+        self._sent = threading.Condition()
+        self._queued_count = 0
+        self._sent_count = 0
+        self._io_thread = None
+        # made now, so requests can be queued before start_connection(). the i/o thread sends them once it starts.
+        self._wakeup = transport.Wakeup(self.selector)
+
+    def start_connection(self, sock=None):
+        """Called by matlab. Connect, then hand the socket to the i/o thread."""
+        super().start_connection(sock)
+        self._io_thread = threading.Thread(
+            target=self._io_loop, name="matlab-io", daemon=True
+        )
+        self._io_thread.start()
 
     def close(self):
+        if self._io_thread is not None:
+            if not self.flush(timeout=1.0):
+                print("Closing with requests still unsent.")
+            self.running = False
+            self._wakeup.wake()
+            self._io_thread.join()
+        self._wakeup.close()
         super().close()
         sys.exit(0)
 
+    def send(self, request):
+        """Queue a request for the i/o thread, without waiting for it to be sent."""
+        with self._sent:
+            self._queued_count += 1
+        self._outbox.put(request)
+        self._wakeup.wake()
+
+    def flush(self, timeout=1.0):
+        """Called by matlab. Wait until everything queued so far has been sent. Returns False if it took too long."""
+        with self._sent:
+            target = self._queued_count
+            self._sent.wait_for(
+                lambda: self._sent_count >= target or not self.running,
+                timeout=float(timeout),
+            )
+            return self._sent_count >= target
+
+    def _io_loop(self):
+        """Send the queued requests one after another, and read whatever the server sends us."""
+        message = self.selector.get_key(self.socket).data
+        in_flight = False
+        while self.running:
+            if message.is_idle():
+                if in_flight:
+                    in_flight = False
+                    with self._sent:
+                        self._sent_count += 1
+                        self._sent.notify_all()
+                try:
+                    self.send_request(self._outbox.get_nowait())
+                    in_flight = True
+                except queue.Empty:
+                    pass
+            # wait for the socket or a new request, rather than spin. still wake up now and then for clock syncs.
+            self.main_loop(timeout=0.1)
+
+        with self._sent:
+            self._sent.notify_all()  # nothing more is going to be sent.
+
+    def harmonic_basis(self, path, voxels, probes, order):
+        """Called by matlab. The spherical harmonics at the voxels and probes, from path if they were saved there."""
+        self.basis = HarmonicBasis.cached(
+            path, np.asarray(voxels), np.asarray(probes), int(order)
+        )
+        return self.basis
+
+    def set_up_solver(
+        self, coil_coefficients, channel_limit=2000.0, rms_limit=2000.0, path=None
+    ):
+        """Called by matlab with the currents which make each harmonic, once they are calculated.
+
+        If path is given the solver is saved there too, for pipeline_client.py."""
+        self.solver = CurrentSolver.from_coil_coefficients(
+            np.asarray(coil_coefficients),
+            channel_limit=float(channel_limit),
+            rms_limit=float(rms_limit),
+        )
+        if path is not None:
+            self.solver.save(str(path))
+
+    def set_up_predictor(self, model="velocity", breathing_period=4.0):
+        """Called by matlab. Filter the field and shim for where it will be by the time the currents are applied."""
+        self.predictor = FieldPredictor(
+            self.basis.probes.shape[0],
+            model=model,
+            breathing_period=float(breathing_period),
+        )
+
+    def _predicted_field(self, field_in_hertz):
+        """The field the probes will see once this frame's currents are on, as near as we can tell."""
+        arrived = self.frame_arrived
+        if arrived is None:
+            arrived = time.perf_counter()
+        self.predictor.update(field_in_hertz, arrived)
+
+        latency = self.rate.pipeline_time(percentile=50)
+        if latency is None:
+            return self.predictor.filtered()  # nothing measured yet, just denoise.
+        return self.predictor.predict(latency)
+
+    def solve_currents(self, data):
+        """Called by matlab. The currents in mA to cancel the field the probes measured, within the amplifier limits.
+
+        data is probes x samples of field (bfit), like calculate_currents.m takes."""
+        data = np.asarray(data, dtype=np.float64)
+        average_field = data.mean(axis=1) if data.ndim > 1 else data
+        field_in_hertz = average_field * GAMMA_1H / (2 * np.pi)
+        if self.predictor is not None:
+            field_in_hertz = self._predicted_field(field_in_hertz)
+
+        result = self.solver.solve(self.basis.coefficients(field_in_hertz))
+        if result.limited:
+            print(
+                "Currents are at the amplifier limits, the field is only partly cancelled."
+            )
+        return np.rint(result.currents)
+
+    def frame_started(self):
+        """Called by matlab when a block of field data arrives."""
+        self.rate.start_frame()
+        self.frame_arrived = time.perf_counter()
+
+    def frame_finished(self):
+        """Called by matlab once that block's currents are queued to send."""
+        self.rate.end_frame()
+
+    def recommended_dynamic_tr(self, fallback=0.5):
+        """Called by matlab. The shortest dynamicTR we have been keeping up with, for the next scan."""
+        return self.rate.dynamic_tr(fallback)
+
+    def load_rate(self, path):
+        """Called by matlab before a scan, with where save_rate() put the last scan's frame times."""
+        if self.rate.load(str(path)):
+            print(
+                f"Frame times from the last scan give a dynamicTR of {self.rate.dynamic_tr()} s."
+            )
+        else:
+            print("No frame times from a previous scan, the dynamicTR is the fallback.")
+
+    def save_rate(self, path):
+        """Called by matlab after a scan, so the next one can pick its dynamicTR."""
+        self.rate.save(str(path))
+
     def send_currents(self, currents):
-        """Called by matlab. Sends a current."""
+        """Called by matlab. Queues currents to be sent, see flush()."""
 
         if isinstance(currents, int):
             currents = [currents]
         else:
             currents = currents.tolist()
 
-        currents_string = " ".join([str(_) for _ in currents])
-        print(f"Sending currents: {currents_string}")
+        current_tokens = [str(_) for _ in currents]
+        print(f"Sending currents: {' '.join(current_tokens)}")
 
         # mismatch in dictionary forms because
         # we want to use the python keyword 'from' as a key.
+        # sent already split into tokens, so nobody has to parse it.
         value = {
             "to": "mrshim",
             "from": "matlab",
-            "content": f"!shim {currents_string}",
+            "content": ["!shim"] + current_tokens,
         }
 
         request = dict(
@@ -43,12 +220,29 @@ class MatlabClient(Client):
             content=value,
         )
 
-        self.send_request(request)
-        self.main_loop()
+        self.send(request)
+
+    def send_array(self, to, name, array, compress=False):
+        """Called by matlab. Queues an array (e.g. the probe fields) for another client, which gets it as a numpy
+        array called name."""
+        self.send(array_request(np.array(array), to, self.name, name, compress))
+
+    def send_shim_table(self, table, compress=False):
+        """Called by matlab. Uploads a table of currents (entries x channels, mA) to mrshim, to pick from with
+        select_shims()."""
+        self.send_array("mrshim", "shim_table", table, compress)
 
+    def select_shims(self, index):
+        """Called by matlab. Tells mrshim to apply an entry of its shim table, which is all that is sent."""
+        value = {
+            "to": "mrshim",
+            "from": "matlab",
+            "content": ["!select", str(int(index))],
+        }
+        self.send(dict(type="relay", encoding="utf-8", content=value))
 
-    def send_currents(self, command):
-        """Called by matlab. Sends an arbitrary command command."""
+    def send_command(self, command):
+        """Called by matlab. Sends an arbitrary command to mrshim."""
 
         command = str(command)
 
@@ -66,5 +260,4 @@ class MatlabClient(Client):
             content=value,
         )
 
-        self.send_request(request)
-        self.main_loop()
+        self.send(request)
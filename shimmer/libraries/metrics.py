@@ -0,0 +1,278 @@
+import bisect
+import math
+import selectors
+import socket
+import time
+
+import libraries.traffic as traffic
+
+# counters, gauges and histograms which are kept up to date as the server and clients run.
+# they can be printed with the stats command, or scraped in the prometheus text format from the metrics endpoint.
+
+# seconds, for latencies and loop times. from 50us to 1s.
+DEFAULT_BUCKETS = (
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+)
+
+
+def _format_value(value):
+    """A sample's value in full, counts as integers, as :g would round big counters and they would stop going up."""
+    if isinstance(value, int):
+        return str(value)
+    value = float(value)
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+
+def _format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    """Something we measure, with a value for each combination of its labels."""
+
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.label_names)
+
+    def samples(self):
+        """Get (name, label string, value) for every value we have."""
+        for label_values, value in sorted(self.values.items()):
+            yield self.name, _format_labels(self.label_names, label_values), value
+
+    def exposition(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{labels} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    """A count which only goes up, e.g. frames sent."""
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value which goes up and down, e.g. a queue depth."""
+
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    """Counts of observations falling into buckets, e.g. relay latencies."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        if key not in self.values:
+            # per bucket counts (the last is +Inf), sum, count
+            self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        counts, _, _ = histogram = self.values[key]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    def samples(self):
+        for label_values, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                yield self.name + "_bucket", _format_labels(
+                    self.label_names, label_values, [("le", bound)]
+                ), cumulative
+            labels = _format_labels(self.label_names, label_values)
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, count
+
+
+class MetricsRegistry:
+    """All the metrics of one server or client."""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(f"{self.prefix}_{name}", help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._add(Gauge(f"{self.prefix}_{name}", help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(f"{self.prefix}_{name}", help, labels, buckets))
+
+    def exposition(self):
+        """Everything in the prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.exposition())
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """A shorter version for people, without the histogram buckets."""
+        lines = []
+        for metric in self.metrics:
+            for name, labels, value in metric.samples():
+                if not name.endswith("_bucket"):
+                    lines.append(f"{name}{labels} {value:g}")
+        return "\n".join(lines)
+
+
+class MetricsEndpoint:
+    """A tiny http server which answers any request with the metrics, for prometheus or curl to scrape.
+
+    It sits on the same selector as everything else, looking enough like a Message for the server's main loop, and
+    so does each scraper's connection: they are read and written as they are ready, never waited on, so a slow or
+    idle scraper can't hold up relays. It only listens on localhost."""
+
+    traffic_class = traffic.DIAGNOSTIC
+    request = None
+    # seconds a scraper has to send its request before it is dropped.
+    idle_timeout = 5.0
+
+    def __init__(self, selector, registry, port):
+        self.selector = selector
+        self.registry = registry
+        self.addr = ("127.0.0.1", port)
+        self.scrapes = set()
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(self.addr)
+        self.sock.listen()
+        self.sock.setblocking(False)
+        self.selector.register(self.sock, selectors.EVENT_READ, data=self)
+
+    def process_events(self, mask):
+        """Accept a scraper."""
+        try:
+            conn, addr = self.sock.accept()
+        except BlockingIOError:
+            return  # they gave up before we got to them.
+        self.sweep()
+        self.scrapes.add(_Scrape(self, conn, addr))
+
+    def sweep(self):
+        """Drop any scrapers which have been connected too long without finishing. Called every server loop."""
+        now = time.monotonic()
+        for scrape in list(self.scrapes):
+            if now - scrape.opened >= self.idle_timeout:
+                scrape.close()
+
+    def time_left(self, timeout=None):
+        """Shorten a select timeout so we wake up when the oldest scraper has had its time."""
+        if not self.scrapes:
+            return timeout
+        oldest = min(scrape.opened for scrape in self.scrapes)
+        left = max(0, oldest + self.idle_timeout - time.monotonic())
+        if timeout is None:
+            return left
+        return min(timeout, left)
+
+    def response(self):
+        body = self.registry.exposition().encode("utf-8")
+        header = (
+            "HTTP/1.0 200 OK\r\n"
+            "Content-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n"
+        ).encode("utf-8")
+        return header + body
+
+    def close(self):
+        for scrape in list(self.scrapes):
+            scrape.close()
+        self.selector.unregister(self.sock)
+        self.sock.close()
+        self.sock = None
+
+
+class _Scrape:
+    """One scraper's connection: its request is read, then the metrics written, a piece at a time."""
+
+    traffic_class = traffic.DIAGNOSTIC
+    request = None
+
+    def __init__(self, endpoint, sock, addr):
+        self.endpoint = endpoint
+        self.sock = sock
+        self.addr = addr
+        self.opened = time.monotonic()
+        self._received = b""
+        self._response = None
+        self.sock.setblocking(False)
+        self.endpoint.selector.register(self.sock, selectors.EVENT_READ, data=self)
+
+    def process_events(self, mask):
+        try:
+            if mask & selectors.EVENT_READ and self._response is None:
+                data = self.sock.recv(4096)
+                if not data:
+                    self.close()
+                    return
+                # we don't need to look at the request, only wait for the end of it.
+                self._received += data
+                if b"\r\n\r\n" in self._received or b"\n\n" in self._received:
+                    self._response = memoryview(self.endpoint.response())
+                    self.endpoint.selector.modify(
+                        self.sock, selectors.EVENT_WRITE, data=self
+                    )
+            elif mask & selectors.EVENT_WRITE and self._response is not None:
+                sent = self.sock.send(self._response)
+                self._response = self._response[sent:]
+                if not self._response:
+                    self.close()
+        except BlockingIOError:
+            pass  # not ready after all, the selector will tell us again.
+        except OSError:
+            self.close()  # the scraper went away, it can try again.
+
+    def close(self):
+        if self.sock is None:
+            return
+        self.endpoint.scrapes.discard(self)
+        self.endpoint.selector.unregister(self.sock)
+        self.sock.close()
+        self.sock = None
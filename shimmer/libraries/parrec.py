@@ -0,0 +1,219 @@
+import os
+
+import numpy as np
+
+# reading philips par/rec field maps (export tool V4, V4.1 and V4.2) without loading the whole rec, the python side
+# of libraries/methods/rec_read_sjm.m.
+#
+# the par is parsed once, the rec is memory mapped, and indexing a view reads and rescales only the images it needs:
+#   rec = ParRec("data/field_map")
+#   img = rec.squeezed()             # as rec_read_sjm returns it, but nothing read yet.
+#   magnitude = img[:, :, :, 0, 0]   # img(:, :, :, 1, 1) in matlab_client.m, only those images are read.
+#
+# the full image has the same axes as rec_read_sjm's before it squeezes it:
+#   x, y, echo, slice, phase, type, seq, dynamic, gradient orientation, b value number, label
+# images missing from the rec are zeros there too.
+
+# label axes, and their columns in the par's image lines (from 0).
+LABELS = [
+    "echo",
+    "slice",
+    "phase",
+    "type",
+    "seq",
+    "dynamic",
+    "gradient",
+    "b_value",
+    "label",
+]
+_LABEL_COLUMNS = {
+    "slice": 0,
+    "echo": 1,
+    "dynamic": 2,
+    "phase": 3,
+    "type": 4,
+    "seq": 5,
+    "b_value": 41,  # V4.1 on.
+    "gradient": 42,  # V4.1 on.
+    "label": 48,  # V4.2 only.
+}
+# these keep the order they first turn up in, like rec_read_sjm, rather than being sorted.
+_IN_ORDER_OF_APPEARANCE = ("type", "seq", "dynamic")
+
+_INDEX, _PIXEL_BITS, _X, _Y = 6, 7, 9, 10
+_INTERCEPT, _SLOPE, _SCALE = 11, 12, 13
+_THICKNESS, _GAP, _SPACING_X, _SPACING_Y = 22, 23, 28, 29
+_ECHO_TIME, _FLIP_ANGLE = 30, 35
+
+
+class ParRec:
+    """A par/rec pair, filename without the extension as for rec_read_sjm.
+
+    general is the par's general information by name (as strings), images its image lines as a float array, one row
+    per image in the order they are listed."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.general, self.images = _read_par(_find(filename, ".PAR"))
+        columns = self.images.shape[1]
+        self.version = "V4.2" if columns > 48 else "V4.1" if columns > 41 else "V4"
+
+        if np.ptp(self.images[:, [_X, _Y, _PIXEL_BITS]], axis=0).any():
+            raise ValueError("Images of different sizes or depths aren't supported.")
+        self.x, self.y = int(self.images[0, _X]), int(self.images[0, _Y])
+        bits = int(self.images[0, _PIXEL_BITS])
+        dtype = {8: np.int8, 16: np.dtype("<i2")}[bits]
+
+        self.raw_images = np.memmap(
+            _find(filename, ".REC"), dtype=dtype, mode="r"
+        ).reshape(-1, self.y, self.x)
+
+        # which image is at each combination of labels, -1 for none.
+        self.labels = {}
+        positions = []
+        for name in LABELS:
+            column = _LABEL_COLUMNS[name]
+            if column >= columns:
+                values = np.ones(len(self.images))
+            else:
+                values = self.images[:, column]
+            if name in _IN_ORDER_OF_APPEARANCE:
+                unique, first = np.unique(values, return_index=True)
+                unique = unique[np.argsort(first)]
+            else:
+                unique = np.unique(values)
+            self.labels[name] = unique
+            positions.append(np.argmax(values[:, None] == unique[None, :], axis=1))
+        self.index = np.full([len(self.labels[name]) for name in LABELS], -1)
+        self.index[tuple(positions)] = self.images[:, _INDEX].astype(int)
+
+        # (stored * slope + intercept) / (slope * scale) gives the floating point value, as rec_read_sjm does.
+        slope = self.images[:, _SLOPE]
+        self._scale = np.zeros(len(self.raw_images))
+        self._offset = np.zeros(len(self.raw_images))
+        image_index = self.images[:, _INDEX].astype(int)
+        self._scale[image_index] = 1 / self.images[:, _SCALE]
+        self._offset[image_index] = self.images[:, _INTERCEPT] / (
+            slope * self.images[:, _SCALE]
+        )
+
+    @property
+    def shape(self):
+        return (self.x, self.y) + self.index.shape
+
+    def data(self):
+        """A view of every image, rescaled, with all the axes."""
+        return RecView(self, range(len(LABELS)))
+
+    def squeezed(self):
+        """A view with the label axes of size one left out, as rec_read_sjm returns."""
+        return RecView(self, [a for a, size in enumerate(self.index.shape) if size > 1])
+
+    def raw(self):
+        """Like data(), but the values as stored, unscaled."""
+        return RecView(self, range(len(LABELS)), rescale=False)
+
+    @property
+    def voxel_size(self):
+        """x, y and z (slice thickness plus gap) in mm, of the first image."""
+        first = self.images[0]
+        return (
+            float(first[_SPACING_X]),
+            float(first[_SPACING_Y]),
+            float(first[_THICKNESS] + first[_GAP]),
+        )
+
+    @property
+    def echo_times(self):
+        """In ms, of each image in the order they are listed (info.te in rec_read_sjm)."""
+        return self.images[:, _ECHO_TIME]
+
+    @property
+    def flip_angles(self):
+        return self.images[:, _FLIP_ANGLE]
+
+    def general_values(self, name):
+        """A general information entry as numbers, e.g. general_values("FOV (ap,fh,rl) [mm]")."""
+        return [float(value) for value in self.general[name].split()]
+
+
+class RecView:
+    """Some of the label axes of a ParRec's images. Indexing reads just the images it covers from the rec and
+    returns a numpy array, rescaled unless this is a raw() view.
+
+    Axes are x, y then the label axes kept, the ones left out are taken at their first value."""
+
+    def __init__(self, rec, axes, rescale=True):
+        self.rec = rec
+        self.axes = list(axes)
+        self.rescale = rescale
+        self.shape = (rec.x, rec.y) + tuple(rec.index.shape[a] for a in self.axes)
+        self.ndim = len(self.shape)
+        self.dtype = np.dtype(np.float64) if rescale else rec.raw_images.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        array = self[...]
+        return array if dtype is None else array.astype(dtype)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            at = key.index(Ellipsis)
+            fill = (slice(None),) * (self.ndim - len(key) + 1)
+            key = key[:at] + fill + key[at + 1 :]
+        if len(key) > self.ndim:
+            raise IndexError(f"Too many indices for a {self.ndim} dimensional view.")
+        key = key + (slice(None),) * (self.ndim - len(key))
+
+        # the images wanted, with the label axes as they will be in the result.
+        label_key = [0] * len(LABELS)
+        for axis, k in zip(self.axes, key[2:]):
+            label_key[axis] = k
+        wanted = np.asarray(self.rec.index[tuple(label_key)])
+        missing = wanted < 0
+        wanted = np.where(missing, 0, wanted)
+
+        images = np.asarray(self.rec.raw_images[wanted.ravel()])  # only these are read.
+        if self.rescale:
+            images = (
+                images * self.rec._scale[wanted.ravel(), None, None]
+                + self.rec._offset[wanted.ravel(), None, None]
+            )
+        images[missing.ravel()] = 0
+        # stored with x changing fastest, so each image is y x x: make it x, y, then the labels.
+        images = images.reshape(wanted.shape + (self.rec.y, self.rec.x))
+        images = np.moveaxis(images, (-1, -2), (0, 1))
+        return images[key[0], key[1]]
+
+
+def _find(filename, extension):
+    """The file with this extension, in upper or lower case."""
+    for candidate in (filename + extension, filename + extension.lower()):
+        if os.path.exists(candidate):
+            return candidate
+    raise FileNotFoundError(f"No {filename}{extension}")
+
+
+def _read_par(path):
+    """The general information (name: value strings) and the image lines of a par file."""
+    general = {}
+    rows = []
+    with open(path, encoding="latin-1") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("."):
+                name, _, value = line[1:].partition(":")
+                general[name.strip()] = value.strip()
+            elif line and not line.startswith("#"):
+                rows.append([float(value) for value in line.split()])
+
+    if not rows:
+        raise ValueError(f"No image lines in {path}.")
+    width = min(len(row) for row in rows)
+    if width < 41:
+        raise ValueError(f"{path} isn't export tool V4 or later.")
+    return general, np.array([row[:width] for row in rows])
@@ -0,0 +1,47 @@
+import json
+import os
+import socket
+import struct
+
+# binary payloads, which the server passes on to the client they are for without looking inside.
+# the content of the frame is a short json description of the payload (its meta), then the raw bytes:
+#   4 byte big endian length of the meta, the meta as utf-8 json, the body.
+# so the body never goes through json, and the receiver gets it as a view of what was read off the socket.
+
+# content types whose frames are forwarded untouched. each has a handler in Client.payload_handlers.
+FORWARDED = ("file", "ndarray")
+
+META_LENGTH = struct.Struct(">I")
+
+
+def pack_meta(meta):
+    """The start of a payload's content, the body goes straight after."""
+    meta_bytes = json.dumps(meta, separators=(",", ":")).encode("utf-8")
+    return META_LENGTH.pack(len(meta_bytes)) + meta_bytes
+
+
+def unpack(content):
+    """Split a payload's content into its meta and a memoryview of its body, without copying the body."""
+    view = memoryview(content)
+    (meta_length,) = META_LENGTH.unpack_from(view)
+    meta_end = META_LENGTH.size + meta_length
+    meta = json.loads(bytes(view[META_LENGTH.size : meta_end]).decode("utf-8"))
+    return meta, view[meta_end:]
+
+
+def can_sendfile(sock):
+    """Check whether the body can go from a file to this socket without passing through python (not on windows,
+    or to an in-process QueueSocket)."""
+    return hasattr(os, "sendfile") and isinstance(sock, socket.socket)
+
+
+def read_range(fd, offset, count):
+    """Read count bytes from offset in a file, for when they can't be sent with sendfile."""
+    os.lseek(fd, offset, os.SEEK_SET)
+    data = bytearray()
+    while len(data) < count:
+        block = os.read(fd, count - len(data))
+        if not block:
+            raise EOFError(f"File ended {count - len(data)} bytes early.")
+        data += block
+    return bytes(data)
@@ -0,0 +1,281 @@
+import queue
+import threading
+import time
+import traceback
+
+from libraries.metrics import MetricsRegistry
+
+# running the acquire -> filter -> solve -> send path as a chain of stages, each on its own thread, with a small
+# queue between each pair. while one frame is being solved the next can be read from skope and the last sent to
+# mrshim, rather than doing each in turn like the matlab loop does.
+#
+# a source makes items, transforms turn each item into another (or drop it), a sink does something with them.
+# each stage says what type of item it takes and gives, which is checked when the pipeline is put together.
+# the queues are bounded: by default when one is full the oldest item is dropped, as for shimming the newest field
+# is the only one worth acting on. with overflow="block" a slow stage holds up the ones before it instead.
+#
+# timing for each stage (time working, time waiting for input, items, drops, queue depth) and from each item leaving
+# the source to it leaving the sink is kept in a MetricsRegistry, see report(). a source's produce() is all counted
+# as waiting, as it is mostly waiting for data to arrive.
+
+
+class EndOfStream(Exception):
+    """Raised by a source's produce() when it has nothing more to give."""
+
+
+class Stage:
+    """Something which runs on its own thread in a Pipeline.
+
+    accepts and produces are the types of item taken and given, None for nothing (a source takes nothing, a sink
+    gives nothing). start() and stop() are called on the stage's own thread, before the first item and after the
+    last, so that is where to open and close sockets."""
+
+    accepts = None
+    produces = None
+
+    def __init__(self, name=None):
+        self.name = name or type(self).__name__
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class Source(Stage):
+    """Makes items, e.g. by reading them from skope."""
+
+    produces = object
+
+    def produce(self):
+        """Return the next item, or None if there isn't one yet. Shouldn't block for long, so the pipeline can stop.
+
+        Raise EndOfStream when there will be no more."""
+        raise NotImplementedError
+
+
+class Transform(Stage):
+    """Turns each item into another."""
+
+    accepts = object
+    produces = object
+
+    def process(self, item):
+        """Return the new item, or None to drop this one."""
+        raise NotImplementedError
+
+
+class Sink(Stage):
+    """Uses up items, e.g. by sending them to the server."""
+
+    accepts = object
+
+    def consume(self, item):
+        raise NotImplementedError
+
+
+# put on a queue after the last item, to tell the stages after it to finish.
+_END = object()
+
+
+class Pipeline:
+    """A source, any number of transforms and a sink, connected by bounded queues.
+
+    pipeline = Pipeline("shim")
+    pipeline.add(BfitSource(ingester))
+    pipeline.add(SolverStage(solver))
+    pipeline.add(ShimmerSink(client))
+    pipeline.run()  # until the source ends or ctrl-c.
+    """
+
+    def __init__(self, name="pipeline", queue_size=4, overflow="drop_oldest"):
+        if overflow not in ("drop_oldest", "block"):
+            raise ValueError(f"Unknown overflow {overflow!r}.")
+        self.name = name
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.stages = []
+        self._queues = []  # _queues[i] is the input of stages[i + 1].
+        self._threads = []
+        self._stopping = threading.Event()
+        self.error = None  # the first exception raised by a stage, if any.
+
+        self.metrics = MetricsRegistry(f"shimmer_{name}")
+        self.stage_time = self.metrics.histogram(
+            "stage_seconds", "Time each stage spends on an item.", labels=("stage",)
+        )
+        self.wait_time = self.metrics.histogram(
+            "wait_seconds",
+            "Time each stage waits for its next item.",
+            labels=("stage",),
+        )
+        self.items = self.metrics.counter(
+            "items_total", "Items each stage has finished with.", labels=("stage",)
+        )
+        self.dropped = self.metrics.counter(
+            "dropped_total",
+            "Items thrown away because the queue into a stage was full.",
+            labels=("stage",),
+        )
+        self.queue_depth = self.metrics.gauge(
+            "queue_depth", "Items waiting for each stage.", labels=("stage",)
+        )
+        self.latency = self.metrics.histogram(
+            "latency_seconds", "Time from an item leaving the source to the sink."
+        )
+
+    def add(self, stage):
+        """Add the next stage, checking it takes what the last one gives. Returns the stage."""
+        if not self.stages:
+            if not isinstance(stage, Source):
+                raise TypeError(f"The first stage must be a Source, not {stage.name}.")
+        else:
+            previous = self.stages[-1]
+            if isinstance(previous, Sink):
+                raise TypeError(f"Nothing can come after the sink {previous.name}.")
+            if isinstance(stage, Source):
+                raise TypeError(f"Only the first stage can be a Source ({stage.name}).")
+            if not issubclass(previous.produces, stage.accepts):
+                raise TypeError(
+                    f"{stage.name} takes {stage.accepts.__name__}, but {previous.name} gives {previous.produces.__name__}."
+                )
+            self._queues.append(queue.Queue(maxsize=self.queue_size))
+        self.stages.append(stage)
+        return stage
+
+    def start(self):
+        if len(self.stages) < 2 or not isinstance(self.stages[-1], Sink):
+            raise TypeError("A pipeline needs a source, then a sink at the end.")
+        self._stopping.clear()
+        for index, stage in enumerate(self.stages):
+            thread = threading.Thread(
+                target=self._run_stage,
+                args=(index,),
+                name=f"{self.name}-{stage.name}",
+                daemon=True,
+            )
+            self._threads.append(thread)
+            thread.start()
+
+    def stop(self):
+        """Stop every stage, dropping whatever is still in the queues."""
+        self._stopping.set()
+        self.join()
+
+    def join(self, timeout=None):
+        """Wait for every stage to finish. Returns True if they have."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            left = None if deadline is None else max(0, deadline - time.monotonic())
+            thread.join(left)
+        return not any(thread.is_alive() for thread in self._threads)
+
+    def run(self):
+        """Start, and block until the source runs out, a stage fails or we are interrupted."""
+        self.start()
+        try:
+            while not self.join(timeout=0.5):
+                pass
+        except KeyboardInterrupt:
+            print(f"Stopping {self.name}.")
+        finally:
+            self.stop()
+        if self.error is not None:
+            raise self.error
+
+    def report(self):
+        return self.metrics.summary()
+
+    def _run_stage(self, index):
+        stage = self.stages[index]
+        inbox = self._queues[index - 1] if index > 0 else None
+        outbox = self._queues[index] if index < len(self._queues) else None
+        try:
+            stage.start()
+            if isinstance(stage, Source):
+                self._run_source(stage, outbox)
+            else:
+                self._run_consumer(index, inbox, outbox)
+        except Exception as e:
+            print(f"Pipeline: Error in {stage.name}:\n{traceback.format_exc()}")
+            if self.error is None:
+                self.error = e
+            self._stopping.set()
+        finally:
+            try:
+                stage.stop()
+            finally:
+                if outbox is not None:
+                    self._put(outbox, _END, self.stages[index + 1], final=True)
+
+    def _run_source(self, stage, outbox):
+        while not self._stopping.is_set():
+            waiting = time.perf_counter()
+            try:
+                item = stage.produce()
+            except EndOfStream:
+                return
+            if item is None:
+                continue
+            # mostly waiting for the data to arrive, so counted as waiting, and the item is timed from now.
+            born = time.perf_counter()
+            self.wait_time.observe(born - waiting, stage=stage.name)
+            self.items.inc(stage=stage.name)
+            self._put(outbox, (born, item), self.stages[1])
+
+    def _run_consumer(self, index, inbox, outbox):
+        stage = self.stages[index]
+        next_stage = self.stages[index + 1] if outbox is not None else None
+        while not self._stopping.is_set():
+            waiting = time.perf_counter()
+            try:
+                entry = inbox.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if entry is _END:
+                return
+            self.queue_depth.set(inbox.qsize(), stage=stage.name)
+
+            born, item = entry
+            started = time.perf_counter()
+            self.wait_time.observe(started - waiting, stage=stage.name)
+            if outbox is None:
+                stage.consume(item)
+                self._finished(stage, started)
+                self.latency.observe(time.perf_counter() - born)
+                continue
+
+            item = stage.process(item)
+            self._finished(stage, started)
+            if item is not None:
+                self._put(outbox, (born, item), next_stage)
+
+    def _finished(self, stage, started):
+        self.stage_time.observe(time.perf_counter() - started, stage=stage.name)
+        self.items.inc(stage=stage.name)
+
+    def _put(self, outbox, entry, receiver, final=False):
+        """Queue an item for the next stage, dropping or waiting if it is behind.
+
+        The end of the stream is never dropped, and when blocking waits like any other item."""
+        while True:
+            if self.overflow == "block" and not self._stopping.is_set():
+                try:
+                    outbox.put(entry, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+            try:
+                outbox.put_nowait(entry)
+                return
+            except queue.Full:
+                if self._stopping.is_set() and not final:
+                    return
+                # the newest data is the most useful.
+                try:
+                    outbox.get_nowait()
+                    self.dropped.inc(stage=receiver.name)
+                except queue.Empty:
+                    pass
@@ -0,0 +1,120 @@
+import cProfile
+import io
+import os
+import pstats
+import time
+
+# timers around the stages of the main loops, switched on for a few seconds by the profile command.
+# when switched off each timed stage costs an attribute check, so they can stay in the real time path.
+
+
+class StageProfiler:
+    """Adds up the time spent in each stage while active, then writes a report to ./logs.
+
+    Use it like:
+        started = profiler.begin()
+        ... the stage ...
+        profiler.end("stage name", started)
+    """
+
+    def __init__(self, name, logger):
+        self.name = name
+        self.logger = logger
+        self.active = False
+        self._until = 0
+        self._cprofile = None
+        self._stages = {}
+
+    def start(self, seconds, full=False):
+        """Profile for this many seconds. full also runs cProfile, which is slower but shows every function.
+
+        One already running is finished (and its report written) first, so its cProfile isn't left running."""
+        if self.active:
+            self.stop()
+        self._stages = {}
+        self._started = time.perf_counter()
+        self._until = self._started + seconds
+        self.active = True
+
+        if full:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+        print(f"Profiling {self.name} for {seconds} seconds.")
+        self.logger.info(f"Profiling {self.name} for {seconds} seconds, full={full}.")
+
+    def begin(self):
+        """Start timing a stage, returns None if we aren't profiling."""
+        if not self.active:
+            return None
+        return time.perf_counter()
+
+    def end(self, stage, started):
+        """Finish timing a stage started with begin()."""
+        if started is not None:
+            self.record(stage, time.perf_counter() - started)
+
+    def record(self, stage, elapsed):
+        """Add time to a stage that was measured some other way."""
+        totals = self._stages.get(stage)
+        if totals is None:
+            # count, total, max
+            self._stages[stage] = [1, elapsed, elapsed]
+        else:
+            totals[0] += 1
+            totals[1] += elapsed
+            if elapsed > totals[2]:
+                totals[2] = elapsed
+
+    def time_left(self, timeout=None):
+        """Shorten a select timeout so we wake up when the time is up."""
+        left = max(0, self._until - time.perf_counter())
+        if timeout is None:
+            return left
+        return min(timeout, left)
+
+    def check(self):
+        """Called once per main loop, writes the report once the time is up."""
+        if self.active and time.perf_counter() > self._until:
+            self.stop()
+
+    def stop(self):
+        self.active = False
+        if self._cprofile is not None:
+            self._cprofile.disable()
+
+        duration = time.perf_counter() - self._started
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        filename = f"./logs/profile_{self.name}_{stamp}.txt"
+        number = 1
+        while os.path.exists(filename):  # e.g. one restarted within the second.
+            number += 1
+            filename = f"./logs/profile_{self.name}_{stamp}_{number}.txt"
+        with open(filename, "w", encoding="utf-8") as report:
+            report.write(self.report(duration))
+
+        self._cprofile = None
+        print(f"Profile of {self.name} written to {filename}")
+        self.logger.info(f"Profile of {self.name} written to {filename}")
+
+    def report(self, duration):
+        """Make a table of the stages, slowest in total first."""
+        lines = [
+            f"Profile of {self.name} over {duration:.3f} s",
+            "",
+            f"{'stage':<24}{'count':>10}{'total ms':>12}{'mean us':>12}{'max us':>12}{'% time':>9}",
+        ]
+        by_total = sorted(self._stages.items(), key=lambda item: -item[1][1])
+        for stage, (count, total, maximum) in by_total:
+            lines.append(
+                f"{stage:<24}{count:>10}{total * 1e3:>12.3f}{total / count * 1e6:>12.1f}"
+                f"{maximum * 1e6:>12.1f}{100 * total / duration:>9.2f}"
+            )
+
+        if self._cprofile is not None:
+            stream = io.StringIO()
+            stats = pstats.Stats(self._cprofile, stream=stream)
+            stats.sort_stats("cumulative").print_stats(40)
+            lines += ["", "cProfile, 40 most expensive by cumulative time:", stream.getvalue()]
+
+        return "\n".join(lines) + "\n"
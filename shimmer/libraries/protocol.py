@@ -0,0 +1,124 @@
+# the fixed layout binary header used by version 2 of the shimmer protocol.
+# version 1 frames are a 2 byte length, a json header and then the content. version 2 frames swap the first two
+# for a fixed layout header which only takes a struct.unpack to read.
+# both ends start on version 1 and offer version 2 in their json headers. once a side has seen an offer (or a
+# version 2 frame) it knows the other end can read version 2 and starts writing it. legacy clients never offer,
+# so they are only ever sent version 1. every reader understands both, version 2 frames start with MAGIC.
+
+import struct
+import sys
+import time
+import zlib
+
+from libraries.registry import registry
+
+VERSION = 2  # the newest version we speak.
+
+# first byte of a version 2 frame. a version 1 frame starts with the high byte of its json header's length,
+# which would need a json header over 45kB to clash.
+MAGIC = 0xB2
+MAGIC_BYTE = bytes([MAGIC])
+
+# magic, version, content type code, flags, to id, from id, content length, sequence number, send time.
+HEADER = struct.Struct(">BBBBHHIId")
+
+FLAG_LITTLE_ENDIAN = 0x01
+
+# numeric codes for the content types, the code is the index. only add to the end of this list.
+CONTENT_TYPES = ["text/json", "command", "relay", "clock", "file", "ndarray", "status"]
+CONTENT_TYPE_CODES = {name: code for code, name in enumerate(CONTENT_TYPES)}
+# content types of commands the server passes on to the client named in "to". a status is a relay which is only
+# ever diagnostic traffic, e.g. mrshim's status updates, so monitoring never holds up the currents.
+RELAYS = ("relay", "status")
+
+# numeric ids for the members of the network, 0 means nobody. taken from the network description, which should be
+# the same on every computer. we check that during negotiation with ENDPOINTS_DIGEST.
+ENDPOINTS = [None] + registry.sections()
+ENDPOINT_IDS = {name: endpoint_id for endpoint_id, name in enumerate(ENDPOINTS)}
+ENDPOINTS_DIGEST = zlib.crc32(",".join(registry.sections()).encode("utf-8"))
+
+# the optional header parts version 2 has room for, anything else has to go in a version 1 json header.
+V2_OPTIONAL_HEADERS = ("to", "from")
+
+
+def offer():
+    """The parts to add to a version 1 json header to offer version 2 to the other end."""
+    return {"protocol": VERSION, "endpoints": ENDPOINTS_DIGEST}
+
+
+def accepts_offer(jsonheader):
+    """Check a version 1 json header for an offer of version 2 we can take up."""
+    return (
+        jsonheader.get("protocol", 1) >= 2
+        and jsonheader.get("endpoints") == ENDPOINTS_DIGEST
+    )
+
+
+def pack_header(content_type, content_length, optional_header, sequence):
+    """Make a version 2 header.
+
+    Returns None if the header can't be represented in version 2, e.g. an unknown content type, so the caller
+    should send a version 1 frame instead."""
+    if content_type not in CONTENT_TYPE_CODES:
+        return None
+
+    optional_header = optional_header or {}
+    for name in optional_header:
+        if name not in V2_OPTIONAL_HEADERS:
+            return None
+
+    to_name = optional_header.get("to")
+    from_name = optional_header.get("from")
+    if to_name not in ENDPOINT_IDS or from_name not in ENDPOINT_IDS:
+        return None
+
+    return HEADER.pack(
+        MAGIC,
+        VERSION,
+        CONTENT_TYPE_CODES[content_type],
+        FLAG_LITTLE_ENDIAN if sys.byteorder == "little" else 0,
+        ENDPOINT_IDS[to_name],
+        ENDPOINT_IDS[from_name],
+        content_length,
+        sequence & 0xFFFFFFFF,
+        time.time(),
+    )
+
+
+def unpack_header(buffer):
+    """Read a version 2 header from the start of buffer, which should be at least HEADER.size long.
+
+    Returns the same dictionary a version 1 json header would have given, with the sequence number and send time.
+    """
+    (
+        _,
+        version,
+        type_code,
+        flags,
+        to_id,
+        from_id,
+        content_length,
+        sequence,
+        send_time,
+    ) = HEADER.unpack_from(buffer)
+
+    try:
+        content_type = CONTENT_TYPES[type_code]
+    except IndexError:
+        raise ValueError(
+            f"Unknown content type code {type_code} in version {version} header."
+        )
+
+    header = {
+        "byteorder": "little" if flags & FLAG_LITTLE_ENDIAN else "big",
+        "content-type": content_type,
+        "content-length": content_length,
+        "seq": sequence,
+        "timestamp": send_time,
+    }
+    if to_id:
+        header["to"] = ENDPOINTS[to_id]
+    if from_id:
+        header["from"] = ENDPOINTS[from_id]
+
+    return header
@@ -0,0 +1,97 @@
+import numpy as np
+
+# updating the shims between the frames mrshim is sent, see MRShimClient.set_ramp().
+#
+# frames arrive every dynamicTR or so. rather than stepping to each as it arrives and holding it until the next, the
+# amplifiers are updated every so often (much more often than frames arrive) with one of:
+#   step         the last frame, as without the scheduler, but slew limited.
+#   ramp         a straight line from where the currents were when the frame arrived to the frame, over the time
+#                frames have been arriving apart, so each is reached just as the next is due.
+#   extrapolate  the line through the last two frames, carried on past the last for up to a frame interval (then
+#                held), to keep up with a field which is drifting, e.g. with breathing.
+# whichever it is, no channel changes faster than its slew limit, so big steps don't ring in the amplifiers or set
+# off eddy currents, and nothing goes past the amplifiers' limit (which jupiter would set to 0 instead).
+
+MODES = ("step", "ramp", "extrapolate")
+
+
+class RampScheduler:
+    """The currents to apply at any time, from the frames received so far. Times are in seconds (perf_counter).
+
+    slew_limit is in mA per second, one for every channel or one each, None for no limit. limit is in mA."""
+
+    def __init__(
+        self, channels, mode="ramp", slew_limit=None, limit=2000.0, smoothing=0.2
+    ):
+        if mode not in MODES:
+            raise ValueError(f"Unknown mode {mode!r}, not one of {', '.join(MODES)}.")
+        self.channels = channels
+        self.mode = mode
+        self.limit = limit
+        self.smoothing = smoothing  # of the moving average of the time between frames.
+        self.set_slew_limit(slew_limit)
+        self.reset()
+
+    def set_slew_limit(self, slew_limit):
+        if slew_limit is None:
+            self.slew_limit = None
+        else:
+            self.slew_limit = np.broadcast_to(
+                np.asarray(slew_limit, dtype=np.float64), (self.channels,)
+            )
+
+    def reset(self, currents=None):
+        """Forget the frames, and start from these currents (0 if not given), e.g. when shimming is started."""
+        self.output = np.zeros(self.channels)
+        if currents is not None:
+            self.output[:] = currents
+        self.frame_interval = None
+        self._updated = None
+        self._frame = self.output.copy()
+        self._arrived = None
+        self._previous = None
+        self._previous_arrived = None
+        self._start = self.output.copy()
+
+    def frame(self, currents, now):
+        """A new frame of currents (mA) has arrived."""
+        if self._arrived is not None and now > self._arrived:
+            interval = now - self._arrived
+            if self.frame_interval is None:
+                self.frame_interval = interval
+            else:
+                self.frame_interval += self.smoothing * (interval - self.frame_interval)
+        self._previous, self._previous_arrived = self._frame, self._arrived
+        self._frame = np.asarray(currents, dtype=np.float64)
+        self._arrived = now
+        self._start = self.output.copy()  # where a ramp to it starts.
+
+    def target(self, now):
+        """Where the currents should be now, before the slew limits."""
+        if self._arrived is None:
+            return self.output
+        if self.mode == "step" or self.frame_interval is None:
+            return self._frame
+
+        elapsed = now - self._arrived
+        if self.mode == "ramp":
+            fraction = min(elapsed / self.frame_interval, 1.0)
+            return self._start + fraction * (self._frame - self._start)
+
+        # extrapolate, from the last two frames.
+        if self._previous_arrived is None or self._arrived <= self._previous_arrived:
+            return self._frame
+        velocity = (self._frame - self._previous) / (
+            self._arrived - self._previous_arrived
+        )
+        return self._frame + velocity * min(elapsed, self.frame_interval)
+
+    def update(self, now):
+        """The currents to apply now, which are then taken to be what is applied."""
+        target = np.clip(self.target(now), -self.limit, self.limit)
+        if self.slew_limit is not None and self._updated is not None:
+            step = self.slew_limit * (now - self._updated)
+            target = np.clip(target, self.output - step, self.output + step)
+        self.output = np.array(target, dtype=np.float64)
+        self._updated = now
+        return self.output
@@ -0,0 +1,226 @@
+import collections
+import functools
+import itertools
+import json
+import math
+import os
+import time
+
+import numpy as np
+
+from libraries.current_solver import CurrentSolver
+from libraries.field_filter import FieldPredictor
+from libraries.field_fit import GAMMA_1H
+from libraries.parrec import ParRec
+from libraries.spherical_harmonics import HarmonicBasis
+
+# working out again what a recorded scan would have shimmed with different settings, see reevaluate.py.
+#
+# a session is a folder written by export_session.m after a scan:
+#   bfit.npy             the probe fields of each dynamic (dynamics x probes, T), averaged like the live loop does.
+#   probe_positions.npy  probes x 3 (m), from AqSysData.
+#   magnitude.npy        the field map's magnitude, for the mask. or field_map.PAR/.REC, which is read from instead.
+#   coil_tmp.npy         the field each coil makes per mA at each voxel, from Arche.
+#   session.json         dynamic_tr (s) and the voxel sizes (m).
+# the .npy files are memory mapped, so the worker processes share one copy of them in the page cache.
+#
+# each frame's currents are solved as the live pipeline would, then scored against the next frame's field, which is
+# the one they are in place for. the residual is the low order field the probes saw plus what the shims add, over the
+# masked voxels. its rms for every frame comes from a few small matrix products, without ever making the residual
+# at every voxel for every frame.
+
+# one point of a sweep. order is of the spherical harmonics, mask_threshold a fraction of the brightest voxel,
+# field_model None or one of FieldPredictor's, predicting ahead by latency seconds (the dynamicTR if None).
+Settings = collections.namedtuple(
+    "Settings",
+    [
+        "order",
+        "mask_threshold",
+        "regularisation",
+        "channel_limit",
+        "rms_limit",
+        "field_model",
+        "latency",
+    ],
+)
+DEFAULT_SETTINGS = Settings(1, 0.05, 0.0, 2000.0, 2000.0, None, None)
+
+# residuals in Hz, as the field per mA in coil_tmp.npy is.
+Evaluation = collections.namedtuple(
+    "Evaluation",
+    [
+        "currents",  # dynamics x channels, mA.
+        "before_rms",  # of the field each frame's currents are in place for, unshimmed, per frame.
+        "after_rms",  # of the residual with them, per frame.
+        "after_std",  # the same without its mean (the frequency offset), per frame.
+        "limited",  # whether each frame's currents hit the amplifier limits.
+        "iterations",  # the solver's, per frame.
+    ],
+)
+
+
+def settings_grid(**values):
+    """Every combination of the values given for each setting, the rest at their defaults.
+
+    e.g. settings_grid(order=[1, 2], regularisation=[0, 1e-3]) is four settings."""
+    names = list(values)
+    grid = []
+    for combination in itertools.product(*(values[name] for name in names)):
+        grid.append(DEFAULT_SETTINGS._replace(**dict(zip(names, combination))))
+    return grid
+
+
+class Session:
+    """A recorded scan, from the folder export_session.m made. The arrays are memory mapped and read only."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.name = os.path.basename(os.path.normpath(folder))
+        with open(os.path.join(folder, "session.json"), encoding="utf-8") as f:
+            info = json.load(f)
+        self.dynamic_tr = float(info["dynamic_tr"])
+        self.resolution = (
+            float(info["resolution"]),
+            float(info["resolution"]),
+            float(info["z_resolution"]),
+        )
+
+        def load(name):
+            return np.load(os.path.join(folder, name), mmap_mode="r")
+
+        self.bfit = load("bfit.npy")
+        self.probe_positions = load("probe_positions.npy")
+        if os.path.exists(os.path.join(folder, "magnitude.npy")):
+            self.magnitude = load("magnitude.npy")
+        else:
+            # img(:, :, :, 1, 1) as matlab_client.m, reading only those images of the rec.
+            self.magnitude = ParRec(os.path.join(folder, "field_map")).squeezed()[
+                :, :, :, 0, 0
+            ]
+        coils = load("coil_tmp.npy")
+        # matlab_client.m reshapes it column major, the same here. a no-op if Arche saved it this shape already.
+        self.coils = coils.reshape((-1,) + self.magnitude.shape, order="F")
+
+    def probe_fields(self):
+        """The field at each probe in each dynamic, in Hz, dynamics x probes."""
+        return np.asarray(self.bfit, dtype=np.float64) * GAMMA_1H / (2 * np.pi)
+
+    def voxel_positions(self):
+        """The position of every voxel (m), on the grid matlab_client.m uses, shape + (3,)."""
+        axes = [
+            size * np.arange(-(n // 2), n - n // 2)
+            for n, size in zip(self.magnitude.shape, self.resolution)
+        ]
+        return np.stack(np.meshgrid(*axes, indexing="ij"), axis=-1)
+
+
+class Calibration:
+    """What matlab_client.m works out before a scan, for one mask and order.
+
+    The voxel and coil matrices are kept as their products with each other, which are all scoring needs."""
+
+    def __init__(self, session, order, mask_threshold):
+        magnitude = np.asarray(session.magnitude)
+        self.mask = magnitude > mask_threshold * magnitude.max()
+        voxels = session.voxel_positions()[self.mask]
+        # channels x voxels.
+        coils = np.asarray(session.coils[:, self.mask], dtype=np.float64)
+
+        self.basis = HarmonicBasis(voxels, session.probe_positions, order)
+        # how much of each coil makes each harmonic, as matlab_client.m's lsqr.
+        coil_coefficients = np.linalg.lstsq(coils.T, self.basis.voxels, rcond=None)[0].T
+
+        self.field_per_current = np.linalg.pinv(coil_coefficients.T)
+        harmonics = self.basis.voxels
+        self.voxel_count = len(voxels)
+        # |harmonics c + coils' I|^2 over the voxels is c' hh c + 2 c' hc I + I' cc I.
+        self._hh = harmonics.T @ harmonics
+        self._hc = harmonics.T @ coils.T
+        self._cc = coils @ coils.T
+        self._h_sum = harmonics.sum(axis=0)
+        self._c_sum = coils.sum(axis=1)
+
+    def residual_statistics(self, coefficients, currents):
+        """rms and standard deviation over the mask of the harmonic field plus the shims, per frame.
+
+        coefficients is frames x harmonics, currents frames x channels."""
+        square = (
+            np.einsum("fi,ij,fj->f", coefficients, self._hh, coefficients)
+            + 2 * np.einsum("fi,ij,fj->f", coefficients, self._hc, currents)
+            + np.einsum("fi,ij,fj->f", currents, self._cc, currents)
+        ) / self.voxel_count
+        mean = (coefficients @ self._h_sum + currents @ self._c_sum) / self.voxel_count
+        square = np.maximum(square, 0)  # rounding, for residuals of nearly nothing.
+        return np.sqrt(square), np.sqrt(np.maximum(square - mean**2, 0))
+
+
+@functools.lru_cache(maxsize=4)
+def load_session(folder):
+    return Session(folder)
+
+
+@functools.lru_cache(maxsize=8)
+def load_calibration(folder, order, mask_threshold):
+    """Cached, as a worker usually gets the same session and mask for several settings in a row."""
+    return Calibration(load_session(folder), order, mask_threshold)
+
+
+def evaluate(folder, settings, max_iterations=1000):
+    """Replay a session's frames through the solver with these settings. Returns an Evaluation."""
+    session = load_session(folder)
+    calibration = load_calibration(folder, settings.order, settings.mask_threshold)
+    solver = CurrentSolver(
+        calibration.field_per_current,
+        channel_limit=settings.channel_limit,
+        rms_limit=settings.rms_limit,
+        regularisation=settings.regularisation,
+        time_budget=math.inf,  # offline, so to convergence.
+        max_iterations=max_iterations,
+    )
+
+    fields = session.probe_fields()
+    predictor = None
+    if settings.field_model is not None:
+        predictor = FieldPredictor(fields.shape[1], model=settings.field_model)
+        latency = (
+            settings.latency if settings.latency is not None else session.dynamic_tr
+        )
+
+    frames = len(fields)
+    channels = calibration.field_per_current.shape[1]
+    currents = np.zeros((frames, channels))
+    limited = np.zeros(frames, dtype=bool)
+    iterations = np.zeros(frames, dtype=int)
+    for frame, field in enumerate(fields):
+        if predictor is not None:
+            predictor.update(field, frame * session.dynamic_tr)
+            field = predictor.predict(latency)
+        result = solver.solve(calibration.basis.coefficients(field))
+        currents[frame] = result.currents
+        limited[frame] = result.limited
+        iterations[frame] = result.iterations
+
+    # each frame's currents are in place for the next frame's field.
+    coefficients = calibration.basis.coefficients(fields[1:].T).T
+    before_rms, _ = calibration.residual_statistics(
+        coefficients, np.zeros((frames - 1, channels))
+    )
+    after_rms, after_std = calibration.residual_statistics(coefficients, currents[:-1])
+    return Evaluation(currents, before_rms, after_rms, after_std, limited, iterations)
+
+
+def evaluate_task(task):
+    """For a process pool: (folder, settings) -> (folder, settings, summary, evaluation)."""
+    folder, settings = task
+    started = time.perf_counter()
+    evaluation = evaluate(folder, settings)
+    summary = {
+        "frames": len(evaluation.currents),
+        "before_rms": float(np.mean(evaluation.before_rms)),
+        "after_rms": float(np.mean(evaluation.after_rms)),
+        "after_std": float(np.mean(evaluation.after_std)),
+        "limited_fraction": float(np.mean(evaluation.limited)),
+        "mean_iterations": float(np.mean(evaluation.iterations)),
+        "seconds": time.perf_counter() - started,
+    }
+    return folder, settings, summary, evaluation
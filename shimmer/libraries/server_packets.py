@@ -3,9 +3,13 @@ import json
 import selectors
 import struct
 import sys
+import time
 
 import libraries.registry as registry
-from .parser import parse
+import libraries.traffic as traffic
+import libraries.protocol as protocol
+import libraries.commands as commands
+import libraries.payloads as payloads
 
 
 class ClientDisconnect(Exception):
@@ -23,12 +27,14 @@ class Message:
         self.sock = sock
         self.addr = addr
         self.server = server
+        self.name = "unknown"  # the client's role, set by the server once it knows.
 
         self._recv_buffer = b""
         self._send_buffer = b""
         self._jsonheader_len = None
         self.jsonheader = None
         self.request = None
+        self.command_tokens = None
         self.response_created = False
         self.disconnect = (
             False  # sentinel for whether to disconnect this socket or not.
@@ -37,6 +43,15 @@ class Message:
         self.is_relayed_message = (
             False  # is this the message created by the server to pass on?
         )
+        self.undeliverable = False  # addressed to a client which isn't connected.
+
+        # which queue the server services this socket in, set properly once we know which client this is.
+        self.role_traffic_class = traffic.CONTROL
+        self.traffic_class = self.role_traffic_class
+
+        # the protocol version we write to this client, goes up to 2 once it shows it can read it.
+        self.protocol_version = 1
+        self._sequence = 0
 
     def _set_selector_events_mask(self, mode):
         """Set selector to listen for events: mode is 'r', 'w', or 'rw'."""
@@ -52,56 +67,89 @@ class Message:
 
     def _read(self):
         """Read from the open socket. Writes data into a buffer."""
+        started = self.server.profiler.begin()
         try:
             # Should be ready to read
-            data = self.sock.recv(4096)
+            data = self.sock.recv(65536)  # file chunks are 64 kB.
         except BlockingIOError:
             self.server.logger.debug("Blocking ioerror reached")
             # Resource temporarily unavailable (errno EWOULDBLOCK)
             pass
         else:  # then
+            self.server.profiler.end("recv", started)
             if data:
                 self._recv_buffer += data
+                self.server.bytes_in.inc(len(data), client=self.name)
             else:
                 raise RuntimeError(self.addr)
 
     def _clear(self):
-        """Reset the buffers and set the selector back to read, ready to recieve more data."""
-        self._recv_buffer = b""
+        """Reset the buffers and set the selector back to read, ready to recieve more data.
+
+        Anything already read past the end of the last frame is the start of the next one, so it is kept."""
         self._send_buffer = b""
         self._jsonheader_len = None
         self.jsonheader = None
         self.request = None
+        self.command_tokens = None
         self.response_created = False
+        self.traffic_class = self.role_traffic_class
 
         self._set_selector_events_mask("r")
 
         if self.is_relayed_message:
             self.is_relayed_message = False
 
+        if self._recv_buffer and not self.disconnect:
+            # e.g. a clock ping right behind a relay, it won't make the selector fire again.
+            self._process_recv_buffer()
+
     def _write(self):
         """Write data to the socket."""
         if self._send_buffer:
+            profiler = self.server.profiler
             try:
                 # Should be ready to write
                 if self.is_relayed_message:
-                    self.server.logger.info(
-                        f"Sending {self._send_buffer!r} to {self.to_address}"
-                    )
+                    started = profiler.begin()
+                    if self.jsonheader["content-type"] in payloads.FORWARDED:
+                        self.server.logger.info(
+                            f"Sending {len(self._send_buffer)} bytes of {self.jsonheader['content-type']} to {self.to_address}"
+                        )
+                    else:
+                        self.server.logger.info(
+                            f"Sending {self._send_buffer!r} to {self.to_address}"
+                        )
+                    profiler.end("logging", started)
+                    started = profiler.begin()
                     sent = self.to_socket.send(self._send_buffer)
                 else:
+                    started = profiler.begin()
                     self.server.logger.info(
                         f"Sending {self._send_buffer!r} to {self.addr}"
                     )
+                    profiler.end("logging", started)
+                    started = profiler.begin()
                     sent = self.sock.send(self._send_buffer)
             except BlockingIOError:
                 # Resource temporarily unavailable (errno EWOULDBLOCK)
                 pass
             else:
+                profiler.end("send", started)
                 self._send_buffer = self._send_buffer[sent:]
+                to_name = self.to_name if self.is_relayed_message else self.name
+                self.server.bytes_out.inc(sent, client=to_name)
+                self.server.send_queue_bytes.set(len(self._send_buffer), client=to_name)
                 # once whole response sent and buffer drained,
                 # clear protoheader, header and request, go back to waiting for read events.
                 if sent and not self._send_buffer:
+                    self.server.frames_out.inc(client=to_name)
+                    if self.is_relayed_message:
+                        self.server.relay_latency.observe(
+                            time.perf_counter() - self._received_at,
+                            from_client=self.name,
+                            to_client=to_name,
+                        )
                     self._clear()
                     if self.disconnect:
                         raise ClientDisconnect(self.addr)
@@ -109,17 +157,37 @@ class Message:
 
     def _json_encode(self, obj):
         """Encode json data into bytes (to send down the wire)."""
-        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        started = self.server.profiler.begin()
+        encoded = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.server.profiler.end("json_encode", started)
+        return encoded
 
     def _json_decode(self, json_bytes):
         """Decode bytes (from the wire) into json data."""
+        started = self.server.profiler.begin()
         tiow = io.TextIOWrapper(io.BytesIO(json_bytes), encoding="utf-8", newline="")
         obj = json.load(tiow)
         tiow.close()
+        self.server.profiler.end("json_decode", started)
         return obj
 
-    def _create_message(self, optional_header=None, *, content_bytes, content_type):
-        """Assemble the bytes representing the message that we will send down the wire."""
+    def _create_message(
+        self, optional_header=None, *, content_bytes, content_type, version=None
+    ):
+        """Assemble the bytes representing the message that we will send down the wire.
+
+        version is the protocol version the reader understands, defaults to that of the client we are talking to."""
+        if version is None:
+            version = self.protocol_version
+        self._sequence += 1
+
+        if version >= 2:
+            header = protocol.pack_header(
+                content_type, len(content_bytes), optional_header, self._sequence
+            )
+            if header is not None:  # not everything fits in a version 2 header.
+                return header + content_bytes
+
         # assemble jsonheader
         jsonheader = {
             "byteorder": sys.byteorder,
@@ -127,6 +195,7 @@ class Message:
             "content-length": len(content_bytes),
         }
         jsonheader.update(optional_header)
+        jsonheader.update(protocol.offer())
         self.server.logger.info(f"jsonheader is {jsonheader}")
         jsonheader_bytes = self._json_encode(jsonheader)
 
@@ -138,14 +207,26 @@ class Message:
     def _create_response_json_content(self):
         """Generate the json response that we'll send back to the client."""
         if self.jsonheader["content-type"] == "command":
-            command = self.request
-            command_tokens = parse(command)
-            content = {"result": f"Command {command_tokens[0]} recieved by server."}
+            content = {
+                "result": f"Command {self.command_tokens[0]} recieved by server."
+            }
             response_type = "command"
 
-        elif self.jsonheader["content-type"] == "relay":
-            content = {"result": self.request}
-            response_type = "relay"
+        elif self.jsonheader["content-type"] in protocol.RELAYS:
+            result = self.request
+            response_type = self.jsonheader["content-type"]
+            if self.server.sel.get_key(self.to_socket).data.protocol_version < 2:
+                result = commands.join(result)  # legacy clients want a string.
+                response_type = "relay"  # and don't know the other relays.
+            content = {"result": result}
+        elif self.jsonheader["content-type"] == "clock":
+            # the pong, stamped as late as we can. see libraries/clock.py.
+            content = {
+                "t0": self.request["t0"],
+                "t1": self._received_wall_time,
+                "t2": time.time(),
+            }
+            response_type = "clock"
         else:
             content = {
                 "result": f"Error: invalid type '{self.jsonheader['content-type']}'."
@@ -169,6 +250,10 @@ class Message:
         """Reads from socket, then processes data as it comes."""
         self.server.logger.debug("read")
         self._read()
+        self._process_recv_buffer()
+
+    def _process_recv_buffer(self):
+        """Work through as much of the next frame as we have."""
         if self._jsonheader_len is None:
             self.process_protoheader()
 
@@ -209,7 +294,19 @@ class Message:
             self.sock = None
 
     def process_protoheader(self):
-        """Process the protoheader to find out the length of the json header."""
+        """Process the protoheader to find out the length of the json header.
+
+        A version 2 header is all one piece, so it is processed here too."""
+        if self._recv_buffer[:1] == protocol.MAGIC_BYTE:
+            if len(self._recv_buffer) >= protocol.HEADER.size:
+                self.jsonheader = protocol.unpack_header(self._recv_buffer)
+                self._recv_buffer = self._recv_buffer[protocol.HEADER.size :]
+                self._jsonheader_len = protocol.HEADER.size
+                # they wrote version 2, so they can read it.
+                self.protocol_version = protocol.VERSION
+                self._process_header_fields()
+            return
+
         hdrlen = 2
         if len(self._recv_buffer) >= hdrlen:  # enough data has been sent in.
             self._jsonheader_len = struct.unpack(">H", self._recv_buffer[:hdrlen])[0]
@@ -233,12 +330,34 @@ class Message:
                 if reqhdr not in self.jsonheader:
                     raise ValueError(f"Missing required header '{reqhdr}'.")
 
-            if self.jsonheader["content-type"] == "relay":
-                to = self.jsonheader["to"]
-                self.to_socket = self.server._get_socket(to)
-                self.to_address = registry.get_address(to)
+            if protocol.accepts_offer(self.jsonheader):
+                self.protocol_version = protocol.VERSION
+
+            self._process_header_fields()
+
+    def _process_header_fields(self):
+        """Act on the header, whichever version it came in."""
+        self.traffic_class = traffic.class_of_frame(
+            self.role_traffic_class, self.jsonheader["content-type"]
+        )
+
+        if (
+            self.jsonheader["content-type"] in protocol.RELAYS
+            or self.jsonheader["content-type"] in payloads.FORWARDED
+        ):
+            to = self.jsonheader["to"]
+            if to not in self.server.clients_on_registry:
+                # e.g. a report to a client which has just left. dropped, rather than closing the sender.
+                self.server.logger.info(
+                    f"Dropping {self.jsonheader['content-type']} from {self.name} to {to}, which isn't connected."
+                )
+                self.undeliverable = True
+                return
+            self.to_name = to
+            self.to_socket = self.server._get_socket(to)
+            self.to_address = registry.get_address(to)
 
-                self.is_relayed_message = True
+            self.is_relayed_message = True
 
     def process_request(self):
         """Process the actual content of the message."""
@@ -252,9 +371,25 @@ class Message:
 
         data = self._recv_buffer[:content_len]
         self._recv_buffer = self._recv_buffer[content_len:]  # clear the read buffer.
+        self._received_at = time.perf_counter()
+        self._received_wall_time = time.time()
+        self.server.frames_in.inc(client=self.name)
+        if "timestamp" in self.jsonheader:  # version 2 frames say when they were sent.
+            self.server.observe_one_way_latency(
+                self.name, self.jsonheader["timestamp"], self._received_wall_time
+            )
+        if self.undeliverable:
+            self.undeliverable = False
+            self._clear()
+            return
 
         # if a decodeable content type, decode it
-        if self.jsonheader["content-type"] in ("text/json", "command", "relay"):
+        if self.jsonheader["content-type"] in (
+            "text/json",
+            "command",
+            "clock",
+            *protocol.RELAYS,
+        ):
             self.request = self._json_decode(data)
 
         if self.jsonheader["content-type"] == "text/json":
@@ -262,30 +397,43 @@ class Message:
                 f"Received request {self.request!r} from {self.addr}"
             )
         elif self.jsonheader["content-type"] == "command":
-
-            command = self.request
-            print(f"Server got command {command}")
-
-            if not command[0] == "!":  # server commands don't start with !
+            # the only time the command is parsed, if it wasn't sent already split into tokens.
+            started = self.server.profiler.begin()
+            self.command_tokens = commands.tokenize(self.request) or [""]
+            self.server.profiler.end("parse", started)
+            print(f"Server got command {commands.join(self.command_tokens)}")
+
+            # server commands don't start with !
+            if not commands.is_client_command(self.command_tokens):
                 self._set_selector_events_mask(
                     "w"
                 )  # set here because we never reach bottom of this function.
-                self.server.handle_command(self.request)
-
-            command_tokens = parse(command)
+                started = self.server.profiler.begin()
+                self.server.handle_command(self.command_tokens)
+                self.server.profiler.end("handle_command", started)
 
-            if command_tokens[0] == "disconnect":
+            if self.command_tokens[0] == "disconnect":
                 # print disconnecting client message here.
                 print(
                     f"Disconnecting client {registry.get_name_from_address(self.addr)}"
                 )
                 self.disconnect = True  # flag so we send the disconnect response.
 
-        elif self.jsonheader["content-type"] == "relay":
+        elif self.jsonheader["content-type"] in protocol.RELAYS:
             # we don't need to do anything to the message content, just pass it on
             self.server.logger.info(
                 f"Relaying message from {self.jsonheader['from']} to {self.jsonheader['to']}."
             )
+        elif self.jsonheader["content-type"] == "clock":
+            # the ping carries the client's latest estimate, from the pings before.
+            self.server.update_clock(self.name, self.request)
+        elif self.jsonheader["content-type"] in payloads.FORWARDED:
+            # passed on as it came, we never look inside.
+            self.request = data
+            self.server.logger.info(
+                f"Forwarding {content_len} bytes of {self.jsonheader['content-type']} "
+                f"from {self.jsonheader['from']} to {self.jsonheader['to']}."
+            )
         else:
             # Binary or unknown content-type
             self.request = data
@@ -308,18 +456,50 @@ class Message:
                 "content_bytes": self._json_encode(content),
                 "content_type": response_type,
             }
-        elif self.jsonheader["content-type"] in ("text/json", "command", "relay"):
+        elif self.jsonheader["content-type"] in (
+            "text/json",
+            "command",
+            "clock",
+            *protocol.RELAYS,
+        ):
             response = self._create_response_json_content()
 
-            if self.jsonheader["content-type"] in ("command", "relay"):
+            if self.jsonheader["content-type"] in ("command", *protocol.RELAYS):
                 optional_header_parts = {
                     "to": self.jsonheader["to"],
                     "from": self.jsonheader["from"],
                 }
+        elif self.jsonheader["content-type"] in payloads.FORWARDED:
+            response = {
+                "content_bytes": self.request,
+                "content_type": self.jsonheader["content-type"],
+            }
+            optional_header_parts = {
+                "to": self.jsonheader["to"],
+                "from": self.jsonheader["from"],
+            }
         else:
-            response = self._create_response_binary_content()
+            content = {
+                "result": f"Error: invalid type '{self.jsonheader['content-type']}'."
+            }
+            response = {
+                "content_bytes": self._json_encode(content),
+                "content_type": "command",
+            }
+
+        version = None
+        if self.is_relayed_message:
+            # written to somebody else, so in the version they understand.
+            version = self.server.sel.get_key(self.to_socket).data.protocol_version
 
-        self.server.logger.debug(f"Created response is {response}")
-        message = self._create_message(optional_header_parts, **response)
+        forwarded = (
+            self.jsonheader is not None
+            and self.jsonheader["content-type"] in payloads.FORWARDED
+        )
+        if not forwarded:  # no need to log a file chunk byte by byte.
+            self.server.logger.debug(f"Created response is {response}")
+        message = self._create_message(
+            optional_header_parts, version=version, **response
+        )
         self.response_created = True
         self._send_buffer += message
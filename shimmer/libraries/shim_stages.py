@@ -0,0 +1,182 @@
+import collections
+import queue
+import selectors
+import time
+
+import numpy as np
+
+from libraries.field_fit import GAMMA_1H
+from libraries.pipeline import EndOfStream, Sink, Source, Transform
+
+# the stages of shimming from skope's field measurements, for a Pipeline, see pipeline_client.py:
+#   BfitSource -> FieldStage -> SolverStage -> ShimmerSink
+# the same steps as MatlabClient.solve_currents() and send_currents(), split up so they can overlap.
+#
+# every item carries when its block arrived (perf_counter), so the sink can measure the whole pipeline for the
+# RateController, which the field predictor then uses as how far ahead to predict.
+
+# the field at each probe, averaged over the block, in Hz.
+ProbeFields = collections.namedtuple("ProbeFields", ["field", "arrived"])
+# its spherical harmonic coefficients.
+Harmonics = collections.namedtuple("Harmonics", ["coefficients", "arrived"])
+# the currents to cancel it, in mA.
+Currents = collections.namedtuple("Currents", ["currents", "arrived", "limited"])
+
+
+def shim_request(currents, sender="matlab"):
+    """A relay request telling mrshim to set these currents (mA), as already split tokens."""
+    current_tokens = [str(int(current)) for current in np.rint(currents)]
+    return dict(
+        type="relay",
+        encoding="utf-8",
+        content={"to": "mrshim", "from": sender, "content": ["!shim"] + current_tokens},
+    )
+
+
+class BfitSource(Source):
+    """Blocks of fitted field from a SkopeIngester's bfit stream."""
+
+    produces = ProbeFields
+
+    def __init__(self, ingester, name=None):
+        super().__init__(name)
+        self.ingester = ingester
+        self._blocks = ingester.subscribe("bfit")
+
+    def start(self):
+        self.ingester.start()
+
+    def stop(self):
+        self.ingester.stop()
+
+    def produce(self):
+        try:
+            block = self._blocks.get(timeout=0.1)
+        except queue.Empty:
+            return None
+        arrived = time.perf_counter()
+
+        if block.header["dataID"] == "T":
+            raise EndOfStream  # the end of the scan.
+        if block.header["dataID"] != "D":
+            return None  # scan headers and log messages, nothing to shim.
+        average_field = block.data.mean(axis=1)
+        return ProbeFields(average_field * GAMMA_1H / (2 * np.pi), arrived)
+
+
+class FieldStage(Transform):
+    """Fits the harmonics to the probe fields, after filtering and predicting them if there is a FieldPredictor.
+
+    rate is the RateController the sink measures the pipeline with, the prediction is that far ahead."""
+
+    accepts = ProbeFields
+    produces = Harmonics
+
+    def __init__(self, basis, predictor=None, rate=None, name=None):
+        super().__init__(name)
+        self.basis = basis
+        self.predictor = predictor
+        self.rate = rate
+
+    def process(self, item):
+        field = item.field
+        if self.predictor is not None:
+            self.predictor.update(field, item.arrived)
+            latency = None if self.rate is None else self.rate.pipeline_time(50)
+            if latency is None:
+                field = self.predictor.filtered()
+            else:
+                field = self.predictor.predict(latency)
+        return Harmonics(self.basis.coefficients(field), item.arrived)
+
+
+class SolverStage(Transform):
+    """The currents within the amplifier limits, from a CurrentSolver."""
+
+    accepts = Harmonics
+    produces = Currents
+
+    def __init__(self, solver, name=None):
+        super().__init__(name)
+        self.solver = solver
+
+    def process(self, item):
+        result = self.solver.solve(item.coefficients)
+        return Currents(result.currents, item.arrived, result.limited)
+
+
+class ShimmerSink(Sink):
+    """Sends the currents to mrshim through the shimming server, as a connected Client.
+
+    Each frame is written out before the next is taken, for at most flush_timeout seconds. If one isn't out by then
+    the next waits for it, and only the newest waiting frame is kept."""
+
+    accepts = Currents
+
+    def __init__(self, client, rate=None, flush_timeout=0.05, name=None):
+        super().__init__(name)
+        self.client = client
+        self.rate = rate
+        self.flush_timeout = flush_timeout
+        # the newest currents, waiting for the connection to be free.
+        self._pending = None
+        self.superseded = 0  # frames replaced by a newer one before they could be sent.
+
+    def start(self):
+        if self.rate is not None:
+            # mrshim's measure of getting and applying the currents, for the rate.
+            self.client.commands.register(
+                "apply_time",
+                self.rate.observe_apply,
+                arguments=(float,),
+                usage="apply_time <seconds>",
+            )
+        self.client.start_connection()
+        self._flush()
+
+    def stop(self):
+        if self._pending is not None:
+            self._flush()  # one more go at the last frame.
+        if self.superseded:
+            print(
+                f"{self.superseded} frames were replaced by newer ones before being sent."
+            )
+        self.client.close()
+
+    def consume(self, item):
+        if item.limited:
+            self.client.logger.warning(
+                "Currents are at the amplifier limits, the field is only partly cancelled."
+            )
+        if self._pending is not None:
+            self.superseded += 1
+        self._pending = shim_request(item.currents, self.client.name)
+        if not self._flush():
+            self.client.logger.warning(
+                f"Currents not sent within {self.flush_timeout} s, carrying on."
+            )
+        if self.rate is not None:
+            self.rate.observe(time.perf_counter() - item.arrived)
+
+    def _flush(self):
+        """Run the client until it has sent the waiting frame and has nothing left to send. Returns False if it ran
+        out of time."""
+        message = self.client.selector.get_key(self.client.socket).data
+        if message.is_idle():
+            # read whatever the server has sent us since, e.g. mrshim's apply times. after sending we only listen
+            # for the answer to a command, so without this nothing else would ever be read.
+            self.client.selector.modify(
+                self.client.socket, selectors.EVENT_READ, data=message
+            )
+            self.client.main_loop()
+        deadline = time.perf_counter() + self.flush_timeout
+        while True:
+            if message.is_idle():
+                if self._pending is None:
+                    return True
+                # only now, a request made while the last was going out (or a relay half read) would be lost.
+                self.client.send_request(self._pending)
+                self._pending = None
+            self.client.main_loop()  # at least once, however short the timeout.
+            if time.perf_counter() > deadline or not self.client.running:
+                return False
@@ -0,0 +1,260 @@
+import collections
+import json
+import socket
+import struct
+import time
+
+import numpy as np
+
+# talking to the skope software over its tcp ports, in python rather than matlab.
+# see sendCommand.m, getBlockHeader.m and getDataByBlock.m in libraries/methods for the matlab versions.
+# everything skope sends is big-endian (it is written in labview), times are seconds since 1904.
+
+PORT_BASE = 6400  # the default, set in the skope software.
+
+# where a RateController's measurements are kept in the data folder between scans, see RateController.save().
+RATE_FILE = "frame_times.npz"
+
+# ports, as offsets from the port base.
+COMMAND = 0
+PHASE = 1
+RAW = 2
+K = 3
+BFIT = 4
+GFIT = 5
+LOG = 6
+
+VERSION = b"2017.0.0000"
+
+# version, data id, send time, acquisition time, processing latency, number of channels, block size.
+BLOCK_HEADER = struct.Struct(">11sc3dHI")
+
+# seconds between 1904-01-01 (labview's epoch) and 1970-01-01 (unix's).
+LABVIEW_EPOCH_OFFSET = 2082844800
+
+
+class SkopeError(Exception):
+    """Raised when the skope software reports an error, or doesn't answer."""
+
+    pass
+
+
+def labview_time(unix_time=None):
+    """Get a time in seconds since 1904, as skope stamps its blocks."""
+    if unix_time is None:
+        unix_time = time.time()
+    return unix_time + LABVIEW_EPOCH_OFFSET
+
+
+def unpack_block_header(buffer):
+    """Read the 42 byte header which comes before every block skope sends."""
+    (
+        version,
+        data_id,
+        send_time,
+        aq_time,
+        proc_latency,
+        nr_channels,
+        block_size,
+    ) = BLOCK_HEADER.unpack_from(buffer)
+    return {
+        "version": version.decode("ascii"),
+        "dataID": data_id.decode("ascii"),
+        "sendTime": send_time,
+        "aqTime": aq_time,
+        "procLatency": proc_latency,
+        "nrChannels": nr_channels,
+        "blockSize": block_size,
+    }
+
+
+def pack_command(command, value=None):
+    """Make the bytes of a command, its header followed by the json."""
+    command_struct = {"command": command}
+    if value is not None:
+        command_struct["value"] = value
+    body = json.dumps(command_struct).encode("utf-8")
+
+    header = BLOCK_HEADER.pack(VERSION, b"C", labview_time(), 0.0, 0.0, 0, len(body))
+    return header + body
+
+
+def _receive_exactly(sock, size):
+    """Keep reading until we have size bytes."""
+    chunks = []
+    remaining = size
+    while remaining:
+        chunk = sock.recv(min(remaining, 1 << 20))
+        if not chunk:
+            raise SkopeError("Skope closed the connection.")
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+class SkopeControl:
+    """A client for skope's command port (PortBase+0).
+
+    Commands are sent one at a time and we wait for the answer, like sendCommand.m does."""
+
+    def __init__(self, host="localhost", port_base=PORT_BASE, timeout=5.0):
+        self.address = (host, port_base + COMMAND)
+        self.timeout = timeout
+        self.sock = socket.create_connection(self.address, timeout=timeout)
+        # commands are small and we wait for each answer, don't let nagle hold them back.
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def close(self):
+        self.sock.close()
+
+    def _read_block(self):
+        header = unpack_block_header(_receive_exactly(self.sock, BLOCK_HEADER.size))
+        return header, _receive_exactly(self.sock, header["blockSize"])
+
+    def send_command(self, command, value=None):
+        """Send a command and wait for skope to answer it.
+
+        Returns the decoded data for commands which get some, otherwise None."""
+        self.sock.sendall(pack_command(command, value))
+
+        status_received = False
+        while True:
+            try:
+                header, body = self._read_block()
+            except socket.timeout:
+                if status_received:
+                    return None  # a status was all we were getting.
+                raise SkopeError(f"No answer from skope to {command}.")
+
+            data_id = header["dataID"]
+            if data_id == "D":
+                return json.loads(body.decode("utf-8"))
+            elif data_id == "A":
+                return None  # acknowledged
+            elif data_id == "E":
+                raise SkopeError(f"Skope error for {command}: {body.decode('utf-8')}")
+            elif data_id == "S":
+                print(body.decode("utf-8"))
+                status_received = True
+
+    def get_short_scan_def(self):
+        return self.send_command("getShortScanDef")
+
+    def set_short_scan_def(self, scan_def):
+        return self.send_command("setShortScanDef", scan_def)
+
+    def start_scan(self):
+        return self.send_command("startScan")
+
+    def get_project_path(self):
+        return self.send_command("getProjectPath")
+
+
+class RateController:
+    """Picks the shortest dynamicTR the shimming pipeline keeps up with.
+
+    Each frame, observe() how long it took from the block arriving to the currents being sent. On top of that is
+    the relay and mrshim applying them, which we can't see from here: mrshim measures it and reports it back, to
+    observe_apply(). Until it has, apply_allowance is used instead. A dynamics comes in every dynamicTR seconds, so
+    if it is shorter than the pipeline the frames queue up and the currents get later and later.
+
+    dynamicTR can only change between scans, so measure on one scan and set it up for the next with apply(), or
+    save() the measurements and load() them into the next run's controller before it picks one."""
+
+    def __init__(
+        self,
+        min_tr=0.05,
+        max_tr=2.0,
+        margin=0.2,
+        apply_allowance=0.01,
+        percentile=95,
+        window=200,
+        step=0.005,
+    ):
+        self.min_tr = min_tr
+        self.max_tr = max_tr
+        self.margin = margin  # fraction of headroom over the slow frames.
+        # until mrshim reports how long it really takes.
+        self.apply_allowance = apply_allowance
+        self.percentile = percentile
+        self.step = step  # round dynamicTR up to this many seconds.
+        self._durations = collections.deque(maxlen=window)
+        self._apply_times = collections.deque(maxlen=window)
+        self._frame_started = None
+
+    def start_frame(self):
+        """Call when a block arrives."""
+        self._frame_started = time.perf_counter()
+
+    def end_frame(self):
+        """Call once the currents are sent."""
+        if self._frame_started is None:
+            return
+        self.observe(time.perf_counter() - self._frame_started)
+        self._frame_started = None
+
+    def observe(self, duration):
+        self._durations.append(duration)
+
+    def observe_apply(self, seconds):
+        """How long frames took from the server to mrshim and to be applied there, as mrshim reports it."""
+        self._apply_times.append(seconds)
+
+    def apply_time(self, percentile=None):
+        """The relay and applying, as measured by mrshim, or apply_allowance if it hasn't said yet."""
+        if not self._apply_times:
+            return self.apply_allowance
+        return self._percentile(self._apply_times, percentile)
+
+    def pipeline_time(self, percentile=None):
+        """How long the slow frames take, the percentile'th percentile (50 for a typical frame), up to the shims."""
+        if not self._durations:
+            return None
+        return self._percentile(self._durations, percentile) + self.apply_time(
+            percentile
+        )
+
+    def _percentile(self, values, percentile):
+        if percentile is None:
+            percentile = self.percentile
+        ordered = sorted(values)
+        index = min(len(ordered) - 1, int(len(ordered) * percentile / 100))
+        return ordered[index]
+
+    def dynamic_tr(self, fallback=0.5):
+        """The dynamicTR to use for the next scan, fallback if we haven't measured anything yet."""
+        pipeline_time = self.pipeline_time()
+        if pipeline_time is None:
+            return fallback
+
+        tr = pipeline_time * (1 + self.margin)
+        tr = round(self.step * -(-tr // self.step), 6)  # round up to the step.
+        return min(self.max_tr, max(self.min_tr, tr))
+
+    def save(self, path):
+        """Save the frames measured (including any loaded), for the next run to load()."""
+        np.savez(
+            path,
+            durations=np.array(self._durations, dtype=np.float64),
+            apply_times=np.array(self._apply_times, dtype=np.float64),
+        )
+
+    def load(self, path):
+        """Start from the frames a previous run saved. Returns False if there weren't any there."""
+        try:
+            with np.load(path) as saved:
+                durations = saved["durations"].tolist()
+                apply_times = saved["apply_times"].tolist()
+        except (OSError, KeyError, ValueError):
+            return False
+        self._durations.extend(durations)
+        self._apply_times.extend(apply_times)
+        return bool(durations)
+
+    def apply(self, control, fallback=0.5):
+        """Set the dynamicTR for the next scan. Returns the value used."""
+        tr = self.dynamic_tr(fallback)
+        scan_def = control.get_short_scan_def()
+        scan_def["dynamicTR"] = tr
+        control.set_short_scan_def(scan_def)
+        return tr
@@ -0,0 +1,213 @@
+import collections
+import json
+import queue
+import selectors
+import socket
+import threading
+
+import numpy as np
+
+from libraries.skope import (
+    BLOCK_HEADER,
+    PORT_BASE,
+    PHASE,
+    RAW,
+    K,
+    BFIT,
+    GFIT,
+    unpack_block_header,
+)
+
+# reading any mix of skope's data streams at once, on one thread, see getDataByBlock.m for the matlab version.
+# each stream's blocks go to the queues of whoever subscribed to it. a stream nobody is subscribed to is still read
+# (or skope would back up) but its blocks are thrown away as raw bytes, never decoded. so e.g. watching the gradients
+# with gfit doesn't slow down getting bfit to the currents.
+
+STREAMS = {"phase": PHASE, "raw": RAW, "k": K, "bfit": BFIT, "gfit": GFIT}
+
+# a block from a stream. data is a channels x samples array for data blocks, the scan header for H blocks, the text
+# of S and E blocks, and None for T (end of scan).
+Block = collections.namedtuple("Block", ["stream", "header", "data"])
+
+
+def decode_data(stream, header, body):
+    """Turn the body of a data block into a channels x samples array, the same values getDataByBlock.m gives.
+
+    >>> decode_data("raw", {"nrChannels": 1}, np.array([100, 7], ">i4").tobytes())
+    array([[7.+100.j]])
+    """
+    nr_channels = header["nrChannels"]
+    if stream == "raw":
+        # complex int32 pairs. the vendor code flips each 8 byte sample for the byte order, which swaps the two int32s
+        # too, so the second of each pair on the wire is the real part.
+        pairs = np.frombuffer(body, dtype=">i4").reshape(-1, nr_channels, 2)
+        return (pairs[..., 1] + 1j * pairs[..., 0]).T
+    return np.frombuffer(body, dtype=">f8").reshape(-1, nr_channels).T
+
+
+def _body_size(header):
+    if header["dataID"] == "D":
+        return header["blockSize"] * header["nrChannels"] * 8
+    return header["blockSize"]
+
+
+class _Stream:
+    """The connection to one of skope's data ports and how far through the current block we are."""
+
+    def __init__(self, name, sock):
+        self.name = name
+        self.sock = sock
+        # replaced, never changed in place, so subscribing from other threads is safe.
+        self.subscribers = []
+        self.dropped = 0  # blocks thrown away because a subscriber's queue was full.
+        self.discarded = 0  # blocks nobody was subscribed to.
+        self._reset()
+
+    def _reset(self):
+        self.header_buffer = bytearray(BLOCK_HEADER.size)
+        self.received = 0
+        self.header = None
+        self.body = None  # None while discarding.
+        self.remaining = 0
+
+
+class SkopeIngester:
+    """Reads skope's data streams (PortBase+1 to PortBase+5) on one event loop and hands out their blocks.
+
+    ingester = SkopeIngester(streams=("bfit", "gfit"))
+    bfit = ingester.subscribe("bfit")
+    ingester.start()
+    block = bfit.get()
+    """
+
+    def __init__(
+        self, host="localhost", port_base=PORT_BASE, streams=("bfit",), queue_size=64
+    ):
+        self.selector = selectors.DefaultSelector()
+        self.queue_size = queue_size
+        self.running = False
+        self._thread = None
+        self._scratch = memoryview(bytearray(1 << 16))  # where discarded bytes go.
+
+        self.streams = {}
+        for name in streams:
+            sock = socket.create_connection((host, port_base + STREAMS[name]))
+            # blocks can be large, give the kernel room to hold a few while we are busy.
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+            sock.setblocking(False)
+            stream = _Stream(name, sock)
+            self.streams[name] = stream
+            self.selector.register(sock, selectors.EVENT_READ, data=stream)
+
+    def subscribe(self, name, maxsize=None):
+        """Get a queue which will be given every block of a stream from now on.
+
+        If the consumer falls behind and the queue fills up, the oldest block is dropped to make room."""
+        consumer = queue.Queue(maxsize=maxsize or self.queue_size)
+        stream = self.streams[name]
+        stream.subscribers = stream.subscribers + [consumer]
+        return consumer
+
+    def unsubscribe(self, name, consumer):
+        stream = self.streams[name]
+        stream.subscribers = [
+            subscriber
+            for subscriber in stream.subscribers
+            if subscriber is not consumer
+        ]
+
+    def start(self):
+        """Run the event loop on its own thread."""
+        self.running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while self.running:
+            self.run_once(timeout=0.1)
+
+    def stop(self):
+        self.running = False
+        if self._thread is not None:
+            self._thread.join()
+        for stream in self.streams.values():
+            self.selector.unregister(stream.sock)
+            stream.sock.close()
+        self.selector.close()
+
+    def run_once(self, timeout=None):
+        """Read whatever has arrived on any stream."""
+        for key, _ in self.selector.select(timeout=timeout):
+            stream = key.data
+            try:
+                self._read(stream)
+            except BlockingIOError:
+                pass  # read everything there was.
+            except ConnectionResetError as e:
+                print(e)
+                self.selector.unregister(stream.sock)
+                stream.sock.close()
+                del self.streams[stream.name]
+
+    def _read(self, stream):
+        """Read until the socket runs dry, a block at a time."""
+        while True:
+            if stream.header is None:
+                view = memoryview(stream.header_buffer)[stream.received :]
+                received = self._recv_into(stream, view)
+                stream.received += received
+                if stream.received < BLOCK_HEADER.size:
+                    continue
+
+                stream.header = unpack_block_header(stream.header_buffer)
+                stream.remaining = _body_size(stream.header)
+                stream.received = 0
+                if stream.subscribers:
+                    stream.body = bytearray(stream.remaining)
+                else:
+                    stream.discarded += 1
+            elif stream.remaining:
+                if stream.body is not None:
+                    view = memoryview(stream.body)[stream.received :]
+                else:
+                    view = self._scratch[: stream.remaining]
+                received = self._recv_into(stream, view)
+                stream.received += received
+                stream.remaining -= received
+
+            if stream.header is not None and not stream.remaining:
+                if stream.body is not None:
+                    self._deliver(stream)
+                stream._reset()
+
+    def _recv_into(self, stream, view):
+        received = stream.sock.recv_into(view)
+        if not received:
+            raise ConnectionResetError(f"Skope closed the {stream.name} stream.")
+        return received
+
+    def _deliver(self, stream):
+        """Decode a block and give it to everyone subscribed."""
+        header = stream.header
+        data_id = header["dataID"]
+        if data_id == "D":
+            data = decode_data(stream.name, header, stream.body)
+        elif data_id == "H":
+            data = json.loads(stream.body.decode("utf-8"))
+        elif data_id in ("S", "E"):
+            data = stream.body.decode("utf-8")
+        else:
+            data = None
+
+        block = Block(stream.name, header, data)
+        for consumer in stream.subscribers:
+            try:
+                consumer.put_nowait(block)
+            except queue.Full:
+                # this consumer is behind, the newest data is the most useful.
+                try:
+                    consumer.get_nowait()
+                except queue.Empty:
+                    pass
+                consumer.put_nowait(block)
+                stream.dropped += 1
@@ -0,0 +1,137 @@
+import hashlib
+
+import numpy as np
+
+# real solid spherical harmonics, r^l P_l^m(cos theta) cos(m phi) and sin(m phi), as polynomials in x, y and z.
+# they are unnormalised and without the condon-shortley phase, so order 1 is exactly [1, z, x, y], the basis
+# matlab_client.m used to write out by hand. built up with the cartesian recurrences, so there is no trig and
+# every point is evaluated at once.
+#
+# terms are ordered by degree l, then m = 0, then cos and sin for each m = 1..l, giving (order + 1)^2 in total.
+
+
+def number_of_terms(order):
+    return (order + 1) ** 2
+
+
+def term_names(order):
+    """Names for the columns of solid_harmonics(), e.g. l1m1c is the cos part of degree 1, order 1 (x)."""
+    names = []
+    for l in range(order + 1):
+        names.append(f"l{l}m0")
+        for m in range(1, l + 1):
+            names += [f"l{l}m{m}c", f"l{l}m{m}s"]
+    return names
+
+
+def solid_harmonics(points, order, radius=1.0):
+    """Evaluate every harmonic up to order at every point.
+
+    points is n x 3 (x, y, z), returns n x (order + 1)^2. Coordinates are divided by radius first, so higher orders
+    don't shrink to nothing for points much less than a metre out."""
+    points = np.asarray(points, dtype=np.float64) / radius
+    x, y, z = points[:, 0], points[:, 1], points[:, 2]
+    r2 = x * x + y * y + z * z
+
+    # cos[(l, m)] and sin[(l, m)] for the terms worked out so far.
+    cos = {(0, 0): np.ones_like(x)}
+    sin = {(0, 0): np.zeros_like(x)}
+    for m in range(order + 1):
+        if m > 0:
+            # the sectoral terms l = m, from the last one.
+            previous_cos, previous_sin = cos[(m - 1, m - 1)], sin[(m - 1, m - 1)]
+            cos[(m, m)] = (2 * m - 1) * (x * previous_cos - y * previous_sin)
+            sin[(m, m)] = (2 * m - 1) * (y * previous_cos + x * previous_sin)
+        if m + 1 <= order:
+            cos[(m + 1, m)] = (2 * m + 1) * z * cos[(m, m)]
+            sin[(m + 1, m)] = (2 * m + 1) * z * sin[(m, m)]
+        for l in range(m + 2, order + 1):
+            # up in degree, from the two below.
+            cos[(l, m)] = (
+                (2 * l - 1) * z * cos[(l - 1, m)] - (l + m - 1) * r2 * cos[(l - 2, m)]
+            ) / (l - m)
+            sin[(l, m)] = (
+                (2 * l - 1) * z * sin[(l - 1, m)] - (l + m - 1) * r2 * sin[(l - 2, m)]
+            ) / (l - m)
+
+    basis = np.empty((len(x), number_of_terms(order)))
+    column = 0
+    for l in range(order + 1):
+        basis[:, column] = cos[(l, 0)]
+        column += 1
+        for m in range(1, l + 1):
+            basis[:, column] = cos[(l, m)]
+            basis[:, column + 1] = sin[(l, m)]
+            column += 2
+    return basis
+
+
+class HarmonicBasis:
+    """The harmonics at the voxels and probes of one calibration, with what each frame needs worked out already.
+
+    A frame only needs the harmonic coefficients of the field the probes measured, which with probe_pinv is one
+    matrix product whatever the order. Save it with the rest of the calibration, see cached()."""
+
+    def __init__(self, voxels, probes, order, radius=1.0):
+        if len(probes) < number_of_terms(order):
+            raise ValueError(
+                f"Order {order} has {number_of_terms(order)} terms, but there are only {len(probes)} probes to fit them."
+            )
+        self.order = order
+        self.radius = radius
+        self.names = term_names(order)
+        self.key = self._key(voxels, probes, order, radius)
+
+        self.voxels = solid_harmonics(voxels, order, radius)
+        self.probes = solid_harmonics(probes, order, radius)
+        self.probe_pinv = np.linalg.pinv(self.probes)
+
+    @staticmethod
+    def _key(voxels, probes, order, radius):
+        """What the matrices were made from, so a cached copy is only used for the same calibration."""
+        digest = hashlib.sha1()
+        for array in (voxels, probes):
+            digest.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+        digest.update(f"{order},{radius}".encode("utf-8"))
+        return digest.hexdigest()
+
+    def coefficients(self, probe_fields):
+        """Harmonic coefficients of the field measured at the probes (probes, or probes x frames)."""
+        return self.probe_pinv @ probe_fields
+
+    def save(self, path):
+        np.savez(
+            path,
+            key=self.key,
+            order=self.order,
+            radius=self.radius,
+            voxels=self.voxels,
+            probes=self.probes,
+            probe_pinv=self.probe_pinv,
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as saved:
+            basis = cls.__new__(cls)
+            basis.key = str(saved["key"])
+            basis.order = int(saved["order"])
+            basis.radius = float(saved["radius"])
+            basis.names = term_names(basis.order)
+            basis.voxels = saved["voxels"]
+            basis.probes = saved["probes"]
+            basis.probe_pinv = saved["probe_pinv"]
+        return basis
+
+    @classmethod
+    def cached(cls, path, voxels, probes, order, radius=1.0):
+        """Load the basis saved at path if it was made from the same points, otherwise make it and save it there."""
+        try:
+            basis = cls.load(path)
+        except (OSError, KeyError, ValueError):
+            basis = None
+
+        if basis is None or basis.key != cls._key(voxels, probes, order, radius):
+            basis = cls(voxels, probes, order, radius)
+            basis.save(path)
+        return basis
@@ -0,0 +1,99 @@
+import collections
+import math
+import time
+
+import numpy as np
+
+from libraries.current_solver import CurrentSolver
+
+# static shimming of a whole volume from a field map, the currents Arche would give, see static_shim.py.
+#
+# the currents I minimise the residual |C' I + b|^2 over the masked voxels, where b is the field map and C the field
+# each channel makes per mA at each voxel (coil_tmp.npy), within the amplifier limits. only the masked voxels are
+# ever put in a matrix, and everything the size of the volume is done once, as blas matrix products (C C' and C b)
+# on all the cores. the limits are then met by CurrentSolver's projected gradient descent on a channels x channels
+# problem, started from the unlimited least squares currents, so it takes no time at all when they are within them.
+#
+# by default the mean of the residual isn't counted, as the scanner sets its frequency to the field's mean anyway:
+# the shims are only asked to make the field flat, not to cancel its offset.
+
+StaticShimResult = collections.namedtuple(
+    "StaticShimResult",
+    [
+        "currents",  # mA, per channel.
+        "before_rms",  # Hz, of the field map over the mask (less its mean, if the offset is ignored).
+        "after_rms",  # of the residual with the currents.
+        "limited",  # whether they hit the amplifier limits.
+        "iterations",  # the solver's.
+        "seconds",  # to solve, not counting reading the maps.
+    ],
+)
+
+
+def load_coils(path, shape):
+    """coil_tmp.npy as channels x shape, reshaped column major as matlab_client.m does."""
+    coils = np.load(path, mmap_mode="r")
+    return coils.reshape((-1,) + tuple(shape), order="F")
+
+
+class StaticShim:
+    """The currents which best flatten a field map, for one mask.
+
+    field is the field map (Hz), coils channels x its shape (Hz per mA), mask which voxels count."""
+
+    def __init__(
+        self,
+        field,
+        coils,
+        mask,
+        channel_limit=2000.0,
+        rms_limit=2000.0,
+        regularisation=0.0,
+        ignore_offset=True,
+        max_iterations=100000,
+    ):
+        self.mask = np.asarray(mask, dtype=bool)
+        self.ignore_offset = ignore_offset
+        # voxels x channels and voxels, the masked voxels only.
+        self._coils = np.asarray(coils[:, self.mask], dtype=np.float64).T
+        self._field = np.asarray(field, dtype=np.float64)[self.mask]
+        if ignore_offset:
+            self._coils -= self._coils.mean(axis=0)
+            self._field -= self._field.mean()
+
+        self.solver = CurrentSolver(
+            self._coils,
+            channel_limit=channel_limit,
+            rms_limit=rms_limit,
+            regularisation=regularisation,
+            time_budget=math.inf,  # offline, so to convergence.
+            max_iterations=max_iterations,
+        )
+
+    def solve(self):
+        """The currents within the limits, with how much of the field they leave. Returns a StaticShimResult."""
+        started = time.perf_counter()
+        # the least squares currents without limits, from the channels x channels normal equations. the smallest
+        # ones, if some combinations of coils make no field over the mask.
+        hessian = self.solver._hessian
+        unlimited = -np.linalg.pinv(hessian) @ (self._coils.T @ self._field)
+        self.solver.previous = self.solver.project(unlimited)
+        result = self.solver.solve(self._field)
+        seconds = time.perf_counter() - started
+
+        residual = self._coils @ result.currents + self._field
+        return StaticShimResult(
+            result.currents,
+            float(np.sqrt(np.mean(self._field**2))),
+            float(np.sqrt(np.mean(residual**2))),
+            result.limited,
+            result.iterations,
+            seconds,
+        )
+
+    def residual(self, currents):
+        """The field left with these currents over the volume, zero outside the mask (and less its mean, if the
+        offset is ignored)."""
+        residual = np.zeros(self.mask.shape)
+        residual[self.mask] = self._coils @ np.asarray(currents) + self._field
+        return residual
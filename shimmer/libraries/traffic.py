@@ -0,0 +1,40 @@
+from libraries.registry import registry
+
+# traffic classes, lower numbers are serviced first by the server.
+REALTIME = 0  # shim currents, anything on the scan's critical path.
+CONTROL = 1  # commands typed in by operators.
+DIAGNOSTIC = 2  # debugging traffic, monitors and anything we don't recognise.
+
+CLASS_NAMES = {"realtime": REALTIME, "control": CONTROL, "diagnostic": DIAGNOSTIC}
+CLASS_LABELS = {traffic_class: name for name, traffic_class in CLASS_NAMES.items()}
+
+# the most urgent class a frame of each content type can be.
+# a relay is only realtime if the client sending it is.
+CONTENT_TYPE_CLASSES = {
+    "relay": REALTIME,
+    "command": CONTROL,
+    "text/json": CONTROL,
+    "clock": REALTIME,  # held up pings make for a worse clock estimate.
+    "file": DIAGNOSTIC,  # big and never urgent, chunks wait behind everything else.
+    "ndarray": CONTROL,  # fields and telemetry for analysis, off the critical path.
+    "status": DIAGNOSTIC,  # monitoring, relayed behind everything else.
+}
+
+
+def class_of_role(name):
+    """Get the traffic class of a role from the network description.
+
+    Roles which aren't on the registry are treated as diagnostic traffic."""
+    if name not in registry:
+        return DIAGNOSTIC
+
+    class_name = registry[name].get("traffic_class", "control")
+    try:
+        return CLASS_NAMES[class_name]
+    except KeyError:
+        raise ValueError(f"Invalid traffic class {class_name!r} for {name}.")
+
+
+def class_of_frame(role_class, content_type):
+    """Get the traffic class of a frame, which can never be more urgent than the client which sent it."""
+    return max(role_class, CONTENT_TYPE_CLASSES.get(content_type, DIAGNOSTIC))
@@ -0,0 +1,246 @@
+import collections
+import os
+import selectors
+import socket
+import tempfile
+import threading
+
+from libraries.registry import registry, get_address
+
+# unix domain sockets skip the tcp stack when both ends are on the same computer.
+# they aren't available everywhere (e.g. older windows pythons), so we fall back to tcp.
+UNIX_AVAILABLE = hasattr(socket, "AF_UNIX")
+
+
+def socket_path(name: str):
+    """Get the path of the unix socket for a role. Made from the port so two networks on one computer don't clash."""
+    port = registry[name]["port"]
+    return os.path.join(tempfile.gettempdir(), f"shimmer_{name}_{port}.sock")
+
+
+def is_local(name: str, server_name: str = "server"):
+    """Check whether a role is on the same computer as the server, according to the network description."""
+    return get_address(name)[0] == get_address(server_name)[0]
+
+
+def local_transport_enabled(server_name: str = "server"):
+    """Check if the server should offer a unix socket to clients on its own computer."""
+    enabled = registry[server_name].get("local_transport", "tcp") == "unix"
+    return enabled and UNIX_AVAILABLE
+
+
+def uses_unix(name: str, server_name: str = "server"):
+    """Check if this role should talk to the server over a unix socket."""
+    return local_transport_enabled(server_name) and is_local(name, server_name)
+
+
+def _bind_unix(sock, path):
+    """Bind to a unix socket path, removing any left over from last time."""
+    # the unix equivalent of SO_REUSEADDR.
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    sock.bind(path)
+
+
+def open_listeners(server_name: str = "server"):
+    """Open the non-blocking sockets the server listens on.
+
+    There is always a tcp socket, for clients on other computers. If local_transport=unix there is also a unix socket.
+    """
+    host, port = get_address(server_name)
+
+    tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # SO_REUSEADDR avoids bind() exception: OSError: [Errno 48] Address already in use
+    tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    tcp_socket.bind((host, port))
+    listeners = [tcp_socket]
+
+    if local_transport_enabled(server_name):
+        unix_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        _bind_unix(unix_socket, socket_path(server_name))
+        listeners.append(unix_socket)
+
+    for listener in listeners:
+        listener.listen()
+        listener.setblocking(False)
+
+    return listeners
+
+
+def connect(name: str, server_name: str = "server"):
+    """Open a non-blocking connection from a client to the server.
+
+    The client binds to its own address (or socket path) so the server can work out which role it is."""
+    if uses_unix(name, server_name):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        _bind_unix(sock, socket_path(name))
+        server_address = socket_path(server_name)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # SO_REUSEADDR avoids bind() exception: OSError: [Errno 48] Address already in use
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(get_address(name))
+        server_address = get_address(server_name)
+
+    sock.setblocking(False)
+    sock.connect_ex(server_address)
+    return sock
+
+
+def peer_address(addr):
+    """Turn the address of a newly accepted client into its address on the registry.
+
+    Unix peers are identified by their socket path, the rest of shimmer only knows about (host, port) addresses.
+    A path which isn't on the registry, or none at all (e.g. socat, which doesn't bind its end), is made (path, 0),
+    which is nobody's address, so the peer is an unknown client.
+    """
+    if not isinstance(addr, str):
+        return addr
+
+    for name in registry.sections():
+        if socket_path(name) == addr:
+            return get_address(name)
+
+    return (addr or "unbound unix socket", 0)
+
+
+def close(sock):
+    """Close a socket, and remove its path if it was a unix socket."""
+    path = None
+    if UNIX_AVAILABLE and sock.family == socket.AF_UNIX:
+        path = sock.getsockname()
+
+    sock.close()
+
+    if path:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+class Wakeup:
+    """One end of a socketpair on a selector, for another thread to wake up a select() waiting on it.
+
+    e.g. when there is something to send, or a line typed on stdin. A socketpair rather than a pipe, as windows
+    can only select on sockets."""
+
+    addr = None  # for the selector printer.
+
+    def __init__(self, selector):
+        self.selector = selector
+        self.sock, self.other_end = socket.socketpair()
+        self.sock.setblocking(False)
+        self.other_end.setblocking(False)
+        self.selector.register(self.sock, selectors.EVENT_READ, data=self)
+
+    def wake(self):
+        try:
+            self.other_end.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass  # already plenty to wake up to, or we are closed.
+
+    def process_events(self, mask):
+        try:
+            while self.sock.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        self.selector.unregister(self.sock)
+        self.sock.close()
+        self.other_end.close()
+
+
+class QueueSocket:
+    """One end of an in-process connection, for running the server and clients in one python process.
+
+    Quacks enough like a non-blocking socket for the Message classes. Bytes objects are handed straight to the
+    other end's queue, the only thing going through the kernel is a doorbell byte which wakes up the other end's
+    selector when its queue stops being empty. Make these with queue_socketpair().
+    """
+
+    family = None  # not a real socket family, so close() doesn't try and remove a path.
+
+    def __init__(self):
+        self.peer = None
+        self.closed = False
+        self._queue = collections.deque()
+        self._lock = threading.Lock()
+
+        # the selector waits on the read end, we ring the write end.
+        self._doorbell, self._bell_push = socket.socketpair()
+        self._doorbell.setblocking(False)
+        self._bell_push.setblocking(False)
+
+    def fileno(self):
+        return self._doorbell.fileno()
+
+    def setblocking(self, flag):
+        pass  # always non-blocking.
+
+    def getsockname(self):
+        return "inprocess"
+
+    def _ring(self):
+        try:
+            self._bell_push.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass  # already ringing, or we are closed.
+
+    def _silence(self):
+        """Empty the doorbell so the selector stops reporting us as readable."""
+        try:
+            while self._doorbell.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _push(self, data):
+        with self._lock:
+            if not self._queue:
+                self._ring()
+            self._queue.append(data)
+
+    def send(self, data):
+        if self.closed or self.peer.closed:
+            raise ConnectionResetError("In-process peer closed.")
+        self.peer._push(bytes(data))
+        return len(data)
+
+    def recv(self, bufsize):
+        with self._lock:
+            if not self._queue:
+                if self.peer.closed:
+                    return b""  # like a socket, an empty read means the other end has gone.
+                self._silence()
+                raise BlockingIOError
+
+            data = self._queue.popleft()
+            if len(data) > bufsize:
+                self._queue.appendleft(data[bufsize:])
+                data = data[:bufsize]
+
+            # keep ringing after the peer closes so we get to read the empty bytes.
+            if not self._queue and not self.peer.closed:
+                self._silence()
+
+        return data
+
+    def close(self):
+        self.closed = True
+        if self.peer is not None:
+            with self.peer._lock:
+                self.peer._ring()  # wake the other end up so it notices.
+        self._doorbell.close()
+        self._bell_push.close()
+
+
+def queue_socketpair():
+    """Make the two ends of an in-process connection."""
+    first, second = QueueSocket(), QueueSocket()
+    first.peer, second.peer = second, first
+    return first, second
@@ -26,6 +26,9 @@ end
 
 NUMBER_COIL_CHANNELS = 24;
 NUMBER_SKOPE_CHANNELS = 16;
+SPHARM_ORDER = 1;  % order of the spherical harmonics to shim, 1 is [1, z, x, y]
+FIELD_MODEL = '';  % '' to shim each frame's field as measured, or 'velocity' or 'respiratory' to predict it
+BREATHING_PERIOD = 4.0;  % seconds, for the respiratory model
 
 %% reload python module
 % use only on first run or when debugging, otherwise just adds lots of loading time
@@ -57,11 +60,17 @@ connCtrl = initTCPClient( Host, PortBase, BufferSize );
 portData = PortBase + 4;
 connData = initTCPClient( Host, portData, BufferSize );
 
-% TODO: add explanation of how to stream additional data
+% to stream additional data, open another client on its port the same way
+% (e.g. PortBase + 5 for Gfit) and read it with getDataByBlock.
+% reading several streams at once is easier from python with
+% libraries/skope_streams.py, which reads them all on one thread and only
+% decodes the streams somebody has subscribed to.
 
 %% initiate python client interface
 client = interface.MatlabClient('matlab');
 client.start_connection()
+% the frame times measured on the scans before, for this one's dynamicTR.
+client.load_rate([data_folder, 'frame_times.npz']);
 
 %% get probe positions
 % steps repeated from RBowtell's code
@@ -113,9 +122,12 @@ for i = 1:NUMBER_COIL_CHANNELS
     coil_unrolled(i, :) = coil_squeezed(mask > 0);
 end
 
-targets=[ones(size(X1)), Z1, X1, Y1];  % the low dimensional spherical harmonics
+% the spherical harmonics at the voxels and probes. saved with the rest of the
+% data, so they are only worked out again when the mask, probes or order change.
+basis = client.harmonic_basis([data_folder, 'spharm_basis.npz'], [X1, Y1, Z1], positions, int32(SPHARM_ORDER));
+targets = double(basis.voxels);  % the low dimensional spherical harmonics
 idx = 0;  % a counter
-coil_coefficients = zeros([24, 4])';  % to store the coefficients
+coil_coefficients = zeros([24, size(targets, 2)])';  % to store the coefficients
 
 for target = targets 
     idx = idx + 1;
@@ -123,15 +135,19 @@ for target = targets
     coil_coefficients(idx, :) = lsqr(coil_unrolled', target, [], 50);
 end
 
-% find spherical harmonics values at probe positions
-probe_x = positions(:, 1);
-probe_y = positions(:, 2);
-probe_z = positions(:, 3);
-    
-spharms(1, :) = ones(size(probe_x));
-spharms(2, :) = probe_z;
-spharms(3, :) = probe_x;
-spharms(4, :) = probe_y;
+% the per frame solver, which keeps the currents within the amplifier limits
+% (2000mA per channel, 2000mA rms) rather than zeroing them when they aren't.
+% it is saved with the basis, so pipeline_client.py can shim without matlab.
+client.set_up_solver(coil_coefficients, 2000, 2000, [data_folder, 'shim_solver.npz']);
+
+% denoise each frame's field and shim for where it will be once the currents
+% are applied, see libraries/field_filter.py.
+if ~isempty(FIELD_MODEL)
+    client.set_up_predictor(FIELD_MODEL, BREATHING_PERIOD);
+end
+
+% spherical harmonics values at probe positions
+spharms = double(basis.probes)';
 
 %% get scan def and edit parameters
 
@@ -143,7 +159,10 @@ spharms(4, :) = probe_y;
 shortScanDef.scanName = 'shimmer';
 shortScanDef.scanDescription = 'Dynamic shimming via Shimmer (MMCT, 2024)';
 shortScanDef.nrDynamics = 100;  % skope needs at least 2 dynamics to do the bfit.
-shortScanDef.dynamicTR = 0.5;  % want this to be as short a possible for lowest latency
+% want this to be as short a possible for lowest latency.
+% the client times each frame and saves them after the scan, so this is the
+% shortest dynamicTR we kept up with last time (0.5 s if there was no last time).
+shortScanDef.dynamicTR = double(client.recommended_dynamic_tr(0.5));
 % another parameter to look at is interleaving.
 % all paramters are described in the manual and the names in shortScanDef
 % are in the TCP_control_client.m example.
@@ -189,32 +208,35 @@ while isempty(keep_going)
     else
         disp("Recieved data.")
         disp(count)
+        client.frame_started();
     end
     
     disp("Calculating currents.")
 
-    currents = calculate_currents(data, coil_coefficients, spharms);
+    % the best currents within the limits, see libraries/current_solver.py.
+    % calculate_currents(data, coil_coefficients, spharms) gives them without limits.
+    currents = double(client.solve_currents(data))';
 
     disp("Currents are: [mA]")
     %disp(currents')  % currents are also displayed by python so this is
     %redundant
 
-    if (rms(currents) > 2000)
-        disp("rms of currents exceeds 2000mA, setting currents to zero.")
-        currents = zeros(24, 1);
-    elseif (rms(currents) > 1500)
-        disp("Warning! rms of currents exceeds 1700mA.")
-    end
-
     % SENDING THE CURRENTS
     % currents should be a ROW vector of currents in MILLIAMPS
+    % they are queued and sent by python in the background, in order, so we can
+    % get on with the next block. client.flush(timeout) waits until they are sent.
     client.send_currents(int32(currents'));
+    client.frame_finished();
     disp("Currents sent.")
 
     %keep_going = input('Enter anything to stop. ');
     count = count +1;
 end
 
+%% dynamicTR for next time
+fprintf("Shortest dynamicTR sustained over the last scans: %.3f s\n", double(client.recommended_dynamic_tr(0.5)));
+client.save_rate([data_folder, 'frame_times.npz']);
+
 %% disconnect from python server
 % If error occours, close the connection
 disp("Disconnecting from Shimmer server.")
@@ -1,14 +1,16 @@
 #!/usr/bin/env python3
 
+import json
 import selectors
 import sys
 import traceback
 import os  # for os.linesep that one time
 import time
 
-import libraries.parser as parser
+import numpy as np
+
 from libraries.generic_client import Client
-from libraries.client_packets import Message
+from libraries.ramp import MODES, RampScheduler
 
 JUPITER_PLUGGED_IN = False  # set to True to enable Jupiter functionality.
 if JUPITER_PLUGGED_IN:
@@ -18,23 +20,104 @@ else:
         "NOTE: JUPITER_PLUGGED_IN is not True, Jupiter functionality is disabled and this will write to shims.txt. See line 13 of mrshim_client.py"
     )
 
+# the name of the array (see libraries/array_payloads.py) which is taken as a new shim table.
+SHIM_TABLE = "shim_table"
+
+# how long frames take to get here from the server and be applied, the slowest of each APPLY_REPORT_INTERVAL
+# seconds, is sent to FRAME_SOURCE (matlab, or whatever shims in its place) for the dynamicTR it picks.
+FRAME_SOURCE = "matlab"
+APPLY_REPORT_INTERVAL = 1.0
+
+# updating the shims between frames, see libraries/ramp.py. these are what mrshim starts with, !ramp and !slew change
+# them while it runs. a RAMP_RATE of 0 applies each frame as it arrives and nothing in between.
+RAMP_RATE = 0  # updates a second, more than one a dynamicTR to be any use.
+RAMP_MODE = "ramp"  # "step", "ramp" or "extrapolate".
+SLEW_LIMIT = None  # mA a second, for every channel, or None for no limit.
+
 
 class MRShimClient(Client):
     """A class for Sinope. Handles !shim commands and writes shim currents to the file."""
 
-    def __init__(self, name):
+    def __init__(self, name, sock=None):
         super().__init__(name)
-        self.start_connection()
+        self.commands.register(
+            "shim", self.shim, rest=int, usage="shim <currents in mA>"
+        )
+        self.commands.register("start", self.start_shimming)
+        self.commands.register("stop", self.stop_shimming)
+        self.commands.register("hold", self.toggle_holding)
+        self.commands.register("status", self.toggle_status)
+        self.commands.register("reset", self.reset)
+        self.commands.register("egg", self.egg)
+        self.commands.register(
+            "report_status",
+            self.report_status,
+            arguments=(str, float),
+            usage="report_status <client name> <seconds between reports, 0 to stop>",
+        )
+        self.commands.register(
+            "select", self.select, arguments=(int,), usage="select <shim table entry>"
+        )
+        self.commands.register(
+            "load_table",
+            self.load_table_file,
+            arguments=(str,),
+            usage="load_table <.npy file of entries x currents in mA>",
+        )
+        self.commands.register(
+            "table_timer",
+            self.table_timer,
+            arguments=(float,),
+            rest=int,
+            usage="table_timer <seconds per entry, 0 to stop> [first entry]",
+        )
+        self.commands.register("table", self.print_table)
+        self.commands.register(
+            "ramp",
+            self.set_ramp,
+            arguments=(float,),
+            rest=str,
+            usage=f"ramp <updates a second, 0 for off> [{'|'.join(MODES)}]",
+        )
+        self.commands.register(
+            "slew",
+            self.set_slew,
+            rest=float,
+            usage="slew <mA a second, for every channel or each one, 0 for no limit>",
+        )
+        self.start_connection(sock)
         self.channel_number = 24
         self.shimming = False  # shimming is disabled by default!
-        self.currents = [0 for _ in range(1, self.channel_number)]
+        self.currents = [0 for _ in range(self.channel_number)]
         self.print_status = True
         self.holding = False
 
-        # because we never send anything first, we need to create the Message object for this client manually.
-        events = selectors.EVENT_READ
-        message = Message(self.selector, self.socket, self.server_address, None, self)
-        self.selector.modify(self.socket, events, data=message)
+        # currents uploaded ahead of time, an entry per slice (or phase), so switching between them only takes an
+        # index from !select or the table timer instead of every current over the network.
+        self.shim_table = []
+        self.table_entry = None
+        self.table_interval = 0  # seconds per entry on the timer, 0 for off.
+        self._table_started = 0
+        self._table_first = 0
+        self._table_step = None
+
+        # between frames, the scheduler which works out the currents, or None to apply frames as they arrive.
+        self.ramp = None
+        self.ramp_interval = 0
+        self._next_ramp = 0
+        self.slew_limit = SLEW_LIMIT
+
+        # a console's status pane, sent a summary every status_interval seconds while it wants one.
+        self.status_to = None
+        self.status_interval = 0
+        self._next_status = 0
+        self._status_since = time.monotonic()
+        self._frames_since_status = 0
+
+        self._slowest_apply = None
+        self._next_apply_report = 0
+
+        # we keep the connection message from start_connection, it lets the server know which protocol versions we speak.
 
         # setting up the file to write shim currents to.
         # w mode clears the old shims
@@ -42,6 +125,10 @@ class MRShimClient(Client):
 
         if JUPITER_PLUGGED_IN:
             self.channel_number = jupiter.start_connection()
+            self.currents = [0 for _ in range(self.channel_number)]
+
+        if RAMP_RATE:
+            self.set_ramp(RAMP_RATE, RAMP_MODE)
 
     def close(self):
         if JUPITER_PLUGGED_IN:
@@ -49,16 +136,19 @@ class MRShimClient(Client):
         self.shimming_file.close()
         super().close()
 
-    def apply_shims(self):
-        """Decide what to do with the shim values."""
+    def apply_shims(self, quiet=False):
+        """Decide what to do with the shim values. quiet is for the ramp's updates, too many to print."""
 
         if not self.shimming:
             # if we aren't shimming, set all currents to 0
             print(f"Shimming is disabled. Setting currents to 0.")
             self.currents = [0 for _ in range(self.channel_number)]
 
+        apply_started = time.perf_counter()
+        started = self.profiler.begin()
         if JUPITER_PLUGGED_IN:
-            self.send_shims_to_jupiter()
+            self.send_shims_to_jupiter(quiet)
+            self.profiler.end("jupiter", started)
         else:
             # puts the currents in the way sinope likes them.
             # (space delimited floats)
@@ -68,14 +158,18 @@ class MRShimClient(Client):
                 )
                 + os.linesep  # BUG: this doesn't seem to do anything??
             )
-            print(f"'Applying' currents: {formatted_currents}")
+            if not quiet:
+                print(f"'Applying' currents: {formatted_currents}")
             self.shimming_file.write(formatted_currents)
             self.shimming_file.flush()
+            self.profiler.end("shimming_file", started)
+        if self.shimming:  # only real frames are worth reporting.
+            self._observe_apply(time.perf_counter() - apply_started)
 
-    def send_shims_to_jupiter(self):
-        jupiter.set_shim_currents(self.currents)
+    def send_shims_to_jupiter(self, quiet=False):
+        jupiter.set_shim_currents(self.currents, verbose=not quiet)
 
-        if self.print_status:
+        if self.print_status and not quiet:
             if JUPITER_PLUGGED_IN:
                 time.sleep(0.5)
                 jupiter.display_status()
@@ -85,24 +179,100 @@ class MRShimClient(Client):
         # this client doesn't actually do anything to the server itself.
         # it just waits for shims to be sent to it and then writes them to the file.
         if mask & selectors.EVENT_READ:
-            self.apply_shims()
+            if self.ramp is None:  # when ramping, _update_ramp() applies them.
+                self.apply_shims()
             return mask
         if mask & selectors.EVENT_WRITE:
+            message = self.selector.get_key(self.socket).data
+            if message.request is not None:
+                # something of our own to send, let the packet write it.
+                return mask
             # to prevent packet writing, set mask to read.
             # also need to make selector accordingly.
-            message = self.selector.get_key(self.socket).data
             self.selector.modify(self.socket, selectors.EVENT_READ, data=message)
             return 1
 
+    def main_loop(self, timeout=0):
+        super().main_loop(timeout)
+        if self.table_interval and self.shimming and not self.holding:
+            self._step_table_timer()
+        if self.ramp is not None and self.shimming and not self.holding:
+            self._update_ramp()
+        if self.status_to is not None and time.monotonic() >= self._next_status:
+            self.send_status()
+        if (
+            self._slowest_apply is not None
+            and time.monotonic() >= self._next_apply_report
+        ):
+            self.send_apply_time()
+
+    def _observe_apply(self, seconds):
+        """Applying took this long, on top of the last frame's trip from the server (if our clocks are synced)."""
+        total = seconds + (self.last_latency or 0.0)
+        if self._slowest_apply is None or total > self._slowest_apply:
+            self._slowest_apply = total
+
+    def send_apply_time(self):
+        """Tell the frame source the slowest apply since the last report, if we aren't busy sending something else."""
+        message = self.selector.get_key(self.socket).data
+        if not message.is_idle():
+            return  # try again next loop.
+        packet = {
+            "to": FRAME_SOURCE,
+            "from": self.name,
+            "content": ["!apply_time", f"{self._slowest_apply:.6f}"],
+        }
+        self._slowest_apply = None
+        self._next_apply_report = time.monotonic() + APPLY_REPORT_INTERVAL
+        self.send_request(self.create_request("relay", packet))
+
+    def report_status(self, name, seconds):
+        """Start (or with 0 seconds, stop) sending a console our status every so often."""
+        if seconds <= 0:
+            self.status_to = None
+            return
+        self.status_to = name
+        self.status_interval = seconds
+        self._next_status = 0
+
+    def send_status(self):
+        """Send the status summary, if we aren't busy sending something else."""
+        message = self.selector.get_key(self.socket).data
+        if not message.is_idle():
+            return  # try again next loop.
+
+        now = time.monotonic()
+        status = {
+            "frame_rate": self._frames_since_status / (now - self._status_since),
+            "shimming": self.shimming,
+            "holding": self.holding,
+            "currents": self.currents,
+            "table_entry": self.table_entry,
+            "latency": self.last_latency,
+            # reading them takes a trip to the amplifiers, so only as often as asked for.
+            "temperatures": jupiter.read_temperatures() if JUPITER_PLUGGED_IN else None,
+        }
+        self._status_since = now
+        self._frames_since_status = 0
+        self._next_status = now + self.status_interval
+
+        packet = {
+            "to": self.status_to,
+            "from": self.name,
+            "content": ["!status_update", json.dumps(status, separators=(",", ":"))],
+        }
+        # as diagnostic traffic, so the server never lets it hold up the currents.
+        self.send_request(self.create_request("status", packet))
+
     def create_request(self, action, value):
         """Make a requst from the users entry.
 
         Here, 'type' tells the packet (and then the server) what to do with the content, how to turn it into a header &c..
         """
         self.logger.debug(f"action is {action}, value is {value}")
-        if action == "relay":
+        if action in ("relay", "status"):
             return dict(
-                type="relay",
+                type=action,
                 encoding="utf-8",
                 content=value,
             )
@@ -119,98 +289,217 @@ class MRShimClient(Client):
                 content=bytes(action + value, encoding="utf-8"),
             )
 
-    def handle_command(self, command_string):
-        command_tokens = parser.parse(command_string)
-        self.logger.debug(f"Recieved command tokens are {command_tokens}")
+    def shim(self, *tile):
+        """Set the currents, tiling them across all the channels if there are fewer than the number of channels."""
+        self._frames_since_status += 1
+        if self.holding:
+            return
+
+        if tile:  # if we have valid arguments:
+            flooring = [0 for _ in range(self.channel_number)]  # the empty floor
+
+            # tiles the tile across the floor
+            # i think this is very clever, which probably means it's wrong
+            for idx, _ in enumerate(flooring):
+                flooring[idx] = tile[idx % len(tile)]
+
+            self._set_currents(flooring)
+
+    def array_received(self, name, array, sender):
+        if name == SHIM_TABLE:
+            self.load_table(array)
+        else:
+            super().array_received(name, array, sender)
+
+    def load_table(self, table):
+        """Keep a table of currents (mA), entries x channels, to switch between with !select or the timer.
+
+        Each entry is tiled across the channels as !shim does. They are made lists of ints now, so switching to one
+        is just picking it out."""
+        table = np.atleast_2d(np.asarray(table))
+        if table.ndim != 2 or 0 in table.shape or table.shape[1] > self.channel_number:
+            print(
+                f"A shim table is entries x up to {self.channel_number} currents, not {table.shape}."
+            )
+            return
+        columns = np.arange(self.channel_number) % table.shape[1]
+        self.shim_table = np.rint(table[:, columns]).astype(int).tolist()
+        self.table_entry = None
+        print(f"Loaded a shim table of {len(self.shim_table)} entries.")
+
+    def load_table_file(self, path):
+        """Load a table from a .npy file, e.g. one sent here with !send_file."""
         try:
-            if command_tokens[0] == "shim":
-                if self.holding:
-                    return
-
-                try:
-                    tile = [
-                        int(current_string) for current_string in command_tokens[1:]
-                    ]  # the tile.
-                except ValueError:
-                    print(
-                        "Invalid currents. (Did you accidentally set a letter?) Will use last currents."
-                    )
-                    tile = []
-
-                if tile:  # if we have valid arguments:
-                    flooring = [
-                        0 for _ in range(self.channel_number)
-                    ]  # the empty floor
-
-                    # tiles the tile across the floor
-                    # i think this is very clever, which probably means it's wrong
-                    for idx, _ in enumerate(flooring):
-                        flooring[idx] = tile[idx % len(tile)]
-
-                    self.currents = flooring
-
-            elif command_tokens[0] == "start":
-                print("Shimming enabled.")
-                self.shimming = True
-
-                if JUPITER_PLUGGED_IN:
-                    jupiter.enable_shims()
-
-            elif command_tokens[0] == "stop":
-                print("Shimming disabled.")
-                self.shimming = False
-
-                if JUPITER_PLUGGED_IN:
-                    jupiter.disable_shims()
-
-            elif command_tokens[0] == "hold":
-                self.holding = not self.holding
-                print(f"Currents are{' not ' if not self.holding else ''} held.")
-
-            elif command_tokens[0] == "status":
-                if JUPITER_PLUGGED_IN:
-                    self.print_status = not self.print_status
-                    # toggle printing status information
-                else:
-                    print("JUPITER_PLUGGED_IN is not True, can't do anything.")
-                    print(
-                        "Either this constant is set to False in mrshim_client.py, or the connection failed in the first instance."
-                    )
-
-            elif command_tokens[0] == "reset":
-                print("Attempting soft reset of Jupiter connection.")
-                if JUPITER_PLUGGED_IN:
-                    jupiter.soft_reset()
-                else:
-                    print("JUPITER_PLUGGED_IN is not True, can't do anything.")
-                    print(
-                        "Either this constant is set to False in mrshim_client.py, or the connection failed in the first instance."
-                    )
-
-            elif command_tokens[0] == "egg":
-                print(f"Step aside Mr. Beat! \a")
-        except IndexError:
+            table = np.load(path)
+        except (OSError, ValueError) as e:
+            print(f"Can't load a shim table from {path}: {e}")
+            return
+        self.load_table(table)
+
+    def select(self, index):
+        """Switch to a table entry. Like !shim, it is applied as soon as the command has been read."""
+        self._frames_since_status += 1
+        if self.holding:
+            return
+        if not 0 <= index < len(self.shim_table):
+            print(f"No shim table entry {index}, there are {len(self.shim_table)}.")
+            return
+        self.table_entry = index
+        # a copy, as jupiter zeroes currents over its limit in place.
+        self._set_currents(list(self.shim_table[index]))
+
+    def table_timer(self, seconds, *first):
+        """Step through the table every so many seconds, round and round from the first entry (0 if not given).
+
+        Steps are timed from when the timer started, so they don't drift by however long applying takes."""
+        if seconds <= 0:
+            self.table_interval = 0
+            print("Table timer stopped.")
+            return
+        if not self.shim_table:
+            print("No shim table loaded.")
+            return
+        self.table_interval = seconds
+        self._table_first = first[0] if first else 0
+        self._table_started = time.perf_counter()
+        self._table_step = None
+
+    def _step_table_timer(self):
+        step = int((time.perf_counter() - self._table_started) / self.table_interval)
+        if step == self._table_step:
+            return
+        self._table_step = step
+        self.select((self._table_first + step) % len(self.shim_table))
+        if self.ramp is None:  # when ramping, _update_ramp() applies it.
+            self.apply_shims(quiet=True)
+
+    def print_table(self):
+        if not self.shim_table:
+            print("No shim table loaded.")
+            return
+        timer = f"every {self.table_interval} s" if self.table_interval else "off"
+        print(
+            f"{len(self.shim_table)} entries, at entry {self.table_entry}, timer {timer}."
+        )
+
+    def _set_currents(self, currents):
+        """New currents, applied straight away or, if ramping, the frame for the ramp to go to."""
+        if self.ramp is not None:
+            self.ramp.frame(currents, time.perf_counter())
+        else:
+            self.currents = currents
+
+    def set_ramp(self, rate, *mode):
+        """Update the shims rate times a second between frames (0 stops), see libraries/ramp.py."""
+        if rate <= 0:
+            self.ramp = None
+            self.ramp_interval = 0
+            print("Ramping off, frames are applied as they arrive.")
+            return
+        mode = mode[0] if mode else RAMP_MODE
+        if mode not in MODES:
+            print(f"Unknown ramp mode {mode}, it is one of {', '.join(MODES)}.")
+            return
+        self.ramp = RampScheduler(self.channel_number, mode, self.slew_limit)
+        self.ramp.reset(self.currents)  # from where the shims are now.
+        self.ramp_interval = 1 / rate
+        self._next_ramp = time.perf_counter()
+        print(f"Ramping ({mode}) at {rate} updates a second.")
+
+    def set_slew(self, *limits):
+        """Limit how fast each channel changes, in mA a second: one limit for them all, or one each."""
+        if not limits:
+            print(f"Slew limit: {self.slew_limit} mA/s.")
+            return
+        if len(limits) not in (1, self.channel_number):
+            print(f"Give one slew limit, or {self.channel_number}.")
+            return
+        if any(limit < 0 for limit in limits):
+            print("Slew limits can't be negative.")
+            return
+        if limits == (0,):
+            self.slew_limit = None
+        else:
+            self.slew_limit = limits[0] if len(limits) == 1 else list(limits)
+        if self.ramp is not None:
+            self.ramp.set_slew_limit(self.slew_limit)
+        print(f"Slew limit: {self.slew_limit} mA/s.")
+
+    def _update_ramp(self):
+        """Apply the ramp's currents, if it is time for the next update."""
+        now = time.perf_counter()
+        if now < self._next_ramp:
+            return
+        # on the schedule, unless we have fallen behind it, when we start again from now.
+        self._next_ramp += self.ramp_interval
+        if self._next_ramp < now:
+            self._next_ramp = now + self.ramp_interval
+        self.currents = np.rint(self.ramp.update(now)).astype(int).tolist()
+        self.apply_shims(quiet=True)
+
+    def start_shimming(self):
+        print("Shimming enabled.")
+        self.shimming = True
+        if self.ramp is not None:
+            self.ramp.reset()  # the shims start from 0.
+
+        if JUPITER_PLUGGED_IN:
+            jupiter.enable_shims()
+
+    def stop_shimming(self):
+        print("Shimming disabled.")
+        self.shimming = False
+
+        if JUPITER_PLUGGED_IN:
+            jupiter.disable_shims()
+
+    def toggle_holding(self):
+        self.holding = not self.holding
+        print(f"Currents are{' not ' if not self.holding else ''} held.")
+
+    def toggle_status(self):
+        if JUPITER_PLUGGED_IN:
+            self.print_status = not self.print_status
+            # toggle printing status information
+        else:
+            print("JUPITER_PLUGGED_IN is not True, can't do anything.")
             print(
-                f"Incorrect number of arguments for command {command_tokens[0]}. Look up correct usage in manual."
+                "Either this constant is set to False in mrshim_client.py, or the connection failed in the first instance."
             )
-        super().handle_command(command_string)
 
+    def reset(self):
+        print("Attempting soft reset of Jupiter connection.")
+        if JUPITER_PLUGGED_IN:
+            jupiter.soft_reset()
+        else:
+            print("JUPITER_PLUGGED_IN is not True, can't do anything.")
+            print(
+                "Either this constant is set to False in mrshim_client.py, or the connection failed in the first instance."
+            )
+
+    def egg(self):
+        print(f"Step aside Mr. Beat! \a")
 
-# check correct arguments (none)
-if len(sys.argv) != 1:
-    print(f"Usage: {sys.argv[0]}")
-    sys.exit(1)
 
+def main():
+    # check correct arguments (none)
+    if len(sys.argv) != 1:
+        print(f"Usage: {sys.argv[0]}")
+        sys.exit(1)
+
+    name = "mrshim"
+    mrshim = MRShimClient(name)
+
+    try:
+        while mrshim.running:
+            mrshim.main_loop()
+    finally:
+        # very important that we stop shimming.
+        if JUPITER_PLUGGED_IN:
+            jupiter.stop()
+        mrshim.close()
+        sys.exit(0)
 
-name = "mrshim"
-mrshim = MRShimClient(name)
 
-try:
-    while mrshim.running:
-        mrshim.main_loop()
-finally:
-    # very important that we stop shimming.
-    if JUPITER_PLUGGED_IN:
-        jupiter.stop()
-    mrshim.close()
-    sys.exit(0)
+if __name__ == "__main__":
+    main()
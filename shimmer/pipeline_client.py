@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+
+from libraries.current_solver import CurrentSolver
+from libraries.field_filter import FieldPredictor
+from libraries.generic_client import Client
+from libraries.pipeline import Pipeline
+from libraries.shim_stages import BfitSource, FieldStage, SolverStage, ShimmerSink
+from libraries.skope import (
+    PORT_BASE,
+    RATE_FILE,
+    RateController,
+    SkopeControl,
+    SkopeError,
+)
+from libraries.skope_streams import SkopeIngester
+from libraries.spherical_harmonics import HarmonicBasis
+
+# shimming from skope's bfit stream without matlab, once matlab_client.m has set up the calibration
+# (spharm_basis.npz and shim_solver.npz in the data folder). takes matlab's place on the network.
+# reading skope, fitting, solving and sending each run on their own thread, so they overlap.
+
+SKOPE_HOST = "localhost"
+FIELD_MODEL = None  # None to shim each frame's field as measured, or "velocity" or "respiratory" to predict it.
+BREATHING_PERIOD = 4.0  # seconds, for the respiratory model.
+
+
+def main():
+    # check correct arguments (the data folder)
+    if len(sys.argv) != 2:
+        print(f"Usage: {sys.argv[0]} <data folder>")
+        sys.exit(1)
+    data_folder = sys.argv[1]
+
+    basis = HarmonicBasis.load(os.path.join(data_folder, "spharm_basis.npz"))
+    solver = CurrentSolver.load(os.path.join(data_folder, "shim_solver.npz"))
+    predictor = None
+    if FIELD_MODEL is not None:
+        predictor = FieldPredictor(
+            basis.probes.shape[0],
+            model=FIELD_MODEL,
+            breathing_period=BREATHING_PERIOD,
+        )
+    # measures the whole pipeline, for the predictor and the next scan's dynamicTR. starts from the scans before.
+    rate = RateController()
+    rate_path = os.path.join(data_folder, RATE_FILE)
+    rate.load(rate_path)
+
+    pipeline = Pipeline("pipeline")
+    pipeline.add(BfitSource(SkopeIngester(SKOPE_HOST, PORT_BASE)))
+    pipeline.add(FieldStage(basis, predictor, rate))
+    pipeline.add(SolverStage(solver))
+    pipeline.add(ShimmerSink(Client("matlab"), rate))
+
+    try:
+        pipeline.run()  # raises whatever a failed stage did, after stopping the rest.
+    finally:
+        print(pipeline.report())
+        print(f"Sustainable dynamicTR: {rate.dynamic_tr(fallback=None)} s")
+        rate.save(rate_path)  # for the next run, or matlab_client.m's.
+    set_next_dynamic_tr(rate)
+    sys.exit(0)
+
+
+def set_next_dynamic_tr(rate):
+    """Set skope's dynamicTR for the next scan to the shortest we kept up with, if we measured anything."""
+    if rate.pipeline_time() is None:
+        return
+    try:
+        control = SkopeControl(SKOPE_HOST, PORT_BASE)
+    except OSError as e:
+        print(f"Couldn't connect to skope to set the dynamicTR: {e}")
+        return
+    try:
+        print(f"Set skope's dynamicTR to {rate.apply(control)} s for the next scan.")
+    except (OSError, SkopeError) as e:
+        print(f"Couldn't set skope's dynamicTR: {e}")
+    finally:
+        control.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+import os
+
+# one blas thread per worker, the pool already has a worker on every core. set before numpy is imported.
+for variable in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+    os.environ.setdefault(variable, "1")
+
+import concurrent.futures
+import csv
+import sys
+import time
+
+import numpy as np
+
+from libraries.reevaluation import evaluate_task, settings_grid
+
+# what recorded scans would have shimmed like with other solver settings, masks or harmonic orders, without the
+# scanner. each session is a folder from export_session.m, see libraries/reevaluation.py.
+# every session and setting is evaluated on a process pool across all the cores. writes results.csv, with the mean
+# residual of each, and the currents and per frame residuals of each to <session>_<n>.npz, to the output folder.
+
+# the settings to try, every combination of these. anything not here is as in DEFAULT_SETTINGS.
+SWEEP = dict(
+    order=[1, 2],
+    mask_threshold=[0.05, 0.1],
+    regularisation=[0.0, 1e-4],
+    field_model=[None, "velocity", "respiratory"],
+)
+
+
+def main():
+    # check correct arguments (the output folder and at least one session)
+    if len(sys.argv) < 3:
+        print(
+            f"Usage: {sys.argv[0]} <output folder> <session folder> [<session folder> ...]"
+        )
+        sys.exit(1)
+    output_folder = sys.argv[1]
+    sessions = sys.argv[2:]
+    os.makedirs(output_folder, exist_ok=True)
+
+    # grouped by session then mask, so each worker's chunk mostly reuses one calibration.
+    grid = sorted(
+        settings_grid(**SWEEP), key=lambda s: (s.order, s.mask_threshold, repr(s))
+    )
+    tasks = [(session, settings) for session in sessions for settings in grid]
+    workers = os.cpu_count() or 1
+    chunksize = max(1, len(tasks) // (workers * 4))
+    print(f"Evaluating {len(tasks)} settings and sessions on {workers} processes.")
+
+    started = time.perf_counter()
+    rows = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(evaluate_task, tasks, chunksize=chunksize)
+        for index, (session, settings, summary, evaluation) in enumerate(results):
+            name = os.path.basename(os.path.normpath(session))
+            np.savez(
+                os.path.join(output_folder, f"{name}_{index}.npz"),
+                **evaluation._asdict(),
+            )
+            rows.append(
+                {
+                    "session": name,
+                    "file": f"{name}_{index}.npz",
+                    **settings._asdict(),
+                    **summary,
+                }
+            )
+            print(
+                f"{name} {settings}: rms {summary['before_rms']:.2f} -> {summary['after_rms']:.2f} Hz"
+            )
+
+    with open(os.path.join(output_folder, "results.csv"), "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+    print(f"Done in {time.perf_counter() - started:.1f} s. Best for each session:")
+    for session in sessions:
+        name = os.path.basename(os.path.normpath(session))
+        best = min(
+            (row for row in rows if row["session"] == name),
+            key=lambda row: row["after_rms"],
+        )
+        print(f"  {name}: {best['after_rms']:.2f} Hz rms with {best['file']}")
+
+
+if __name__ == "__main__":
+    main()
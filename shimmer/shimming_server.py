@@ -6,9 +6,14 @@ import sys
 import traceback
 import copy
 import logging
+import time
 
 import libraries.registry as reg
-from libraries.parser import parse
+import libraries.traffic as traffic
+import libraries.transport as transport
+from libraries.commands import CommandTable, CommandError
+from libraries.metrics import MetricsRegistry, MetricsEndpoint
+from libraries.profiling import StageProfiler
 from libraries.server_packets import Message, ClientDisconnect
 from libraries.printers import selector_printer
 
@@ -22,6 +27,11 @@ class ModelClient:
         self.id = id
         self.name = name  # the role name for this client generic client object.
 
+        # the client's estimate of how far our clock is ahead of its own, see libraries/clock.py.
+        self.clock_offset = None
+        self.clock_uncertainty = None
+        self.clock_drift = 0.0
+
 
 class ShimmingServer:
     """Coordinates packets between clients. Has internal state."""
@@ -46,6 +56,11 @@ class ShimmingServer:
         self.debugging = reg.registry["server"].getboolean("debug")
         self.halting = False
 
+        # seconds per loop we are allowed to spend on anything less urgent than realtime traffic.
+        self.low_priority_budget = reg.registry["server"].getfloat(
+            "low_priority_budget", fallback=0.005
+        )
+
         self.stdout_handler = logging.StreamHandler(sys.stdout)
         self.stdout_handler.setLevel(logging.WARNING)
         self.logger.addHandler(self.stdout_handler)
@@ -53,6 +68,83 @@ class ShimmingServer:
             self.stdout_handler.setLevel(logging.DEBUG)
             print("Debugging mode enabled.")
 
+        # server commands, looked up by name.
+        self.commands = CommandTable()
+        self.commands.register("list", self.list_clients)
+        self.commands.register("status", self.print_status)
+        self.commands.register("halt", self.stop)
+        self.commands.register("debug", self.toggle_debugging)
+        self.commands.register("stats", self.print_stats)
+        self.commands.register("clock", self.print_clocks)
+        self.commands.register(
+            "profile",
+            self.profile,
+            arguments=(float,),
+            rest=str,
+            usage="profile <seconds> [full]",
+        )
+
+        # kept up to date as we run, see the stats command and the metrics endpoint.
+        self.metrics = MetricsRegistry("shimmer_server")
+        self.frames_in = self.metrics.counter(
+            "frames_in_total", "Frames received from each client.", ["client"]
+        )
+        self.frames_out = self.metrics.counter(
+            "frames_out_total", "Frames sent to each client.", ["client"]
+        )
+        self.bytes_in = self.metrics.counter(
+            "bytes_in_total", "Bytes received from each client.", ["client"]
+        )
+        self.bytes_out = self.metrics.counter(
+            "bytes_out_total", "Bytes sent to each client.", ["client"]
+        )
+        self.send_queue_bytes = self.metrics.gauge(
+            "send_queue_bytes", "Bytes waiting to be sent to each client.", ["client"]
+        )
+        self.ready_sockets = self.metrics.gauge(
+            "ready_sockets",
+            "Sockets ready in the last loop, by traffic class.",
+            ["traffic_class"],
+        )
+        self.deferred_sockets = self.metrics.counter(
+            "deferred_total",
+            "Sockets put off to the next loop by the low priority budget.",
+            ["traffic_class"],
+        )
+        self.clients_connected = self.metrics.gauge(
+            "clients_connected", "Clients currently connected."
+        )
+        self.relay_latency = self.metrics.histogram(
+            "relay_latency_seconds",
+            "From a relay arriving in full to it being sent on in full.",
+            ["from_client", "to_client"],
+        )
+        self.loop_time = self.metrics.histogram(
+            "loop_seconds", "Time spent working in each main loop, not waiting."
+        )
+        self.select_wait = self.metrics.histogram(
+            "select_wait_seconds", "Time spent waiting for sockets to be ready."
+        )
+        self.clock_offset = self.metrics.gauge(
+            "clock_offset_seconds",
+            "How far the server's clock is ahead of each client's.",
+            ["client"],
+        )
+        self.clock_uncertainty = self.metrics.gauge(
+            "clock_uncertainty_seconds",
+            "How far out the clock offset could be.",
+            ["client"],
+        )
+        self.one_way_latency = self.metrics.histogram(
+            "one_way_latency_seconds",
+            "From a client sending a frame to it arriving, corrected for the client's clock.",
+            ["client"],
+        )
+        self.metrics_endpoint = None
+
+        # per stage timers, off until the profile command.
+        self.profiler = StageProfiler(self.name, self.logger)
+
     def _get_socket(self, name):
         return self.clients_on_registry[name].socket
 
@@ -66,47 +158,100 @@ class ShimmingServer:
     def start(self):
         """Start the server."""
 
-        # open a listening socket to listen for new connections.
-        self.lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # SO_REUSEADDR avoids bind() exception: OSError: [Errno 48] Address already in use
-        self.lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.lsock.bind((self.host, self.port))
-        self.lsock.listen()
-        print(f"Listening on {(self.host, self.port)}")
-        self.logger.info(f"Listening on {(self.host, self.port)}")
-        self.lsock.setblocking(False)
-        # adds this socket to the register is a read type io.
-        self.sel.register(self.lsock, selectors.EVENT_READ, data=None)
-
-    def handle_command(self, command_string):
-        """Handle a the command part of a 'command' type packet."""
-        command_tokens = parse(command_string)
-        if command_tokens[0] == "list":
-            print("Listing connected clients:")
-            for name, client in self.clients_on_registry.items():
-                print(f" - {name}({client.id}) @ {client.addr[0]}:{client.addr[1]},")
-        elif command_tokens[0] == "status":
-            print(f"Server {'is' if self.running else 'is not'} running.")
-        elif command_tokens[0] == "halt":
-            self.stop()
-        elif command_tokens[0] == "debug":
-            self.debugging = not self.debugging
+        # open listening sockets to listen for new connections.
+        # tcp for clients on other computers, and maybe a unix socket for those on this one.
+        self.listeners = transport.open_listeners(self.name)
+        for listener in self.listeners:
+            print(f"Listening on {listener.getsockname()}")
+            self.logger.info(f"Listening on {listener.getsockname()}")
+            # adds this socket to the register is a read type io.
+            self.sel.register(listener, selectors.EVENT_READ, data=None)
+
+        # prometheus style text metrics on localhost, if there is a port for them.
+        metrics_port = reg.registry["server"].getint("metrics_port", fallback=0)
+        if metrics_port:
+            self.metrics_endpoint = MetricsEndpoint(
+                self.sel, self.metrics, metrics_port
+            )
+            print(f"Metrics available at http://127.0.0.1:{metrics_port}/metrics")
+
+    def handle_command(self, command_tokens):
+        """Handle a the command part of a 'command' type packet, already split into tokens."""
+        try:
+            if not self.commands.dispatch(command_tokens):
+                self.logger.info(f"Server ignored command {command_tokens}")
+        except CommandError as e:
+            print(e)
+
+    def list_clients(self):
+        print("Listing connected clients:")
+        for name, client in self.clients_on_registry.items():
+            print(f" - {name}({client.id}) @ {client.addr[0]}:{client.addr[1]},")
+
+    def print_status(self):
+        print(f"Server {'is' if self.running else 'is not'} running.")
 
-            if self.debugging:
-                print("Debugging mode enabled.")
-                self.stdout_handler.setLevel(logging.DEBUG)
+    def print_stats(self):
+        print(self.metrics.summary())
+
+    def print_clocks(self):
+        print("Clock offsets (server minus client):")
+        for name, client in self.clients_on_registry.items():
+            if client.clock_offset is None:
+                print(f" - {name}: not synchronised yet")
             else:
-                print("Debugging mode disabled.")
-                self.stdout_handler.setLevel(logging.WARNING)
+                print(
+                    f" - {name}: {client.clock_offset * 1e3:+.3f} ms"
+                    f" +/- {client.clock_uncertainty * 1e3:.3f} ms,"
+                    f" drifting {client.clock_drift * 1e6:+.2f} ppm"
+                )
+
+    def update_clock(self, name, estimate):
+        """Keep the clock estimate a client sent with its ping."""
+        client = self.clients_on_registry.get(name)
+        if client is None or estimate.get("offset") is None:
+            return
+
+        client.clock_offset = estimate["offset"]
+        client.clock_uncertainty = estimate["uncertainty"]
+        client.clock_drift = estimate["drift"]
+        self.clock_offset.set(client.clock_offset, client=name)
+        self.clock_uncertainty.set(client.clock_uncertainty, client=name)
+
+    def to_server_time(self, name, client_time):
+        """Convert a time stamped by a client's clock to ours. None if we don't know its clock yet."""
+        client = self.clients_on_registry.get(name)
+        if client is None or client.clock_offset is None:
+            return None
+        return client_time + client.clock_offset
+
+    def observe_one_way_latency(self, name, sent, received):
+        """Record how long a frame took to get here, once we know the sender's clock."""
+        sent = self.to_server_time(name, sent)
+        if sent is not None:
+            # anything under 0 is within the uncertainty of the offset.
+            self.one_way_latency.observe(max(0.0, received - sent), client=name)
+
+    def profile(self, seconds, *mode):
+        self.profiler.start(seconds, full="full" in mode)
+
+    def toggle_debugging(self):
+        self.debugging = not self.debugging
+
+        if self.debugging:
+            print("Debugging mode enabled.")
+            self.stdout_handler.setLevel(logging.DEBUG)
+        else:
+            print("Debugging mode disabled.")
+            self.stdout_handler.setLevel(logging.WARNING)
 
     def accept_wrapper(self, sock):
         """Accept a new client's connection."""
         self.logger.debug(f"Attempting to accept a new connection from {sock}")
         conn, addr = sock.accept()  # new socket for the client.
+        addr = transport.peer_address(addr)
         print(f"Accepted connection from {addr}")
         conn.setblocking(False)
-        # create a message object to do the talking on.
-        message = Message(self.sel, conn, addr, self)
         name_assigned = False
 
         # work out which role the newly connected client is by comparing against the directory registry file.
@@ -122,53 +267,130 @@ class ShimmingServer:
             role = "unknown"
 
         print(f"{role} just connected.")
+        self._add_client(conn, addr, role)
+
+    def connect_inprocess(self, name):
+        """Connect a client which lives in this process, over queues instead of a socket.
+
+        Returns the client's end of the connection, to give to Client.start_connection()."""
+        server_end, client_end = transport.queue_socketpair()
+        addr = reg.get_address(name)
+        print(f"{name} just connected in-process.")
+        self._add_client(server_end, addr, name)
+        return client_end
+
+    def _add_client(self, conn, addr, role):
+        """Start keeping track of a newly connected client."""
+        # create a message object to do the talking on.
+        message = Message(self.sel, conn, addr, self)
+        message.name = role
+        message.role_traffic_class = traffic.class_of_role(role)
+        message.traffic_class = message.role_traffic_class
         # create a GenericClient object for keeping track of who is connected.
         generated_id = self._generate_id()
         new_client = ModelClient(conn, addr, generated_id, role)
         self.clients_on_registry[role] = new_client
+        self.clients_connected.set(len(self.clients_on_registry))
 
         # add the new message to the selector, we're ready to listen to it.
         self.sel.register(conn, selectors.EVENT_READ, data=message)
 
-    def main_loop(self):
-        """Choose the socket to send/recieve on and do that."""
-        events = self.sel.select(timeout=None)  # set of waiting io
+    def main_loop(self, timeout=None):
+        """Choose the socket to send/recieve on and do that.
+
+        Waiting sockets are sorted into queues by traffic class and the most urgent are serviced first.
+        Only low_priority_budget seconds are spent on the less urgent queues, anything left over is still
+        ready next time we select so it is serviced on the next loop.
+        timeout=0 doesn't wait, for when other things in this process need a turn."""
+        profiler = self.profiler
+        if profiler.active:
+            # wake up in time to write the report, even if nothing happens.
+            timeout = profiler.time_left(timeout)
+        if self.metrics_endpoint:
+            # and in time to drop a scraper which never asks for anything.
+            timeout = self.metrics_endpoint.time_left(timeout)
+
+        loop_start = time.perf_counter()
+        events = self.sel.select(timeout=timeout)  # set of waiting io
+        work_start = time.perf_counter()
+        self.select_wait.observe(work_start - loop_start)
+        if profiler.active:
+            profiler.record("select_wait", work_start - loop_start)
 
         if self.debugging:
             selector_printer(self.sel, events)
 
+        queues = {traffic_class: [] for traffic_class in traffic.CLASS_NAMES.values()}
         for key, mask in events:  # iterate through waiting sockets.
             # key is a NamedTuple with the socket number and data=message. mask is the io type.
             if key.data is None:  # this is a new socket, we should accept it.
+                started = profiler.begin()
                 self.accept_wrapper(key.fileobj)
-            else:  # otherwise we should process it.
-                if key.data.request:
-                    self.logger.debug(f"Key request is {key.data.request}")
-
-                self.current_message = key.data
-                try:
-                    self.current_message.process_events(mask)
-                # during processing, a client may disconnect.
-                # we should handle that nicely
-                except (
-                    RuntimeError,
-                    ConnectionResetError,
-                    ClientDisconnect,
-                ) as disconnected_address:
-                    print("Client disconnected.")
-                    self._remove_from_registry(disconnected_address)
-                    self.current_message.close()
-                except Exception:
-                    print(
-                        f"Main: Error: Exception for {self.current_message.addr}:\n"
-                        f"{traceback.format_exc()}"
-                    )
-                    self.current_message.close()
+                profiler.end("accept", started)
+            else:  # otherwise we queue it to process it.
+                queues[key.data.traffic_class].append((key, mask))
+
+        deadline = None
+        for traffic_class in sorted(queues):
+            label = traffic.CLASS_LABELS[traffic_class]
+            self.ready_sockets.set(len(queues[traffic_class]), traffic_class=label)
+            for key, mask in queues[traffic_class]:
+                if traffic_class > traffic.REALTIME:
+                    # always do at least one piece of low priority work so nobody is starved.
+                    if deadline is None:
+                        deadline = time.perf_counter() + self.low_priority_budget
+                    elif time.perf_counter() > deadline:
+                        self.logger.debug(f"Deferred {key.data.addr} to the next loop.")
+                        self.deferred_sockets.inc(traffic_class=label)
+                        continue
+
+                started = profiler.begin()
+                self.process_message(key.data, mask)
+                profiler.end(f"process_{label}", started)
+
+        work_time = time.perf_counter() - work_start
+        self.loop_time.observe(work_time)
+        if profiler.active:
+            profiler.record("loop_work", work_time)
+            profiler.check()
+
+        if self.metrics_endpoint:
+            self.metrics_endpoint.sweep()
 
         # after processing all the responses, see if we should stop.
         if self.halting:
             self.stop()
 
+    def process_message(self, message, mask):
+        """Let a message read or write, and handle the client disconnecting while it does."""
+        if message.sock is None:  # closed earlier in this loop.
+            return
+
+        if message.request:
+            self.logger.debug(f"Key request is {message.request}")
+
+        self.current_message = message
+        try:
+            self.current_message.process_events(mask)
+        # during processing, a client may disconnect.
+        # we should handle that nicely
+        except (
+            RuntimeError,
+            ConnectionResetError,
+            BrokenPipeError,
+            ClientDisconnect,
+        ):
+            print("Client disconnected.")
+            # not all of these exceptions carry the address, the message always knows it.
+            self._remove_from_registry(self.current_message.addr)
+            self.current_message.close()
+        except Exception:
+            print(
+                f"Main: Error: Exception for {self.current_message.addr}:\n"
+                f"{traceback.format_exc()}"
+            )
+            self.current_message.close()
+
     def _remove_from_registry(self, address):
         """Removes a client from the connected clients registry and deletes its model object."""
         name_assigned = False  # otherwise will fall through to remove last client on the registry.
@@ -182,6 +404,7 @@ class ShimmingServer:
 
         if name_assigned:
             del self.clients_on_registry[name]
+            self.clients_connected.set(len(self.clients_on_registry))
 
     def stop(self):
         # the first time this function is called, self.halting won't have been set.
@@ -204,23 +427,31 @@ class ShimmingServer:
                     print(e)
         else:  # once we have disconnected everybody, then we can close
             print("Closing server.")
-            self.lsock.close()
+            for listener in self.listeners:
+                transport.close(listener)
+            if self.metrics_endpoint:
+                self.metrics_endpoint.close()
             self.sel.close()
             self.running = False
 
 
-if len(sys.argv) != 1:
-    print(f"Usage: {sys.argv[0]}")
-    sys.exit(1)
+def main():
+    if len(sys.argv) != 1:
+        print(f"Usage: {sys.argv[0]}")
+        sys.exit(1)
+
+    server = ShimmingServer()
+    server.start()
+
+    try:
+        while server.running:
+            server.main_loop()
+    except KeyboardInterrupt:
+        print("Caught keyboard interrupt, exiting")
+        server.stop()
+    finally:
+        print("Have a nice day :) - mags")
 
-server = ShimmingServer()
-server.start()
 
-try:
-    while server.running:
-        server.main_loop()
-except KeyboardInterrupt:
-    print("Caught keyboard interrupt, exiting")
-    server.stop()
-finally:
-    print("Have a nice day :) - mags")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+
+import numpy as np
+
+from libraries.generic_client import Client
+from libraries.parrec import ParRec
+from libraries.shim_stages import Currents, ShimmerSink
+from libraries.static_shim import StaticShim, load_coils
+
+# static shimming from a field map without Arche: the currents which flatten the field over the masked volume,
+# see libraries/static_shim.py. reads field_map.PAR/.REC and coil_tmp.npy from the data folder, and writes the
+# currents to static_currents.npy there.
+# with send, the currents are then sent to mrshim as matlab would, so start the server and mrshim first (and not
+# matlab_client.m, whose place this takes). mrshim applies them once shimming is started with !start.
+# blas uses every core for the products over the volume, so leave OMP_NUM_THREADS unset here.
+
+MASK_THRESHOLD = 0.05  # of the brightest voxel, as matlab_client.m.
+CHANNEL_LIMIT = 2000.0  # mA
+RMS_LIMIT = 2000.0  # mA
+REGULARISATION = 0.0
+IGNORE_OFFSET = True  # leave the mean field to the scanner's frequency.
+CLIENT_NAME = "matlab"
+
+
+def main():
+    # check correct arguments (the data folder, and whether to send the currents)
+    if len(sys.argv) not in (2, 3) or sys.argv[2:] not in ([], ["send"]):
+        print(f"Usage: {sys.argv[0]} <data folder> [send]")
+        sys.exit(1)
+    data_folder = sys.argv[1]
+    send = sys.argv[2:] == ["send"]
+
+    started = time.perf_counter()
+    img = ParRec(os.path.join(data_folder, "field_map")).squeezed()
+    magnitude = img[:, :, :, 0, 0]  # img(:, :, :, 1, 1) in matlab_client.m
+    field = img[:, :, :, 1, 1]  # Hz
+    mask = magnitude > MASK_THRESHOLD * magnitude.max()
+    coils = load_coils(os.path.join(data_folder, "coil_tmp.npy"), field.shape)
+    print(
+        f"Read a {'x'.join(map(str, field.shape))} field map and {len(coils)} coils, "
+        f"{mask.sum()} voxels in the mask, in {time.perf_counter() - started:.2f} s."
+    )
+
+    shim = StaticShim(
+        field,
+        coils,
+        mask,
+        channel_limit=CHANNEL_LIMIT,
+        rms_limit=RMS_LIMIT,
+        regularisation=REGULARISATION,
+        ignore_offset=IGNORE_OFFSET,
+    )
+    result = shim.solve()
+    print(
+        f"Solved in {result.seconds:.3f} s ({result.iterations} iterations): "
+        f"rms {result.before_rms:.2f} -> {result.after_rms:.2f} Hz."
+    )
+    if result.limited:
+        print(
+            "Currents are at the amplifier limits, the field is only partly flattened."
+        )
+    print(f"Currents (mA): {np.array2string(result.currents, precision=1)}")
+    np.save(os.path.join(data_folder, "static_currents.npy"), result.currents)
+    print(f"Total time {time.perf_counter() - started:.2f} s.")
+
+    if send:
+        sink = ShimmerSink(Client(CLIENT_NAME), flush_timeout=1.0)
+        sink.start()
+        try:
+            sink.consume(Currents(result.currents, time.perf_counter(), result.limited))
+        finally:
+            sink.stop()
+        print("Sent to mrshim.")
+
+
+if __name__ == "__main__":
+    main()
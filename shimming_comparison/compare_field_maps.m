@@ -1,6 +1,7 @@
 % compares two field maps, shimmed and unshimmed.
 % written by mmct in August 2024
 % based on code by Prof. Richard Bowtell
+% for many sessions at once, with a summary table, see shimmer/compare_field_maps.py
 
 close all;  % close all figures
 % clear;  % ONLY IF NOT CURRENTLY SHIMMING